@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+"""Benchmarks of pypackages_tools.bytecompile on synthetic buildroots.
+
+A buildroot with configurable number of files, tree depth, source sizes, configs and
+SCL rootdirs is generated first (see generate_testroot), then config loading, planning
+and (optionally) execution are timed separately. Results are written as JSON, so that
+they can be compared between versions using --compare.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RPM_BUILDROOT = 'BUILDROOT'
+CONFIG_DIR = os.path.join('etc', 'pypackages-tools')
+
+
+def load_script():
+    """Imports pypackages_tools.bytecompile of this checkout."""
+    sys.path.insert(0, ROOT)
+    from pypackages_tools import bytecompile as module
+    # the script logs every planned item, that's not what we want to measure
+    logging.getLogger().setLevel(logging.WARNING)
+    return module
+
+
+def make_source(size, seed):
+    """Returns valid Python source of roughly given size."""
+    chunks = []
+    total = 0
+    i = seed
+    while total < size:
+        chunk = 'def f{0}(x, y={0}):\n    """Docstring {0}."""\n    return [x + y * n for n in range({0})]\n\n\n'.format(i)
+        chunks.append(chunk)
+        total += len(chunk)
+        i += 1
+    return ''.join(chunks)
+
+
+def generate_testroot(path, files=1000, depth=4, configs=2, scl_roots=2, source_size=2048,
+        python=sys.executable, seed=0):
+    """Generates a test root with configs in etc/pypackages-tools and a synthetic
+    rpm buildroot in BUILDROOT.
+
+    Args:
+        path: directory to generate the test root in
+        files: number of .py files in the buildroot
+        depth: depth of package directories under every libdir or data directory
+        configs: number of system Python configs, the first one is default for /
+        scl_roots: number of SCL configs, each default for its own rootdir
+        source_size: average size of sources in bytes (sizes vary from half to
+            one and a half of it)
+        python: Python interpreter to set in all configs
+        seed: seed of the random generator, same arguments give the same buildroot
+
+    Returns:
+        a tuple (rpm buildroot path, config directory path)
+    """
+    rnd = random.Random(seed)
+    buildroot = os.path.join(path, RPM_BUILDROOT)
+    config_dir = os.path.join(path, CONFIG_DIR)
+    os.makedirs(config_dir)
+
+    # directories that sources are spread across
+    areas = ['usr/share/pkg-data']
+    for i in range(configs):
+        name = 'python3.{0}'.format(i)
+        with open(os.path.join(config_dir, name + '.conf'), 'w') as f:
+            f.write('[bytecompile]\ndefault_for_rootdir={0}\npython={1}\n'.format(
+                int(i == 0), python))
+        areas.extend(['usr/lib/{0}/site-packages'.format(name),
+            'usr/lib64/{0}/site-packages'.format(name)])
+    for i in range(scl_roots):
+        name = 'scl{0}'.format(i)
+        with open(os.path.join(config_dir, name + '.conf'), 'w') as f:
+            f.write(('[bytecompile]\nrootdir=/opt/rh/{{fname}}/root\ndefault_for_rootdir=1\n' +
+                'compile_dirs={{rootdir}}/usr/lib/python3.6:{{rootdir}}/usr/lib64/python3.6\n' +
+                'python={0}\n').format(python))
+        areas.extend(['opt/rh/{0}/root/usr/lib/python3.6/site-packages'.format(name),
+            'opt/rh/{0}/root/usr/share/{0}-data'.format(name)])
+
+    for n in range(files):
+        area = areas[n % len(areas)]
+        packages = ['pkg{0}'.format(rnd.randrange(max(1, files // 100)))]
+        packages.extend('sub{0}'.format(rnd.randrange(4)) for d in range(depth - 1))
+        directory = os.path.join(buildroot, area, *packages)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = rnd.randint(source_size // 2, source_size * 3 // 2)
+        with open(os.path.join(directory, 'mod{0}.py'.format(n)), 'w') as f:
+            f.write(make_source(size, n))
+
+    return buildroot, config_dir
+
+
+def remove_bytecode(buildroot):
+    for root, dirs, files in os.walk(buildroot):
+        if '__pycache__' in dirs:
+            shutil.rmtree(os.path.join(root, '__pycache__'))
+            dirs.remove('__pycache__')
+        for f in files:
+            if f.endswith(('.pyc', '.pyo')):
+                os.unlink(os.path.join(root, f))
+
+
+def time_call(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def benchmark(script, buildroot, config_dir, repeat=3, execute=False, jobs=None):
+    """Times phases of bytecompilation of given buildroot.
+
+    Returns:
+        a mapping {phase: [durations of all repetitions in seconds]}
+    """
+    timings = {}
+
+    def measure(phase, func):
+        timings.setdefault(phase, []).append(time_call(func))
+
+    for r in range(repeat):
+        measure('load_configs', lambda: script.load_configs(config_dir))
+        configs = script.load_configs(config_dir)
+        measure('get_exclude_dirs', lambda: [script.get_exclude_dirs(configs, buildroot, fname)
+            for fname in configs])
+        # the index is memoizing, every phase gets a fresh one
+        measure('unassoc_libdirs_errors', lambda: script.unassoc_libdirs_errors(configs,
+            buildroot, script.BuildrootIndex(buildroot)))
+
+        def plan_invocations():
+            index = script.BuildrootIndex(buildroot)
+            for fname, config in configs.items():
+                config.get_compile_invocations(buildroot,
+                    script.get_exclude_dirs(configs, buildroot, fname), index)
+        measure('get_compile_invocations', plan_invocations)
+
+        def plan_batches():
+            index = script.BuildrootIndex(buildroot)
+            resolver = script.OwnershipResolver(configs, buildroot)
+            for config in configs.values():
+                config.get_compile_batches(buildroot, resolver, index)
+        measure('get_compile_batches', plan_batches)
+
+        if execute:
+            for phase, workers in [('execute_invocations', False), ('execute_workers', True)]:
+                remove_bytecode(buildroot)
+
+                def execute():
+                    retcode = script.bytecompile(buildroot, None, '1', config_dir, False,
+                        jobs=jobs, workers=workers)
+                    if retcode != 0:
+                        raise RuntimeError('bytecompilation failed with {0}'.format(retcode))
+                measure(phase, execute)
+    return timings
+
+
+def summarize(timings):
+    result = {}
+    for phase, runs in timings.items():
+        runs = sorted(runs)
+        result[phase] = {'min': runs[0], 'median': runs[len(runs) // 2], 'runs': runs}
+    return result
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=ROOT, stderr=subprocess.STDOUT)
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Returns lines comparing median times of phases of two benchmark results."""
+    lines = []
+    for phase in sorted(set(old['results']) & set(new['results'])):
+        o, n = old['results'][phase]['median'], new['results'][phase]['median']
+        ratio = n / o if o else float('inf')
+        lines.append('{0:<28} {1:10.4f}s {2:10.4f}s {3:8.2f}x'.format(phase, o, n, ratio))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--configs', type=int, default=2)
+    parser.add_argument('--scl-roots', type=int, default=2)
+    parser.add_argument('--source-size', type=int, default=2048)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--execute', action='store_true', default=False,
+        help='time also the actual bytecompilation')
+    parser.add_argument('--python', default=sys.executable,
+        help='Python interpreter to set in generated configs')
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--output', default=None, help='write JSON results to this file')
+    parser.add_argument('--compare', default=None,
+        help='JSON results of a previous run to compare with')
+    parser.add_argument('--keep', default=None,
+        help='generate the test root into this directory and keep it')
+    args = parser.parse_args(argv)
+
+    script = load_script()
+    path = args.keep or tempfile.mkdtemp(prefix='bench-bytecompile-')
+    try:
+        start = time.time()
+        buildroot, config_dir = generate_testroot(path, files=args.files, depth=args.depth,
+            configs=args.configs, scl_roots=args.scl_roots, source_size=args.source_size,
+            python=args.python, seed=args.seed)
+        generation = time.time() - start
+        timings = benchmark(script, buildroot, config_dir, repeat=args.repeat,
+            execute=args.execute, jobs=args.jobs)
+    finally:
+        if not args.keep:
+            shutil.rmtree(path)
+
+    params = dict((k, getattr(args, k)) for k in
+        ['files', 'depth', 'configs', 'scl_roots', 'source_size', 'seed', 'repeat', 'jobs'])
+    output = {'revision': git_revision(), 'python': platform.python_version(),
+        'parameters': params, 'generation': generation, 'results': summarize(timings)}
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        sys.stderr.write('{0:<28} {1:>11} {2:>11} {3:>9}\n'.format('phase', 'old', 'new',
+            'new/old'))
+        for line in compare(old, output):
+            sys.stderr.write(line + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1 @@
+"""Tools for RPM Python packaging."""
@@ -0,0 +1,3886 @@
+"""Bytecompilation of Python sources in rpm buildroots, as specified by configs
+in /etc/pypackages-tools/.
+
+The brp-python-bytecompile.py script is a thin wrapper of main(); build tools
+can use Bytecompiler to load configs once and plan, execute and inspect the
+bytecompilation of any number of buildroots in process.
+"""
+import argparse
+import base64
+import binascii
+try:
+    from configparser import ConfigParser as SafeConfigParser
+except ImportError:
+    from ConfigParser import SafeConfigParser
+import codecs
+import contextlib
+import copy
+import errno
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shlex
+import shutil
+import signal
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+
+def path_norm_join(path, *more):
+    """Normalize a path using os.path.abspath. If more paths are given,
+    they are merged, normalized and returned. Unlike os.path.join, this
+    also works when any of the paths is/are absolute."""
+    result = [path]
+    result.extend(more)
+    joined = os.path.abspath(os.path.sep.join(result))
+    # POSIX gives exactly two leading slashes an implementation defined meaning,
+    #  so os.path.abspath keeps them; we always want a single one
+    if joined.startswith(os.path.sep * 2):
+        joined = os.path.sep + joined.lstrip(os.path.sep)
+    return joined
+
+
+PYTHON_LIBDIRS = [path_norm_join(os.path.sep, 'usr', 'lib', 'python[0-9].[0-9]'),
+    path_norm_join(os.path.sep, 'usr', 'lib64', 'python[0-9].[0-9]')]
+# shell-style patterns of directories, that are never compiled as part of a rootdir;
+#  they match anywhere in buildroot, patterns not ending with a slash match also
+#  directories that only start with the last component, e.g. /usr/lib/python3.10
+ROOTDIR_EXCLUDE_PATTERNS = ['/bin/', '/sbin/'] + PYTHON_LIBDIRS
+# batches of files compiled by workers aren't made smaller than this by default,
+#  so that the per-batch overhead stays negligible
+MIN_BATCH_SIZE = 64 * 1024
+# estimated cost of bytecompiling a file, that doesn't depend on size of the file
+FILE_WEIGHT_OVERHEAD = 1024
+# number of planned batches, that are held and ordered longest first at once while
+#  planning is pipelined with execution (at least four per job)
+PLAN_WINDOW = 64
+# files of a directory compiled by workers are planned in chunks of at most this many
+#  files, so that huge trees don't have to be walked whole before compilation starts
+PLAN_CHUNK_FILES = 2048
+# seconds after which probing of an interpreter is given up
+PROBE_TIMEOUT = 5
+# mount point of the cgroup filesystem, see get_resource_limits
+CGROUP_ROOT = '/sys/fs/cgroup'
+# memory a running item is expected to take until items of its config are measured,
+#  see MemoryAdmission
+DEFAULT_ITEM_RSS = 64 * 1024 ** 2
+# fraction of memory available in the cgroup that running items may take
+MEMORY_BUDGET_RATIO = 0.8
+
+# Scripts run by the configured Python interpreters. They must work with every Python
+#  that may be configured, so they're written for both Python 2 and 3.
+# The hello() function describes the interpreter, the probe script just prints that
+#  description to stdout.
+_HELLO_SCRIPT = '''
+import binascii, json, os, py_compile, sys
+
+
+def hello():
+    info = {"version": list(sys.version_info[:3]), "optimize": sys.flags.optimize}
+    try:
+        import importlib.util
+        info["magic"] = importlib.util.MAGIC_NUMBER
+    except (ImportError, AttributeError):
+        import imp
+        info["magic"] = imp.get_magic()
+    info["magic"] = binascii.hexlify(info["magic"]).decode("ascii")
+    info["cache_tag"] = getattr(getattr(sys, "implementation", None), "cache_tag", None)
+    if info["cache_tag"] is None and sys.version_info >= (3, 2):
+        import imp
+        info["cache_tag"] = imp.get_tag()
+    return info
+'''
+_PROBE_SCRIPT = _HELLO_SCRIPT + '''
+sys.stdout.write("\\n" + json.dumps(hello()) + "\\n")
+'''
+# Prints the interpreter's executable and the environment that the run template
+#  started it in, see capture_environment.
+_ENVIRONMENT_SCRIPT = '''
+import json, os, sys
+sys.stdout.write("\\n" + json.dumps({"executable": sys.executable,
+    "environ": dict(os.environ)}) + "\\n")
+'''
+# Source of the persistent compile worker. The worker talks to us using newline
+#  separated JSON messages over two pipes inherited as file descriptors READ_FD and
+#  WRITE_FD (stdin can't be used, since run templates may feed a shell script to the
+#  wrapper via stdin). It first sends a "hello" message with information about the
+#  interpreter, then for every batch of [source, dfile, optimize] jobs it sends one
+#  result per file and optimization level and a "done" message with CPU time spent
+#  on the batch. optimize is either a single optimization level (-1 meaning the level
+#  of the interpreter) or a list of levels. Files are written with INVALIDATION_MODE,
+#  name of a py_compile.PycInvalidationMode or None for the interpreter's default.
+_WORKER_SCRIPT = _HELLO_SCRIPT + '''
+
+def compile_file(source, dfile, optimize):
+    """Returns a list of results, one for every optimization level. optimize is
+    either a single level or a list of levels to compile from a single read
+    of the source."""
+    if not isinstance(optimize, list):
+        return [compile_level(source, dfile, optimize)]
+    if len(optimize) > 1 and sys.version_info >= (3, 7):
+        try:
+            return compile_levels(source, dfile, optimize)
+        except (SyntaxError, ValueError, EnvironmentError):
+            # let py_compile report the problem
+            pass
+    return [compile_level(source, dfile, level) for level in optimize]
+
+
+def compile_level(source, dfile, optimize):
+    kwargs = {}
+    if optimize >= 0 and sys.version_info >= (3, 2):
+        kwargs["optimize"] = optimize
+    if INVALIDATION_MODE and hasattr(py_compile, "PycInvalidationMode"):
+        kwargs["invalidation_mode"] = getattr(py_compile.PycInvalidationMode, INVALIDATION_MODE)
+    result = {"source": source, "optimize": optimize}
+    try:
+        cfile = py_compile.compile(source, dfile=dfile, doraise=True, **kwargs)
+    except py_compile.PyCompileError as e:
+        result.update(ok=False, error=e.msg)
+        return result
+    except (IOError, OSError) as e:
+        result.update(ok=False, error=str(e))
+        return result
+    if cfile is None:
+        # Python 2 doesn't return the path of the bytecompiled file
+        cfile = source + (__debug__ and "c" or "o")
+    result.update(ok=True, cfile=cfile)
+    return result
+
+
+def compile_levels(source, dfile, levels):
+    # the same as py_compile.compile of Python 3.7+ does for every level, but the
+    #  source is read and stat'ed only once; it's parsed for every level though,
+    #  sharing the syntax tree would change reference flags in the marshalled code
+    import importlib.util, marshal, struct, tempfile
+    with open(source, "rb") as f:
+        data = f.read()
+    st = os.stat(source)
+    mode = INVALIDATION_MODE
+    if not mode:
+        mode = "CHECKED_HASH" if os.environ.get("SOURCE_DATE_EPOCH") else "TIMESTAMP"
+    # header of PEP 552: magic number, flags and either mtime and size of the source
+    #  or its hash
+    if mode == "TIMESTAMP":
+        header = importlib.util.MAGIC_NUMBER + struct.pack("<III", 0,
+            int(st.st_mtime) & 0xFFFFFFFF, st.st_size & 0xFFFFFFFF)
+    else:
+        header = importlib.util.MAGIC_NUMBER + struct.pack("<I",
+            0b01 | (mode == "CHECKED_HASH") << 1) + importlib.util.source_hash(data)
+    results = []
+    for level in levels:
+        cfile = importlib.util.cache_from_source(source, optimization=level or "")
+        if os.path.islink(cfile) or (os.path.exists(cfile) and not os.path.isfile(cfile)):
+            results.append(compile_level(source, dfile, level))
+            continue
+        code = compile(data, dfile or source, "exec", dont_inherit=True, optimize=level)
+        if os.path.dirname(cfile):
+            os.makedirs(os.path.dirname(cfile), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cfile) or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header + marshal.dumps(code))
+            os.chmod(tmp, st.st_mode & 0o666 | 0o200)
+            os.replace(tmp, cfile)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        results.append({"source": source, "optimize": level, "ok": True, "cfile": cfile})
+    return results
+
+
+def main():
+    rfile = os.fdopen(READ_FD, "r")
+    wfile = os.fdopen(WRITE_FD, "w")
+
+    def send(message):
+        wfile.write(json.dumps(message) + "\\n")
+        wfile.flush()
+
+    send({"hello": hello()})
+    for line in iter(rfile.readline, ""):
+        request = json.loads(line)
+        if request["op"] == "quit":
+            break
+        start = os.times()
+        for source, dfile, optimize in request["jobs"]:
+            for result in compile_file(source, dfile, optimize):
+                send(result)
+        end = os.times()
+        send({"done": True, "cpu": end[0] + end[1] - start[0] - start[1]})
+
+
+main()
+'''
+# Runs INLINE_SCRIPT of an invocation as "python -c" would, recording when the
+#  interpreter got to run it and every file bytecompiled by py_compile (and so by
+#  compileall). However the script ends, the record is written as a JSON dict after
+#  REPORT_MARKER on a line of its own, see Invocation.execute.
+_REPORTING_SCRIPT = '''
+import time
+started = time.time()
+import json, py_compile, sys
+
+compiled = []
+_compile = py_compile.compile
+
+
+def compile(file, cfile=None, *args, **kwargs):
+    result = written = _compile(file, cfile, *args, **kwargs)
+    if sys.version_info < (3, 0):
+        # Python 2 doesn't return the path of the bytecompiled file
+        written = cfile or file + (__debug__ and "c" or "o")
+    if written is not None:
+        compiled.append([file, written])
+    return result
+
+
+py_compile.compile = compile
+try:
+    exec(INLINE_SCRIPT, {"__name__": "__main__"})
+finally:
+    sys.stdout.write(REPORT_MARKER + json.dumps({"started": started,
+        "compiled": compiled}) + "\\n")
+    sys.stdout.flush()
+'''
+# starts the line with the record written by _REPORTING_SCRIPT
+_REPORT_MARKER = '#pypackages-tools-report# '
+
+
+class BuildrootIndex(object):
+    """Index of the directory tree of rpm buildroot, shared by all planning steps.
+
+    Every directory is listed (using os.scandir where available) at most once
+    and only when some planning step asks about it, so planning walks the buildroot
+    at most once regardless of the number of configs and their overlapping rootdirs.
+    Same as os.walk, symlinks to directories are not descended into.
+    """
+
+    def __init__(self, rpm_buildroot):
+        self.rpm_buildroot = rpm_buildroot
+        # {directory: (sorted subdirectory names, sorted .py file names)},
+        #  None for paths that can't be listed
+        self._listings = {}
+        # {directory: (depth, number of .py files in the whole subtree)}
+        self._subtrees = {}
+
+    def listdir(self, directory):
+        """Returns a tuple (subdirectory names, .py file names) of given directory
+        or None if it doesn't exist or isn't a directory."""
+        try:
+            return self._listings[directory]
+        except KeyError:
+            pass
+        subdirs, py_files = [], []
+        try:
+            if scandir is not None:
+                for entry in scandir(directory):
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.name.endswith('.py'):
+                        py_files.append(entry.name)
+            else:
+                for name in os.listdir(directory):
+                    fullpath = os.path.join(directory, name)
+                    if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+                        subdirs.append(name)
+                    elif name.endswith('.py'):
+                        py_files.append(name)
+            listing = (sorted(subdirs), sorted(py_files))
+        except OSError:
+            listing = None
+        self._listings[directory] = listing
+        return listing
+
+    def exists(self, directory):
+        """Returns True if given directory exists."""
+        return self.listdir(directory) is not None
+
+    def get_depth(self, directory):
+        """Returns depth of the subtree of given directory, 0 if it has no subdirectories."""
+        return self._get_subtree(directory)[0]
+
+    def count_py_files(self, directory, recursive=True):
+        """Returns number of .py files in given directory, including its whole
+        subtree if recursive is True."""
+        if not recursive:
+            listing = self.listdir(directory)
+            return len(listing[1]) if listing else 0
+        return self._get_subtree(directory)[1]
+
+    def has_py_files(self, directory):
+        """Returns True if there's any .py file in the subtree of given directory.
+        Unlike count_py_files, the subtree is walked only until the first one is found."""
+        return next(self.iter_py_files(directory), None) is not None
+
+    def iter_py_files(self, directory):
+        """Yields full paths of all .py files in the subtree of given directory,
+        depth-first. __pycache__ directories are skipped."""
+        stack = [directory]
+        while stack:
+            d = stack.pop()
+            listing = self.listdir(d)
+            if not listing:
+                continue
+            for name in listing[1]:
+                yield os.path.join(d, name)
+            stack.extend(os.path.join(d, s) for s in reversed(listing[0]) if s != '__pycache__')
+
+    def get_stamps(self):
+        """Returns {directory relative to rpm buildroot: its mtime, None if it doesn't
+        exist} of all directories listed so far, except for __pycache__ directories.
+        Adding or removing an entry of a directory changes its mtime, so the same
+        stamps mean the same layout of the listed part of the buildroot."""
+        prefix = len(self.rpm_buildroot)
+        return dict((d[prefix:], _get_mtime(d)) for d in self._listings
+            if os.path.basename(d) != '__pycache__')
+
+    def find_dirs(self, pattern):
+        """Returns a sorted list of directories matching given shell-style pattern.
+        Unlike glob.glob, the pattern is an absolute path relative to rpm buildroot
+        and the buildroot path itself is never treated as a pattern."""
+        found = [self.rpm_buildroot]
+        for component in pattern.strip(os.path.sep).split(os.path.sep):
+            matching = []
+            for d in found:
+                listing = self.listdir(d)
+                if listing:
+                    matching.extend(os.path.join(d, s) for s in
+                        fnmatch.filter(listing[0], component))
+            found = matching
+        return sorted(found)
+
+    def _get_subtree(self, directory):
+        try:
+            return self._subtrees[directory]
+        except KeyError:
+            pass
+        # iterative post-order traversal, so that deep trees don't hit recursion limit
+        stack = [(directory, False)]
+        while stack:
+            d, children_done = stack.pop()
+            if d in self._subtrees:
+                continue
+            listing = self.listdir(d) or ([], [])
+            subdirs = [os.path.join(d, s) for s in listing[0]]
+            if children_done:
+                depth = max([self._subtrees[s][0] + 1 for s in subdirs] or [0])
+                py_count = len(listing[1]) + sum(self._subtrees[s][1] for s in subdirs)
+                self._subtrees[d] = (depth, py_count)
+            else:
+                stack.append((d, True))
+                stack.extend((s, False) for s in subdirs if s not in self._subtrees)
+        return self._subtrees[directory]
+
+
+class OwnershipResolver(object):
+    """Decides which config bytecompiles which files in rpm buildroot.
+
+    Compile dirs and rootdirs of all configs are kept in a prefix tree of path
+    components, so resolving a path takes a single walk down the tree, in time
+    proportional to its depth, regardless of the number of configs; matches of
+    ROOTDIR_EXCLUDE_PATTERNS are tracked along the same walk. Only planning of
+    persistent workers, manifests and verification resolve files this way,
+    invocations leave the matching to compileall. Directories are owned by:
+
+    * the config with the deepest compile dir containing the directory, if any
+    * otherwise the config with the deepest rootdir containing the directory
+      (if the config is default for it), unless some part of the directory path
+      matches ROOTDIR_EXCLUDE_PATTERNS
+
+    Owners are represented as units - (config_name, real_dir) tuples, where real_dir
+    is the compile dir or rootdir without rpm buildroot. Paths are matched literally,
+    relative to rpm buildroot, so any characters in them (e.g. regular expression
+    metacharacters) are fine.
+    """
+
+    class _Node(object):
+        __slots__ = ('children', 'compile_dir_unit', 'rootdir_unit', 'units_below')
+
+        def __init__(self):
+            self.children = {}
+            self.compile_dir_unit = None
+            self.rootdir_unit = None
+            # units of this node and all nodes below it
+            self.units_below = set()
+
+    def __init__(self, configs, rpm_buildroot):
+        self.rpm_buildroot = rpm_buildroot
+        self._root = self._Node()
+        # if configs share a directory, the result must not depend on dict ordering
+        for fname, config in sorted(configs.items()):
+            for unit in config.get_units():
+                node = self._insert(unit)
+                if unit[1] in config.formatted_dict['compile_dirs']:
+                    node.compile_dir_unit = node.compile_dir_unit or unit
+                else:
+                    node.rootdir_unit = node.rootdir_unit or unit
+
+        # every pattern is a list of matchers of path components
+        self._exclude_patterns = []
+        for p in ROOTDIR_EXCLUDE_PATTERNS:
+            components = p.strip(os.path.sep).split(os.path.sep)
+            if not p.endswith(os.path.sep):
+                components[-1] += '*'
+            self._exclude_patterns.append([re.compile(fnmatch.translate(c)).match
+                for c in components])
+        # state of the walk at rpm buildroot, see _step
+        self._start = (self._root, self._root.compile_dir_unit, self._root.rootdir_unit,
+            (), False)
+
+    def resolve(self, path):
+        """Returns unit owning given file or None if no config compiles it.
+
+        Args:
+            path: full path of the file, including rpm buildroot
+        """
+        state = self._start
+        for c in self._split(os.path.dirname(path)):
+            state = self._step(state, c)
+        return self._owner(state)
+
+    def iter_owned_files(self, index, unit):
+        """Yields full paths of .py files owned by given unit, depth-first.
+        Subtrees that can't contain any such files are not visited at all.
+
+        Args:
+            index: BuildrootIndex of rpm buildroot
+            unit: (config_name, real_dir) tuple
+        """
+        start = path_norm_join(self.rpm_buildroot, unit[1])
+        state = self._start
+        for c in self._split(start):
+            state = self._step(state, c)
+        stack = [(start, state)]
+        while stack:
+            directory, state = stack.pop()
+            listing = index.listdir(directory)
+            if not listing:
+                continue
+            if self._owner(state) == unit:
+                for name in listing[1]:
+                    yield os.path.join(directory, name)
+            for name in reversed(listing[0]):
+                if name == '__pycache__':
+                    continue
+                sub = self._step(state, name)
+                if self._owner(sub) == unit or \
+                        (sub[0] is not None and unit in sub[0].units_below):
+                    stack.append((os.path.join(directory, name), sub))
+
+    def _insert(self, unit):
+        node = self._root
+        node.units_below.add(unit)
+        for c in self._split_real(unit[1]):
+            node = node.children.setdefault(c, self._Node())
+            node.units_below.add(unit)
+        return node
+
+    def _split(self, path):
+        """Splits a full path into components relative to rpm buildroot."""
+        return self._split_real(os.path.sep + os.path.relpath(path, self.rpm_buildroot))
+
+    def _split_real(self, path):
+        return [c for c in path.split(os.path.sep) if c and c != os.curdir]
+
+    def _step(self, state, c):
+        """Returns state of the walk one path component c deeper. The state is
+        a tuple (node of the prefix tree or None if the path left the tree, deepest
+        compile dir unit, deepest rootdir unit, partial matches of exclude patterns
+        as (pattern index, number of matched components) tuples, whether some
+        pattern has matched)."""
+        node, compile_dir_unit, rootdir_unit, partial, excluded = state
+        if node is not None:
+            node = node.children.get(c)
+            if node is not None:
+                compile_dir_unit = node.compile_dir_unit or compile_dir_unit
+                rootdir_unit = node.rootdir_unit or rootdir_unit
+        if not excluded:
+            matches = []
+            # every pattern may also start matching at this component
+            for i, n in partial + tuple((i, 0) for i in range(len(self._exclude_patterns))):
+                pattern = self._exclude_patterns[i]
+                if pattern[n](c):
+                    if n + 1 == len(pattern):
+                        excluded = True
+                        break
+                    matches.append((i, n + 1))
+            partial = () if excluded else tuple(matches)
+        return node, compile_dir_unit, rootdir_unit, partial, excluded
+
+    def _owner(self, state):
+        node, compile_dir_unit, rootdir_unit, partial, excluded = state
+        if compile_dir_unit is not None:
+            return compile_dir_unit
+        if rootdir_unit is not None and not excluded:
+            return rootdir_unit
+        return None
+
+
+class ByteCompileConfig(object):
+    # flags that the interpreter is invoked with to compile with an optimization level
+    _optimization_flags = {0: '', 1: '-O', 2: '-OO'}
+    # compileall of Python 3.9 and newer can compile more optimization levels at once;
+    #  used in place of the default inline_script
+    _single_pass_inline_script = 'import compileall, sys, re; ' + \
+        'sys.exit(not compileall.compile_dir("{compile_dir}", {depth}, "{real_dir}", ' + \
+        'force={force}, quiet=1, rx={rx}, optimize={optimize}{invalidation_kwargs}))'
+    # values of invalidation_mode mapped to names of py_compile.PycInvalidationMode
+    _invalidation_modes = {'timestamp': 'TIMESTAMP', 'checked-hash': 'CHECKED_HASH',
+        'unchecked-hash': 'UNCHECKED_HASH'}
+
+    def __init__(self, fname, **kwargs):
+        """Initializes ByteCompileConfig object. Configuration options are stored as
+        underscored values - rootdir, default_for_rootdir, flags, python, compile_dirs,
+        inline script, run, cache_dir, optimization_levels, invalidation_mode and
+        capture_environment.
+
+        A formatted_dict attribute with some formatted values (rootdir, default_for_rootdir,
+        flags, python, compile_dirs, cache_dir, optimization_levels, invalidation_mode,
+        invalidation_kwargs and capture_environment) is initialized.
+        inline_script and run aren't in formatted_dict, since they are supposed to be used
+        more times to construct different invocation strings."""
+        self.fname = fname
+        self._rootdir = kwargs.get('rootdir', os.path.sep)
+        self._default_for_rootdir = kwargs.get('default_for_rootdir', '0')
+        self._flags = kwargs.get('flags', '')
+        self._python = kwargs.get('python',
+            path_norm_join(os.path.sep, '{rootdir}', 'usr', 'bin', '{fname}'))
+        self._compile_dirs = kwargs.get('compile_dirs',
+            path_norm_join(os.path.sep, '{rootdir}', 'usr', 'lib', '{fname}') + ':' +
+            path_norm_join(os.path.sep, '{rootdir}', 'usr', 'lib64', '{fname}'))
+        self._inline_script = kwargs.get('inline_script', 'import compileall, sys, re; ' + \
+            'sys.exit(not compileall.compile_dir("{compile_dir}", {depth}, "{real_dir}", ' + \
+            'force={force}, quiet=1, rx={rx}{invalidation_kwargs}))')
+        self._run = kwargs.get('run', "{python} {flags} -c '{inline_script}'")
+        self._cache_dir = kwargs.get('cache_dir', None)
+        self._optimization_levels = kwargs.get('optimization_levels', '0 1')
+        self._invalidation_mode = kwargs.get('invalidation_mode', None)
+        self._capture_environment = kwargs.get('capture_environment', '0')
+        # the options as given, so that the config can be serialized with a plan
+        self.options = dict(kwargs)
+        # persistent workers replace inline_script, so they can't be used with a custom one
+        self.supports_workers = 'inline_script' not in kwargs
+        # {"executable", "environ"} captured from the run template, see capture_environment
+        self.environment = None
+        # TODO: check format of provided attributes
+
+        # not create non-underscored versions of some attributes
+        self.formatted_dict = {'fname': self.fname}
+        self.formatted_dict['rootdir'] = path_norm_join(self._rootdir.format(**self.formatted_dict))
+        self.formatted_dict['default_for_rootdir'] = (self._default_for_rootdir == '1')
+        self.formatted_dict['capture_environment'] = (self._capture_environment == '1')
+        self.formatted_dict['flags'] = self._flags  # no formatting for flags for now
+        self.formatted_dict['python'] = \
+            path_norm_join(self._python.format(**self.formatted_dict))
+        self.formatted_dict['compile_dirs'] = \
+            [path_norm_join(p) for p in self._compile_dirs.format(**self.formatted_dict).split(':')]
+        self.formatted_dict['cache_dir'] = None
+        if self._cache_dir:
+            self.formatted_dict['cache_dir'] = \
+                path_norm_join(self._cache_dir.format(**self.formatted_dict))
+        levels = set()
+        for level in self._optimization_levels.replace(',', ' ').split():
+            if level not in ('0', '1', '2'):
+                raise ValueError('Invalid optimization level "{0}" in config "{1}"'.format(
+                    level, self.fname))
+            levels.add(int(level))
+        self.formatted_dict['optimization_levels'] = sorted(levels)
+        # None means the default of the interpreter (hash based files only if
+        #  SOURCE_DATE_EPOCH is set)
+        self.formatted_dict['invalidation_mode'] = None
+        self.formatted_dict['invalidation_kwargs'] = ''
+        if self._invalidation_mode is not None:
+            mode = self._invalidation_modes.get(self._invalidation_mode.strip())
+            if mode is None:
+                raise ValueError('Invalid invalidation mode "{0}" in config "{1}"'.format(
+                    self._invalidation_mode, self.fname))
+            self.formatted_dict['invalidation_mode'] = mode
+            # the mode can only be passed to compileall of Python 3.7 and newer
+            self.formatted_dict['invalidation_kwargs'] = ', **({{"invalidation_mode": ' + \
+                'compileall.py_compile.PycInvalidationMode.{0}}} if hasattr(' + \
+                'compileall.py_compile, "PycInvalidationMode") else {{}})'
+            self.formatted_dict['invalidation_kwargs'] = \
+                self.formatted_dict['invalidation_kwargs'].format(mode)
+
+    def get_invalidation_mode(self, info):
+        """Returns name of py_compile.PycInvalidationMode, that the Python interpreter
+        described by info (see probe_interpreter) writes bytecompiled files of this
+        config with, None if it writes only timestamp based files (Python < 3.7)."""
+        if tuple(info['version']) < (3, 7):
+            return None
+        if self.formatted_dict['invalidation_mode'] is not None:
+            return self.formatted_dict['invalidation_mode']
+        return 'CHECKED_HASH' if os.environ.get('SOURCE_DATE_EPOCH') else 'TIMESTAMP'
+
+    def get_depth(self, directory, index=None):
+        """Get depth of given directory.
+
+        Args:
+            directory: full path of the directory
+            index: BuildrootIndex to use instead of walking the directory
+        """
+        if index is not None:
+            return index.get_depth(directory)
+        dir_slashes = directory.count(os.path.sep)
+        return max((path[0].count(os.path.sep) for path in os.walk(directory))) - dir_slashes
+
+    def get_compile_invocations(self, rpm_buildroot, exclude_dirs=[], index=None, info=None,
+            force=True):
+        """Returns a list of proper bytecompilation invocations that are to be called
+        based on this config, see iter_compile_invocations."""
+        return list(self.iter_compile_invocations(rpm_buildroot, exclude_dirs, index, info,
+            force))
+
+    def iter_compile_invocations(self, rpm_buildroot, exclude_dirs=[], index=None, info=None,
+            force=True):
+        """Yields proper bytecompilation invocations that are to be called based on
+        this config. Every directory is walked only when the invocations before
+        it were consumed.
+
+        Args:
+            rpm_buildroot: rpm buildroot path
+            exclude_dirs: dirs to be excluded from bytecompilation by this Python
+            index: BuildrootIndex of rpm_buildroot, shared by all configs; a new
+                one is created if not provided
+            info: information about the Python interpreter of this config as returned
+                by probe_interpreter; if it's known to support it, every directory
+                is compiled with all optimization levels by a single invocation
+            force: if False, the invocations skip sources with up to date bytecompiled
+                files (the force value of the inline_script)
+        Yields:
+            Invocation objects
+        """
+        if index is None:
+            index = BuildrootIndex(rpm_buildroot)
+        variations = self.get_variations(info)
+
+        for invocation in self._iter_libdir_compile_invocations(rpm_buildroot, variations,
+                index, force):
+            yield invocation
+        for invocation in self._iter_rootdir_compile_invocations(rpm_buildroot, variations,
+                exclude_dirs, index, force):
+            yield invocation
+
+    def get_flags_variations(self):
+        """Returns a list of flags, one for every Python invocation needed to compile
+        a directory with every optimization level separately."""
+        flags_variations = []
+        for level in self.formatted_dict['optimization_levels']:
+            flags_variations.append(' '.join([self.formatted_dict['flags'],
+                self._optimization_flags[level]]).strip())
+        return flags_variations
+
+    def supports_single_pass(self, info, workers=False):
+        """Tells whether all optimization levels can be compiled in a single pass
+        over every directory by the Python interpreter described by info (see
+        probe_interpreter, None if unknown). Persistent workers need Python 3.2,
+        compileall invocations Python 3.9 and the default inline_script."""
+        if info is None or len(self.formatted_dict['optimization_levels']) < 2:
+            return False
+        if workers:
+            return tuple(info['version']) >= (3, 2)
+        return self.supports_workers and tuple(info['version']) >= (3, 9)
+
+    def get_variations(self, info=None, workers=False):
+        """Returns a list of (flags, optimize) tuples, one for every pass needed to
+        compile a directory. optimize is either -1, meaning the optimization level
+        given by flags, or a list of optimization levels compiled in a single pass.
+
+        Args:
+            info: information about the Python interpreter of this config as returned
+                by probe_interpreter, None if unknown
+            workers: True if the directory is compiled by persistent workers
+        """
+        if self.supports_single_pass(info, workers):
+            return [(self.formatted_dict['flags'], self.formatted_dict['optimization_levels'])]
+        return [(f, -1) for f in self.get_flags_variations()]
+
+    def get_units(self):
+        """Returns a list of (config_name, real_dir) tuples of directories
+        compiled by this config - its compile_dirs and rootdir, if it's default for it."""
+        units = [(self.fname, l) for l in self.formatted_dict['compile_dirs']]
+        if self.formatted_dict['default_for_rootdir']:
+            units.append((self.fname, self.formatted_dict['rootdir']))
+        return units
+
+    def get_compile_batches(self, rpm_buildroot, resolver, index=None, info=None):
+        """Returns a list of batches of files that are to be bytecompiled by persistent
+        workers of this config, see iter_compile_batches."""
+        return list(self.iter_compile_batches(rpm_buildroot, resolver, index, info))
+
+    def iter_compile_batches(self, rpm_buildroot, resolver, index=None, info=None,
+            max_files=None):
+        """Yields batches of files that are to be bytecompiled by persistent workers
+        of this config. This is the persistent workers counterpart of
+        iter_compile_invocations.
+
+        Args:
+            rpm_buildroot: rpm buildroot path
+            resolver: OwnershipResolver of all configs
+            index: BuildrootIndex of rpm_buildroot, shared by all configs; a new
+                one is created if not provided
+            info: information about the Python interpreter of this config as returned
+                by probe_interpreter; if it's known to support it, every file is
+                compiled with all optimization levels by a single worker
+            max_files: if set, files of a compile dir or rootdir are yielded in batches
+                of at most this many files as they're found, otherwise in a single
+                batch (for each variation) after the whole directory is walked
+        Yields:
+            CompileBatch objects
+        """
+        if index is None:
+            index = BuildrootIndex(rpm_buildroot)
+        variations = self.get_variations(info, workers=True)
+        for unit in self.get_units():
+            real_dir = unit[1]
+            compile_dir = path_norm_join(rpm_buildroot, real_dir)
+            sources = resolver.iter_owned_files(index, unit)
+            while True:
+                files = [(source, path_norm_join(real_dir, os.path.relpath(source, compile_dir)))
+                    for source in itertools.islice(sources, max_files)]
+                if not files:
+                    break
+                for f, optimize in variations:
+                    yield CompileBatch(self.fname, compile_dir, real_dir, f,
+                        [(source, dfile, optimize) for source, dfile in files])
+
+    def get_worker_command(self, flags, read_fd, write_fd):
+        """Returns a command that starts persistent compile worker of this config.
+
+        Args:
+            flags: flags to start the Python interpreter with
+            read_fd: file descriptor that the worker reads jobs from
+            write_fd: file descriptor that the worker writes results to
+        Returns:
+            string that can be invoked by subprocess.Popen with shell=True
+        """
+        return self._get_bootstrap_command(flags, self._get_worker_script(read_fd, write_fd))
+
+    def get_worker_popen_args(self, flags, read_fd, write_fd):
+        """Returns a tuple (args, kwargs) for subprocess.Popen starting persistent compile
+        worker of this config, see get_worker_command and get_popen_args."""
+        script = self._get_worker_script(read_fd, write_fd)
+        return self.get_popen_args(flags, script, lambda: self._get_bootstrap_command(flags,
+            script))
+
+    def _get_worker_script(self, read_fd, write_fd):
+        return 'READ_FD, WRITE_FD = {0}, {1}\nINVALIDATION_MODE = {2!r}\n'.format(read_fd,
+            write_fd, self.formatted_dict['invalidation_mode']) + _WORKER_SCRIPT
+
+    def get_reporting_popen_args(self, flags, inline_script):
+        """Returns a tuple (args, kwargs) for subprocess.Popen running given inline
+        script, so that it reports its start and the files it bytecompiles (see
+        _REPORTING_SCRIPT), see get_popen_args."""
+        script = 'REPORT_MARKER = {0!r}\nINLINE_SCRIPT = {1!r}\n'.format(_REPORT_MARKER,
+            inline_script) + _REPORTING_SCRIPT
+        return self.get_popen_args(flags, script, lambda: self._get_bootstrap_command(flags,
+            script))
+
+    def get_probe_command(self, flags):
+        """Returns a command that prints information about the Python interpreter
+        of this config (see _PROBE_SCRIPT) as the last line of its output.
+
+        Args:
+            flags: flags to start the Python interpreter with
+        Returns:
+            string that can be invoked by subprocess.Popen with shell=True
+        """
+        return self._get_bootstrap_command(flags, _PROBE_SCRIPT)
+
+    def get_environment_command(self):
+        """Returns a command that prints the executable of the Python interpreter of this
+        config and its environment, as set up by the run template, as the last line of
+        its output, see capture_environment.
+
+        Returns:
+            string that can be invoked by subprocess.Popen with shell=True
+        """
+        return self._get_bootstrap_command(self.formatted_dict['flags'], _ENVIRONMENT_SCRIPT)
+
+    def get_popen_args(self, flags, inline_script, run_string):
+        """Returns a tuple (args, kwargs) for subprocess.Popen running given inline
+        script by the Python interpreter of this config with given flags. If an
+        environment was captured from the run template (see capture_environment),
+        the interpreter is started directly in it, otherwise run_string is run
+        in a shell.
+
+        Args:
+            flags: flags to start the Python interpreter with
+            inline_script: the script, None if unknown
+            run_string: the command running the script by the run template, or
+                a function returning it
+        """
+        if self.environment is None or inline_script is None:
+            if callable(run_string):
+                run_string = run_string()
+            return run_string, {'shell': True}
+        args = [self.environment['executable']] + shlex.split(flags) + ['-c', inline_script]
+        return args, {'env': self.environment['environ']}
+
+    def _get_bootstrap_command(self, flags, script):
+        """Returns a command running given Python script by the run template of this
+        config in place of inline_script."""
+        # encode the script, so that it survives any quoting and heredocs in run
+        encoded = base64.b64encode(zlib.compress(script.encode('utf-8'))).decode('ascii')
+        bootstrap = 'exec(__import__("zlib").decompress(__import__("base64").b64decode("' + \
+            encoded + '")))'
+        form_dict = dict(compile_dir=None, depth=None, real_dir=None, rx=None, force=None,
+            **self.formatted_dict)
+        form_dict['flags'] = flags
+        form_dict['inline_script'] = bootstrap
+        return self._run.format(**form_dict)
+
+    def _iter_libdir_compile_invocations(self, rpm_buildroot, variations, index, force=True):
+        """Yields proper bytecompilation invocations that are to called based on
+        compile_dirs of this config.
+
+        Args:
+            rpm_buildroot: rpm buildroot path
+            variations: list of (flags, optimize) tuples as returned by get_variations,
+                one invocation is made for each of them for every directory
+            index: BuildrootIndex of rpm_buildroot
+            force: the force value of the inline_script, see iter_compile_invocations
+
+        Yields:
+            Invocation objects
+        """
+        # first, obtain run strings for libdirs
+        for l in self.formatted_dict['compile_dirs']:
+            compile_dir = path_norm_join(rpm_buildroot, l)
+            # there's nothing to do for a directory without any sources
+            if not index.has_py_files(compile_dir):
+                continue
+            real_dir = l
+            form_dict = dict(compile_dir=compile_dir,
+                depth=self.get_depth(compile_dir, index),
+                real_dir=real_dir, rx=None, force=int(force), **self.formatted_dict)
+            for invocation in self._iter_invocations(form_dict, variations):
+                yield invocation
+
+    def _iter_rootdir_compile_invocations(self, rpm_buildroot, variations, exclude_dirs, index,
+            force=True):
+        """Yields proper bytecompilation invocations that are to called for
+        compilation of rootdir of this config (none if this config doesn't say
+        that rootdir should be compiled).
+
+        Args:
+            rpm_buildroot: rpm buildroot path
+            variations: list of (flags, optimize) tuples as returned by get_variations,
+                one invocation is made for each of them
+            exclude_dirs: dirs to be excluded from root bytecompilation
+            index: BuildrootIndex of rpm_buildroot
+            force: the force value of the inline_script, see iter_compile_invocations
+
+        Yields:
+            Invocation objects
+        """
+        if self.formatted_dict['default_for_rootdir']:
+            full_rootdir = path_norm_join(rpm_buildroot, self.formatted_dict['rootdir'])
+            if not index.has_py_files(full_rootdir):
+                return
+            really_exclude = self._get_rootdir_exclude_dirs(full_rootdir, exclude_dirs)
+
+            exclude_rx = '|'.join(_exclude_dir_regex(d, rpm_buildroot) for d in really_exclude)
+            # double quotes, since the inline script is usually single quoted in run
+            rx = 're.compile(r"{0}")'.format(exclude_rx)
+            form_dict = dict(compile_dir=full_rootdir,
+                depth=self.get_depth(full_rootdir, index),
+                real_dir=self.formatted_dict['rootdir'], rx=rx, force=int(force),
+                **self.formatted_dict)
+            for invocation in self._iter_invocations(form_dict, variations, exclude_rx):
+                yield invocation
+
+    def _iter_invocations(self, form_dict, variations, exclude_rx=None):
+        """Yields invocations compiling a directory described by form_dict, one for
+        each of variations."""
+        for f, optimize in variations:
+            # construct the whole inline script
+            if optimize == -1:
+                inline_script = self._inline_script.format(**form_dict)
+            else:
+                inline_script = self._single_pass_inline_script.format(optimize=optimize,
+                    **form_dict)
+            # construct the whole command
+            run_dict = dict(form_dict, flags=f, inline_script=inline_script)
+            yield Invocation(self.fname, form_dict['compile_dir'], form_dict['real_dir'], f,
+                self._run.format(**run_dict), exclude_rx=exclude_rx,
+                optimization_levels=optimize if optimize != -1 else None,
+                inline_script=inline_script)
+
+    def _get_rootdir_exclude_dirs(self, full_rootdir, exclude_dirs):
+        """Returns those of exclude_dirs that can be excluded from compilation of rootdir."""
+        # we can really exclude only these dirs that are not superdirs of rootdir
+        return [d for d in exclude_dirs if not full_rootdir.startswith(d)]
+
+    @classmethod
+    def from_file(cls, fullpath):
+        """A class method that instantiates and returns a config from a given file path."""
+        parser = SafeConfigParser()
+        # open a file first, so that we're sure it's opened with utf-8
+        with codecs.open(fullpath, 'r', 'utf-8') as fp:
+            # readfp is deprecated (and gone in newer Pythons), but Python 2 only has that
+            read_file = getattr(parser, 'read_file', None) or parser.readfp
+            read_file(fp)
+
+        # first handle values that are not in _conf_file_autovalues
+        fname = os.path.splitext(os.path.split(fullpath)[1])[0]
+        items = []
+        if parser.has_section('bytecompile'):
+            items = parser.items('bytecompile')
+        return cls(fname, **dict(items))
+
+
+
+class Invocation(object):
+    """A single bytecompilation command planned from a config.
+
+    Attributes:
+        config_name: name of the config that planned this invocation
+        compile_dir: full path of the compiled directory, including rpm buildroot
+        real_dir: directory hardcoded to the bytecompiled files
+        flags: flags that the Python interpreter is invoked with
+        run_string: the command to run in a shell
+        exclude_rx: regular expression of paths excluded from compilation
+            (as passed to compileall), None if nothing is excluded
+        optimization_levels: list of optimization levels compiled by the invocation
+            in a single pass, None if it's given by flags
+        inline_script: the script run by run_string, used to start the interpreter
+            directly in an environment captured from the run template, None if unknown
+    """
+    def __init__(self, config_name, compile_dir, real_dir, flags, run_string, exclude_rx=None,
+            optimization_levels=None, inline_script=None):
+        self.config_name = config_name
+        self.compile_dir = compile_dir
+        self.real_dir = real_dir
+        self.flags = flags
+        self.run_string = run_string
+        self.exclude_rx = exclude_rx
+        self.optimization_levels = optimization_levels
+        self.inline_script = inline_script
+
+    def to_dict(self):
+        return {'type': 'invocation', 'config_name': self.config_name,
+            'compile_dir': self.compile_dir, 'real_dir': self.real_dir, 'flags': self.flags,
+            'run_string': self.run_string, 'exclude_rx': self.exclude_rx,
+            'optimization_levels': self.optimization_levels,
+            'inline_script': self.inline_script}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['config_name'], data['compile_dir'], data['real_dir'], data['flags'],
+            data['run_string'], exclude_rx=data['exclude_rx'],
+            optimization_levels=data['optimization_levels'],
+            inline_script=data.get('inline_script'))
+
+    def iter_sources(self, index):
+        """Yields full paths of sources compiled by this invocation (unless it
+        uses a custom inline_script), as listed by given BuildrootIndex."""
+        rx = re.compile(self.exclude_rx) if self.exclude_rx is not None else None
+        for source in index.iter_py_files(self.compile_dir):
+            if rx is None or not rx.search(source):
+                yield source
+
+    def execute(self, executor):
+        """Runs the invocation in a new process session, so that the whole process
+        group can be killed by the executor if needed. If the executor reports
+        the run and the inline script is known, the script reports its start up
+        time and the files it bytecompiles, see _REPORTING_SCRIPT.
+
+        Args:
+            executor: Executor that runs this invocation
+
+        Returns:
+            WorkResult object
+        """
+        args, kwargs = self.run_string, {'shell': True}
+        config = executor.configs.get(self.config_name)
+        reporting = config is not None and executor.report and self.inline_script is not None
+        if reporting:
+            args, kwargs = config.get_reporting_popen_args(self.flags, self.inline_script)
+        elif config is not None:
+            args, kwargs = config.get_popen_args(self.flags, self.inline_script,
+                self.run_string)
+        kwargs.update(_new_session_kwargs())
+        start = time.time()
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            **kwargs)
+        if not executor.register_process(proc):
+            return WorkResult(self, None, '', killed=True)
+        try:
+            out = proc.stdout.read()
+            proc.stdout.close()
+            rusage = _wait_with_rusage(proc)
+        finally:
+            executor.unregister_process(proc)
+        cpu_time = max_rss = None
+        if rusage is not None:
+            cpu_time = rusage.ru_utime + rusage.ru_stime
+            # kilobytes on Linux
+            max_rss = rusage.ru_maxrss * 1024 or None
+        output, report = out.decode('utf-8', 'replace'), None
+        if reporting:
+            output, report = _split_report(output)
+        startup_time = compiled_files = None
+        if report is not None:
+            startup_time = report['started'] - start
+            compiled_files = [tuple(f) for f in report['compiled']]
+        return WorkResult(self, proc.returncode, output,
+            killed=executor.cancelled and proc.returncode != 0, cpu_time=cpu_time,
+            startup_time=startup_time, max_rss=max_rss, compiled_files=compiled_files)
+
+
+def _split_report(output):
+    """Splits the record written by _REPORTING_SCRIPT off output of an invocation.
+
+    Returns:
+        a tuple (the output without the record, the record or None if there's none)
+    """
+    before, marker, after = output.rpartition(_REPORT_MARKER)
+    line, newline, rest = after.partition('\n')
+    try:
+        report = json.loads(line) if marker else None
+    except ValueError:
+        report = None
+    if not isinstance(report, dict):
+        return output, None
+    return before + rest, report
+
+
+class CompileBatch(object):
+    """A batch of files to be bytecompiled by a persistent worker of a config.
+
+    Attributes:
+        config_name: name of the config that planned this batch
+        compile_dir: full path of the directory that the files come from,
+            including rpm buildroot
+        real_dir: directory hardcoded to the bytecompiled files
+        flags: flags that the Python interpreter of the worker is invoked with
+        jobs: list of (source, dfile, optimize) tuples, where dfile is the path
+            hardcoded to the bytecompiled file and optimize is the optimization
+            level (-1 means the level of the interpreter) or a list of levels
+            compiled from a single read of the source
+        weight: estimated cost of compiling the batch, None if not estimated yet
+    """
+    def __init__(self, config_name, compile_dir, real_dir, flags, jobs, weight=None):
+        self.config_name = config_name
+        self.compile_dir = compile_dir
+        self.real_dir = real_dir
+        self.flags = flags
+        self.jobs = jobs
+        self.weight = weight
+
+    def describe(self):
+        return '{0} files in "{1}" with flags "{2}"'.format(len(self.jobs), self.compile_dir,
+            self.flags)
+
+    def to_dict(self):
+        return {'type': 'batch', 'config_name': self.config_name,
+            'compile_dir': self.compile_dir, 'real_dir': self.real_dir, 'flags': self.flags,
+            'jobs': self.jobs, 'weight': self.weight}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['config_name'], data['compile_dir'], data['real_dir'], data['flags'],
+            [tuple(job) for job in data['jobs']], data['weight'])
+
+    def split(self, max_weight, get_weight):
+        """Splits the batch into consecutive batches of at most max_weight
+        (unless a single file is heavier).
+
+        Args:
+            max_weight: maximum weight of a resulting batch
+            get_weight: function returning weight of a single job
+
+        Returns:
+            list of CompileBatch objects with weights set
+        """
+        parts = []
+        current, current_weight = [], 0
+        for job in self.jobs:
+            w = get_weight(job)
+            if current and current_weight + w > max_weight:
+                parts.append(CompileBatch(self.config_name, self.compile_dir, self.real_dir,
+                    self.flags, current, current_weight))
+                current, current_weight = [], 0
+            current.append(job)
+            current_weight += w
+        if current:
+            parts.append(CompileBatch(self.config_name, self.compile_dir, self.real_dir,
+                self.flags, current, current_weight))
+        return parts
+
+    def execute(self, executor):
+        """Compiles the batch by a persistent worker obtained from the executor's pool.
+
+        Args:
+            executor: Executor that runs this batch
+
+        Returns:
+            WorkResult object
+        """
+        try:
+            worker = executor.worker_pool.acquire(self.config_name, self.flags)
+        except WorkerError as e:
+            return WorkResult(self, e.returncode, e.output, killed=executor.cancelled)
+        if worker is None:
+            return WorkResult(self, None, '', killed=True)
+        # the first batch compiled by a worker is charged with its start up
+        startup_time = worker.startup_time if not worker.compiled_batches else 0.0
+        cache = executor.caches.get(self.config_name)
+        try:
+            file_results, to_compile, keys = [], self.jobs, {}
+            if cache is not None:
+                file_results, to_compile, keys = cache.restore_jobs(self.jobs, worker.info,
+                    worker.invalidation_mode)
+            compiled = worker.compile(to_compile)
+            cpu_time = worker.last_cpu_time
+            max_rss = _process_tree_rss(worker.proc.pid)
+        except WorkerError as e:
+            return WorkResult(self, e.returncode, e.output, killed=executor.cancelled,
+                startup_time=startup_time)
+        finally:
+            executor.worker_pool.release(worker)
+        if cache is not None:
+            cache.store_results(compiled, keys)
+        file_results.extend(compiled)
+
+        errors = ['*** Error compiling "{0}": {1}'.format(r['source'], r['error'])
+            for r in file_results if not r['ok']]
+        return WorkResult(self, 1 if errors else 0, '\n'.join(errors),
+            file_results=file_results, cpu_time=cpu_time, startup_time=startup_time,
+            max_rss=max_rss)
+
+
+class Plan(object):
+    """Planned bytecompilation of a buildroot, that can be serialized to JSON and
+    executed later, skipping loading of configs, validation and planning.
+
+    Attributes:
+        rpm_buildroot: rpm buildroot
+        configs: mapping of config names to ByteCompileConfig objects
+        items: list of planned items (Invocation and CompileBatch objects)
+    """
+    # version of the serialized format, plans of other versions are refused
+    FORMAT_VERSION = 1
+
+    def __init__(self, rpm_buildroot, configs, items):
+        self.rpm_buildroot = rpm_buildroot
+        self.configs = configs
+        self.items = items
+
+    def to_dict(self):
+        return {'format_version': self.FORMAT_VERSION, 'rpm_buildroot': self.rpm_buildroot,
+            'configs': [[fname, config.options] for fname, config in self.configs.items()],
+            'items': [i.to_dict() for i in self.items]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a plan from the result of to_dict.
+
+        Raises:
+            ValueError if the data isn't a valid plan
+        """
+        try:
+            if data['format_version'] != cls.FORMAT_VERSION:
+                raise ValueError('unsupported plan format version {0}'.format(
+                    data['format_version']))
+            configs = {}
+            for fname, options in data['configs']:
+                configs[fname] = ByteCompileConfig(fname, **options)
+            item_types = {'invocation': Invocation, 'batch': CompileBatch}
+            items = [item_types[i['type']].from_dict(i) for i in data['items']]
+            return cls(data['rpm_buildroot'], configs, items)
+        except (KeyError, TypeError) as e:
+            raise ValueError('invalid plan: {0!r}'.format(e))
+
+    def write(self, path):
+        """Writes the plan to given file (atomically, so that concurrent readers never
+        see it incomplete)."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Loads a plan written by write.
+
+        Raises:
+            IOError or OSError if the file can't be read
+            ValueError if it isn't a valid plan
+        """
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+class PlanCache(object):
+    """On-disk cache of plans, so that repeated runs with the same configs on
+    a buildroot of the same layout skip straight to execution.
+
+    Plans are keyed on what's cheap to check: names, mtimes and sizes of config
+    files, of the interpreters they run and of this script, the buildroot and
+    options that affect planning. Every plan is stored with mtimes of the
+    directories listed by its planning (see BuildrootIndex.get_stamps), taken
+    after the execution, that must all be the same for the plan to be used, so
+    a hit neither walks the buildroot nor probes the interpreters. Only
+    max_entries most recently used plans are kept.
+
+    Attributes:
+        directory: the cache directory
+        max_entries: maximum number of cached plans
+    """
+    def __init__(self, directory, max_entries=64):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def get_key(self, config_dir, configs, rpm_buildroot, **options):
+        """Returns the cache key of plan of given buildroot, planned from configs
+        loaded from config_dir with given options."""
+        key = {'format_version': Plan.FORMAT_VERSION, 'rpm_buildroot': rpm_buildroot,
+            'script': _get_stat_key(os.path.abspath(__file__)), 'options': options,
+            'configs': [[name, _get_stat_key(os.path.join(config_dir, name))]
+                for name in sorted(_list_configs(config_dir))],
+            'interpreters': [[fname, _get_stat_key(config.formatted_dict['python'])]
+                for fname, config in sorted(configs.items())]}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached plan with given key or None, also if the layout of its
+        buildroot changed since it was stored."""
+        path = self._entry_path(key)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            plan = Plan.from_dict(data['plan'])
+            if any(_get_mtime(plan.rpm_buildroot + d) != mtime
+                    for d, mtime in data['stamps'].items()):
+                return None
+            # mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            return None
+        return plan
+
+    def put(self, key, plan, index):
+        """Stores given plan with stamps of its BuildrootIndex in the cache and evicts
+        the least recently used plans."""
+        tmp = None
+        try:
+            makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'plan': plan.to_dict(), 'stamps': index.get_stamps()}, f)
+            os.rename(tmp, self._entry_path(key))
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    path = os.path.join(self.directory, name)
+                    entries.append((os.stat(path).st_mtime, path))
+            for mtime, path in sorted(entries, reverse=True)[self.max_entries:]:
+                os.unlink(path)
+        except (IOError, OSError) as e:
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            logging.warning('Warning: failed to store plan in plan cache "{0}": {1}'.format(
+                self.directory, e))
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+
+def _get_stat_key(path):
+    """Returns [mtime, size] of given file, None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class WorkerError(Exception):
+    """Raised when a persistent compile worker dies unexpectedly."""
+    def __init__(self, returncode, output):
+        super(WorkerError, self).__init__(output)
+        self.returncode = returncode
+        self.output = output
+
+
+class CompileWorker(object):
+    """A persistent compile worker process of a config, started by the run template
+    of the config, see _WORKER_SCRIPT for the protocol.
+
+    Attributes:
+        config_name: name of the config that started this worker
+        flags: flags of the worker's Python interpreter
+        info: the "hello" information about the worker's Python interpreter
+        startup_time: seconds it took the worker to start up and say hello
+        compiled_batches: number of batches compiled by the worker so far
+        last_cpu_time: CPU time the worker spent on the last compiled batch
+        invalidation_mode: name of py_compile.PycInvalidationMode that the worker
+            writes files with, see ByteCompileConfig.get_invalidation_mode
+    """
+    def __init__(self, config, flags):
+        self.config_name = config.fname
+        self.flags = flags
+        self.info = None
+        self.invalidation_mode = None
+        self._config = config
+        self.startup_time = None
+        self.compiled_batches = 0
+        self.last_cpu_time = None
+        self._started = time.time()
+        # (our end, worker's end) of both pipes
+        jobs_read, jobs_write = os.pipe()
+        results_read, results_write = os.pipe()
+        for fd in (jobs_write, results_read):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._log = tempfile.TemporaryFile()
+        args, popen_kwargs = config.get_worker_popen_args(flags, jobs_read, results_write)
+        popen_kwargs.update(_new_session_kwargs())
+        if sys.version_info >= (3, 2):
+            popen_kwargs['pass_fds'] = (jobs_read, results_write)
+        else:
+            popen_kwargs['close_fds'] = False
+        try:
+            self.proc = subprocess.Popen(args, stdout=self._log, stderr=subprocess.STDOUT,
+                **popen_kwargs)
+        finally:
+            os.close(jobs_read)
+            os.close(results_write)
+        self._jobs = os.fdopen(jobs_write, 'w')
+        self._results = os.fdopen(results_read, 'r')
+
+    def start(self):
+        """Waits for the worker to start up and say hello."""
+        self.info = self._receive()['hello']
+        self.startup_time = time.time() - self._started
+        self.invalidation_mode = self._config.get_invalidation_mode(self.info)
+
+    def compile(self, jobs):
+        """Compiles given jobs and returns a list of per-file results.
+
+        Raises:
+            WorkerError if the worker dies
+        """
+        self._send({'op': 'compile', 'jobs': jobs})
+        results = []
+        while True:
+            message = self._receive()
+            if message.get('done'):
+                self.compiled_batches += 1
+                self.last_cpu_time = message.get('cpu')
+                return results
+            results.append(message)
+
+    def close(self):
+        """Asks the worker to quit and waits for it."""
+        try:
+            self._send({'op': 'quit'})
+            self._jobs.close()
+        except (IOError, OSError, WorkerError):
+            pass
+        self._results.close()
+        self.proc.wait()
+        self._log.close()
+
+    def kill(self):
+        _kill_process_group(self.proc)
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _send(self, message):
+        try:
+            self._jobs.write(json.dumps(message) + '\n')
+            self._jobs.flush()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self._died()
+
+    def _receive(self):
+        line = self._results.readline()
+        if not line:
+            self._died()
+        return json.loads(line)
+
+    def _died(self):
+        try:
+            self._jobs.close()
+        except (IOError, OSError):
+            pass
+        self.proc.wait()
+        self._log.seek(0)
+        raise WorkerError(self.proc.returncode,
+            self._log.read().decode('utf-8', 'replace').rstrip())
+
+
+class WorkerPool(object):
+    """A pool of persistent compile workers, kept for reuse per config and flags.
+    There are never more than max_workers workers alive at the same time.
+
+    Worker processes are registered with the executor that uses the pool, so
+    that they get killed on cancellation. The pool may be used by more executors
+    one after another, see attach.
+    """
+    def __init__(self, configs, max_workers):
+        self.configs = configs
+        self.max_workers = max_workers
+        self.executor = None
+        self._lock = threading.Lock()
+        # {(config_name, flags): [idle CompileWorker, ...]}
+        self._idle = {}
+        self._busy = set()
+
+    def acquire(self, config_name, flags):
+        """Returns an idle worker for given config and flags, starting a new one
+        if needed.
+
+        Args:
+            config_name: name of the config
+            flags: flags of the worker's Python interpreter
+
+        Returns:
+            CompileWorker object or None if the executor was cancelled
+
+        Raises:
+            WorkerError if the worker dies during start up
+        """
+        to_close = None
+        with self._lock:
+            idle = self._idle.get((config_name, flags))
+            # idle workers may have been killed by cancellation of a previous executor
+            while idle:
+                worker = idle.pop()
+                if worker.alive:
+                    self._busy.add(worker)
+                    return worker
+            # make room for the new worker by closing some idle one
+            if len(self._busy) + sum(len(i) for i in self._idle.values()) >= self.max_workers:
+                for i in self._idle.values():
+                    if i:
+                        to_close = i.pop()
+                        break
+        if to_close is not None:
+            self._close(to_close)
+
+        worker = CompileWorker(self.configs[config_name], flags)
+        if not self.executor.register_process(worker.proc):
+            return None
+        try:
+            worker.start()
+        except WorkerError:
+            self.executor.unregister_process(worker.proc)
+            raise
+        with self._lock:
+            self._busy.add(worker)
+        return worker
+
+    def attach(self, executor):
+        """Makes the pool start workers for given executor and registers the idle
+        workers with it."""
+        with self._lock:
+            self.executor = executor
+            workers = [w for idle in self._idle.values() for w in idle]
+        for w in workers:
+            executor.register_process(w.proc)
+
+    def release(self, worker):
+        """Returns a worker obtained by acquire back to the pool."""
+        with self._lock:
+            self._busy.discard(worker)
+            if worker.alive:
+                self._idle.setdefault((worker.config_name, worker.flags), []).append(worker)
+                return
+        self.executor.unregister_process(worker.proc)
+
+    def close(self):
+        """Closes all idle workers."""
+        with self._lock:
+            workers = [w for idle in self._idle.values() for w in idle]
+            self._idle = {}
+        for w in workers:
+            self._close(w)
+
+    def _close(self, worker):
+        worker.close()
+        self.executor.unregister_process(worker.proc)
+
+
+class BytecodeCache(object):
+    """On-disk cache of bytecompiled files, shared across builds.
+
+    Entries are keyed on hash of the source, magic number of the interpreter,
+    optimization level, the path hardcoded to the bytecompiled file and invalidation
+    mode. Timestamps (and sizes) in headers of restored timestamp based files are
+    updated to match the restored source.
+    Least recently used entries are evicted by evict() when the cache is bigger
+    than max_size.
+
+    Attributes:
+        directory: the cache directory
+        max_size: maximum size of the cache in bytes
+        hits, misses, stores, evictions: statistics of this run
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self._lock = threading.Lock()
+
+    def hash_source(self, source):
+        """Returns hex digest of hash of contents of given source."""
+        h = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def get_key(self, source_hash, info, optimize, dfile, invalidation_mode=None):
+        """Returns the cache key for a source with given hash (see hash_source) compiled
+        by an interpreter described by worker's hello info with given optimization level,
+        dfile and invalidation mode."""
+        key = b'\0'.join(_fsencode(k) for k in [source_hash, info['magic'], str(optimize), dfile,
+            str(invalidation_mode)])
+        return hashlib.sha256(key).hexdigest()
+
+    def restore_jobs(self, jobs, info, invalidation_mode=None):
+        """Restores bytecompiled files of given jobs from the cache.
+
+        Args:
+            jobs: list of (source, dfile, optimize) tuples
+            info: the "hello" information about the worker's Python interpreter
+            invalidation_mode: name of py_compile.PycInvalidationMode the files are
+                written with, see ByteCompileConfig.get_invalidation_mode
+
+        Returns:
+            a tuple (per-file results of restored jobs, list of jobs that need to be compiled,
+            {(source, optimize): key} of jobs that need to be compiled and should be
+            stored afterwards)
+        """
+        restored, to_compile, keys = [], [], {}
+        misses = 0
+        for source, dfile, optimize in jobs:
+            levels = optimize if isinstance(optimize, list) else [optimize]
+            levels = [info['optimize'] if level < 0 else level for level in levels]
+            try:
+                source_hash = self.hash_source(source)
+            except (IOError, OSError):
+                # let the worker report the problem
+                to_compile.append((source, dfile, optimize))
+                misses += len(levels)
+                continue
+            missing = []
+            for level in levels:
+                cfile = _cache_from_source(source, info, level)
+                key = self.get_key(source_hash, info, level, dfile, invalidation_mode)
+                if cfile is not None and self._restore(key, source, cfile, info):
+                    restored.append({'source': source, 'optimize': level, 'ok': True,
+                        'cfile': cfile, 'cached': True})
+                else:
+                    missing.append(level)
+                    keys[(source, level)] = key
+            if missing:
+                to_compile.append((source, dfile,
+                    missing if isinstance(optimize, list) else missing[0]))
+                misses += len(missing)
+        with self._lock:
+            self.hits += len(restored)
+            self.misses += misses
+        return restored, to_compile, keys
+
+    def store_results(self, file_results, keys):
+        """Stores bytecompiled files of successful per-file results to the cache."""
+        for r in file_results:
+            key = keys.get((r['source'], r['optimize']))
+            if not r['ok'] or key is None:
+                continue
+            entry = self._entry_path(key)
+            try:
+                makedirs(os.path.dirname(entry))
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+                with os.fdopen(fd, 'wb') as f, open(r['cfile'], 'rb') as cf:
+                    shutil.copyfileobj(cf, f)
+                os.rename(tmp, entry)
+            except (IOError, OSError) as e:
+                logging.warning('Warning: failed to store "{0}" in bytecode cache: {1}'.
+                    format(r['cfile'], e))
+                continue
+            with self._lock:
+                self.stores += 1
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size."""
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            # other files, e.g. the plan cache, may share the directory
+            for f in fnmatch.filter(files, '*.pyc'):
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + '.pyc')
+
+    def _restore(self, key, source, cfile, info):
+        entry = self._entry_path(key)
+        try:
+            with open(entry, 'rb') as f:
+                data = f.read()
+            st = os.stat(source)
+        except (IOError, OSError):
+            return False
+        data = _update_pyc_header(data, tuple(info['version']), st)
+        tmp = None
+        try:
+            makedirs(os.path.dirname(cfile))
+            # cfile may be a hardlink of bytecode of another optimization level (see
+            #  dedup_bytecode) and must not be left truncated, so it's replaced, not
+            #  written in place
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cfile))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # the same mode as py_compile gives it
+            os.chmod(tmp, stat.S_IMODE(st.st_mode) & 0o666 | 0o200)
+            os.rename(tmp, cfile)
+            # mark the entry as recently used
+            os.utime(entry, None)
+        except (IOError, OSError):
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            return False
+        return True
+
+
+class WorkResult(object):
+    """Result of executing one planned item.
+
+    Attributes:
+        item: the executed item, e.g. an Invocation object
+        returncode: exit status of the process; None if it wasn't started at all
+        output: combined stdout and stderr of the process
+        killed: True if the process was killed (or never started) because
+            bytecompilation was cancelled
+        file_results: list of per-file results reported by a persistent worker,
+            None for invocations
+        compiled_files: list of (source, bytecompiled file) of files written by
+            an invocation, as it reported them, None if it didn't report them
+        wall_time: seconds it took to execute the item, set by the executor
+        cpu_time: CPU time of the processes that executed the item, None if unknown
+        startup_time: seconds spent starting the Python interpreter for the item,
+            None if unknown
+        max_rss: resident memory of the processes that executed the item in bytes
+            (peak for invocations, after the batch for persistent workers), None
+            if unknown
+    """
+    def __init__(self, item, returncode, output, killed=False, file_results=None,
+            cpu_time=None, startup_time=None, max_rss=None, compiled_files=None):
+        self.item = item
+        self.returncode = returncode
+        self.output = output
+        self.killed = killed
+        self.file_results = file_results
+        self.compiled_files = compiled_files
+        self.wall_time = None
+        self.cpu_time = cpu_time
+        self.startup_time = startup_time
+        self.max_rss = max_rss
+
+    @property
+    def failed(self):
+        return self.returncode != 0 and not self.killed
+
+
+class Executor(object):
+    """Executes planned items concurrently on a bounded pool of threads. Each thread
+    runs one item (usually a subprocess) at a time.
+
+    If errors_terminate is set, the first failure cancels all items that haven't
+    started yet and kills process groups of all running ones. An exception raised
+    by planning (i.e. by the items iterator) or executing an item always cancels
+    them, its traceback is kept in errors.
+
+    Persistent compile workers needed by CompileBatch items are taken from
+    worker_pool, which is left open for the caller to reuse or close; caches is
+    a mapping {config_name: BytecodeCache} for configs whose bytecompiled files
+    are cached. Invocations of configs given in configs are run in environments
+    captured from their run templates, if there are any, see capture_environment.
+    If admission (a MemoryAdmission) is given, items are started only as memory
+    allows. If report is set, invocations report their start up time and the files
+    they bytecompile, see Invocation.execute."""
+
+    def __init__(self, jobs, errors_terminate, worker_pool=None, caches={}, configs={},
+            admission=None, report=False):
+        self.jobs = max(1, jobs)
+        self.errors_terminate = errors_terminate
+        self.worker_pool = worker_pool
+        self.caches = caches
+        self.configs = configs
+        self.admission = admission
+        self.report = report
+        self.cancelled = False
+        self.results = []
+        self.errors = []
+        self._lock = threading.Lock()
+        self._items_lock = threading.Lock()
+        self._processes = set()
+        if worker_pool is not None:
+            worker_pool.attach(self)
+
+    def run(self, items):
+        """Executes given items and waits for all of them to finish.
+
+        Args:
+            items: iterable of items with execute(executor) method
+
+        Returns:
+            list of WorkResult objects of all executed items
+        """
+        items = iter(items)
+        threads = [threading.Thread(target=self._worker, args=(items,))
+            for i in range(self.jobs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.results
+
+    def cancel(self):
+        """Cancels all items that haven't started yet and kills running processes."""
+        with self._lock:
+            self.cancelled = True
+            processes = list(self._processes)
+        for proc in processes:
+            _kill_process_group(proc)
+
+    def register_process(self, proc):
+        """Registers a started process, so that it can be killed on cancellation.
+        If the executor was already cancelled, the process is killed right away.
+
+        Returns:
+            False if the process was killed, True otherwise
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._processes.add(proc)
+                return True
+        _kill_process_group(proc)
+        proc.wait()
+        return False
+
+    def unregister_process(self, proc):
+        with self._lock:
+            self._processes.discard(proc)
+
+    def _next_item(self, items):
+        if self.cancelled:
+            return None
+        # items may be a generator doing I/O, e.g. reading a manifest from a pipe,
+        #  so it has its own lock, not to block cancellation
+        with self._items_lock:
+            try:
+                return next(items, None)
+            except Exception:
+                self._error()
+                return None
+
+    def _worker(self, items):
+        while True:
+            item = self._next_item(items)
+            if item is None:
+                return
+            reserved = max_rss = None
+            if self.admission is not None:
+                reserved = self.admission.acquire(item.config_name)
+            try:
+                start = time.time()
+                result = item.execute(self)
+                result.wall_time = time.time() - start
+                max_rss = result.max_rss
+            except Exception:
+                self._error()
+                continue
+            finally:
+                if self.admission is not None:
+                    self.admission.release(item.config_name, reserved, max_rss)
+            with self._lock:
+                self.results.append(result)
+            if result.failed and self.errors_terminate:
+                self.cancel()
+
+    def _error(self):
+        """Keeps traceback of the exception being handled and cancels the execution."""
+        with self._lock:
+            self.errors.append(traceback.format_exc())
+        self.cancel()
+
+
+class RunReport(object):
+    """Timing and throughput report of a bytecompile run, see to_dict for its structure.
+
+    Attributes:
+        rpm_buildroot: rpm buildroot
+        phases: list of {"name", "wall_time", "cpu_time"} of timed phases, CPU time
+            is the time spent in this process (not in subprocesses)
+        items: list of per-item records, see add_results
+        status: exit status of the run
+        dedup: {"files_linked", "bytes_saved"} of bytecode deduplication, None
+            if it wasn't done
+        incremental: {"skipped", "compiled"} numbers of bytecompiled files in
+            incremental mode, None if it wasn't used
+    """
+    def __init__(self, rpm_buildroot):
+        self.rpm_buildroot = rpm_buildroot
+        self.phases = []
+        self.items = []
+        self.status = None
+        self.dedup = None
+        self.incremental = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager timing a phase of the run."""
+        start, start_cpu = time.time(), _process_cpu_time()
+        try:
+            yield
+        finally:
+            self.phases.append({'name': name, 'wall_time': time.time() - start,
+                'cpu_time': _process_cpu_time() - start_cpu})
+
+    def add_results(self, results):
+        """Adds records of executed items.
+
+        Files compiled and bytes read and written are taken from the files that
+        persistent workers and invocations reported as they ran, start up times
+        from their starts; they're unknown for invocations that didn't report them
+        (those with unknown inline_script).
+
+        Args:
+            results: list of WorkResult objects
+        """
+        for r in results:
+            item = r.item
+            record = {'type': 'invocation' if isinstance(item, Invocation) else 'batch',
+                'config': item.config_name, 'compile_dir': item.compile_dir,
+                'real_dir': item.real_dir, 'flags': item.flags, 'returncode': r.returncode,
+                'killed': r.killed, 'wall_time': r.wall_time, 'cpu_time': r.cpu_time,
+                'startup_time': r.startup_time, 'files_compiled': None, 'files_cached': None,
+                'bytes_read': None, 'bytes_written': None}
+            if r.file_results is not None:
+                ok = [f for f in r.file_results if f['ok']]
+                record['files_cached'] = len([f for f in ok if f.get('cached')])
+                record['files_compiled'] = len(ok) - record['files_cached']
+                record['bytes_read'] = sum(_file_size(source)
+                    for source in set(f['source'] for f in r.file_results))
+                record['bytes_written'] = sum(_file_size(f['cfile']) for f in ok)
+            elif r.compiled_files is not None:
+                record['files_compiled'] = len(r.compiled_files)
+                record['bytes_read'] = sum(_file_size(source)
+                    for source in set(source for source, cfile in r.compiled_files))
+                record['bytes_written'] = sum(_file_size(cfile)
+                    for source, cfile in r.compiled_files)
+            self.items.append(record)
+
+    def get_slowest(self, count=5):
+        """Returns records of count items that took the longest."""
+        return sorted(self.items, key=lambda i: i['wall_time'] or 0, reverse=True)[:count]
+
+    def to_dict(self):
+        """Returns the report as a JSON serializable dict with keys rpm_buildroot,
+        status, phases, items, totals (sums of per-item values, unknown values
+        are counted as zero), dedup and incremental."""
+        totals = {}
+        for key in ['files_compiled', 'files_cached', 'bytes_read', 'bytes_written',
+                'wall_time', 'cpu_time', 'startup_time']:
+            totals[key] = sum(i[key] or 0 for i in self.items)
+        return {'rpm_buildroot': self.rpm_buildroot, 'status': self.status,
+            'phases': self.phases, 'items': self.items, 'totals': totals, 'dedup': self.dedup,
+            'incremental': self.incremental}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def log_summary(self, count=5):
+        """Logs times of phases and the slowest items."""
+        logging.info('Phases: ' + ', '.join('{0} {1:.2f}s'.format(p['name'], p['wall_time'])
+            for p in self.phases))
+        slowest = self.get_slowest(count)
+        if slowest:
+            logging.info('Slowest bytecompilation items:')
+        for i in slowest:
+            logging.info('{0:.2f}s ({1} CPU): config "{2}", "{3}" with flags "{4}"'.format(
+                i['wall_time'] or 0,
+                '?' if i['cpu_time'] is None else '{0:.2f}s'.format(i['cpu_time']),
+                i['config'], i['compile_dir'], i['flags']))
+
+
+def probe_interpreter(config, flags):
+    """Runs the Python interpreter of given config through its run template with
+    given flags, only to describe itself.
+
+    Returns:
+        a tuple (hello information as in persistent workers or None if the output
+        couldn't be parsed or the run didn't finish in PROBE_TIMEOUT, seconds the
+        run took)
+    """
+    start = time.time()
+    args, kwargs = config.get_popen_args(flags, _PROBE_SCRIPT,
+        lambda: config.get_probe_command(flags))
+    info = _run_reporting_script(args, kwargs)
+    return info, time.time() - start
+
+
+def capture_environment(config):
+    """Runs the Python interpreter of given config through its run template (e.g.
+    "scl enable ...") once, to capture the environment that the template sets up
+    (PATH, LD_LIBRARY_PATH, ...) and the interpreter's executable. The config's
+    environment is set to them, so that the interpreter can be started directly
+    from then on, see ByteCompileConfig.get_popen_args.
+
+    Returns:
+        True if the environment was captured, False if the output couldn't be parsed
+        or the run didn't finish in PROBE_TIMEOUT; the run template is used then
+    """
+    environment = _run_reporting_script(config.get_environment_command(), {'shell': True})
+    if not environment or not environment.get('executable') or \
+            not isinstance(environment.get('environ'), dict):
+        logging.warning('Warning: can\'t capture environment of config "{0}", '.format(
+            config.fname) + 'using its run template')
+        return False
+    config.environment = environment
+    logging.info('Captured environment of config "{0}", starting "{1}" directly'.format(
+        config.fname, environment['executable']))
+    return True
+
+
+def capture_environments(configs, names=None):
+    """Captures environments of given configs concurrently, see capture_environment.
+    Only configs with capture_environment set and no environment captured yet
+    are run.
+
+    Args:
+        configs: mapping of config names to ByteCompileConfig objects
+        names: names of configs to consider, all by default
+    """
+    threads = [threading.Thread(target=capture_environment, args=(configs[name],))
+        for name in (configs if names is None else names)
+        if configs[name].formatted_dict['capture_environment'] and
+            configs[name].environment is None]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def _run_reporting_script(args, kwargs):
+    """Runs a script that prints a JSON dict as the last line of its output, killing
+    it after PROBE_TIMEOUT.
+
+    Returns:
+        the dict or None if the output couldn't be parsed or the script failed
+    """
+    kwargs = dict(kwargs, **_new_session_kwargs())
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    timer = threading.Timer(PROBE_TIMEOUT, _kill_process_group, [proc])
+    timer.start()
+    try:
+        out = proc.communicate()[0]
+    finally:
+        timer.cancel()
+    lines = out.decode('utf-8', 'replace').strip().splitlines()
+    try:
+        info = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        info = None
+    if proc.returncode != 0 or not isinstance(info, dict):
+        info = None
+    return info
+
+
+def probe_interpreters(configs, names):
+    """Probes interpreters of given configs concurrently, each with the flags
+    of its config, see probe_interpreter.
+
+    Args:
+        configs: mapping of config names to ByteCompileConfig objects
+        names: names of configs to probe
+
+    Returns:
+        a mapping {config_name: hello information or None}
+    """
+    infos = {}
+
+    def probe(name):
+        config = configs[name]
+        infos[name] = probe_interpreter(config, config.formatted_dict['flags'])[0]
+
+    threads = [threading.Thread(target=probe, args=(name,)) for name in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return infos
+
+
+def _process_cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def _new_session_kwargs():
+    """Returns subprocess.Popen kwargs that start the process in a new session."""
+    if sys.version_info >= (3, 2):
+        return {'start_new_session': True}
+    return {'preexec_fn': os.setsid}
+
+
+def _kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # the process has already exited
+        pass
+
+
+def _wait_with_rusage(proc):
+    """Waits for given subprocess.Popen process like proc.wait() does, but returns
+    resource usage of the process and its waited for descendants (None if it
+    can't be determined)."""
+    while True:
+        try:
+            status, rusage = os.wait4(proc.pid, 0)[1:]
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            # somebody else has already waited for the process
+            proc.wait()
+            return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def _fsencode(path):
+    """Encodes given path (or any string) to bytes the same way os functions do."""
+    if isinstance(path, bytes):
+        return path
+    if sys.version_info >= (3, 2):
+        return os.fsencode(path)
+    return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+
+def _fsdecode(path):
+    """Decodes given path from bytes the same way os functions do."""
+    if not isinstance(path, bytes) or sys.version_info < (3, 2):
+        return path
+    return os.fsdecode(path)
+
+
+def makedirs(directory):
+    """Creates given directory and its missing parents, unless it already exists."""
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _cache_from_source(source, info, optimize):
+    """Returns path of the bytecompiled file of given source, as an interpreter
+    described by worker's hello info would write it with given optimization level.
+    None is returned if the path can't be determined."""
+    version = tuple(info['version'])
+    if version < (3, 2):
+        return source + ('o' if optimize else 'c')
+    if info['cache_tag'] is None:
+        return None
+    directory, name = os.path.split(source)
+    stem = os.path.splitext(name)[0] + '.' + info['cache_tag']
+    if version < (3, 5):
+        name = stem + ('.pyo' if optimize else '.pyc')
+    else:
+        name = stem + ('.opt-{0}.pyc'.format(optimize) if optimize else '.pyc')
+    return os.path.join(directory, '__pycache__', name)
+
+
+def _update_pyc_header(data, version, st):
+    """Updates source mtime and size in header of a timestamp based bytecompiled file
+    written by Python of given version to values of given os.stat result."""
+    # the header is magic, flags (since 3.7), source mtime and source size (since 3.3),
+    #  each 4 bytes; hash based files (flags other than 0) don't contain mtime and size
+    offset = 4
+    if version >= (3, 7):
+        if struct.unpack('<I', data[4:8])[0] != 0:
+            return data
+        offset = 8
+    fields = struct.pack('<I', int(st.st_mtime) & 0xFFFFFFFF)
+    if version >= (3, 3):
+        fields += struct.pack('<I', st.st_size & 0xFFFFFFFF)
+    return data[:offset] + fields + data[offset + len(fields):]
+
+
+def _parse_size(value):
+    """Parses size given as a number of bytes, optionally with K, M or G suffix."""
+    if isinstance(value, int):
+        return value
+    value = value.strip().upper()
+    multiplier = 1
+    for i, suffix in enumerate('KMG'):
+        if value.endswith(suffix):
+            multiplier = 1024 ** (i + 1)
+            value = value[:-1]
+    return int(value) * multiplier
+
+
+def get_default_jobs(limits=None):
+    """Returns the default number of concurrently running bytecompilation processes,
+    which is $RPM_BUILD_NCPUS if set, otherwise number of CPUs that this process may
+    use (see ResourceLimits.cpu_jobs).
+
+    Args:
+        limits: ResourceLimits of this process, detected if not provided
+    """
+    try:
+        return max(1, int(os.environ['RPM_BUILD_NCPUS']))
+    except (KeyError, ValueError):
+        pass
+    if limits is None:
+        limits = get_resource_limits()
+    return limits.cpu_jobs
+
+
+class ResourceLimits(object):
+    """CPU and memory limits of this process, see get_resource_limits.
+
+    Attributes:
+        cpus: number of CPUs this process may run on
+        cpu_quota: CPUs worth of time per period allowed by the cgroup CPU quota,
+            None if unlimited
+        memory_limit: memory limit of the cgroup in bytes, None if unlimited
+        memory_usage: memory used by the cgroup in bytes, None if unknown
+    """
+    def __init__(self, cpus, cpu_quota=None, memory_limit=None, memory_usage=None):
+        self.cpus = cpus
+        self.cpu_quota = cpu_quota
+        self.memory_limit = memory_limit
+        self.memory_usage = memory_usage
+
+    @property
+    def cpu_jobs(self):
+        """Number of processes that can run at once without exceeding the CPU quota."""
+        if self.cpu_quota is None:
+            return self.cpus
+        return max(1, min(self.cpus, int(math.ceil(self.cpu_quota))))
+
+    @property
+    def memory_available(self):
+        """Memory in bytes that can still be taken before hitting the cgroup memory
+        limit, None if unlimited."""
+        if self.memory_limit is None:
+            return None
+        return max(0, self.memory_limit - (self.memory_usage or 0))
+
+    def describe(self):
+        parts = ['{0} CPUs'.format(self.cpus)]
+        if self.cpu_quota is not None:
+            parts.append('CPU quota {0:.2f}'.format(self.cpu_quota))
+        if self.memory_limit is not None:
+            parts.append('memory limit {0}, {1} available'.format(
+                _format_size(self.memory_limit), _format_size(self.memory_available)))
+        return ', '.join(parts)
+
+
+def get_resource_limits(cgroup_root=CGROUP_ROOT, proc_cgroup='/proc/self/cgroup'):
+    """Detects CPU affinity of this process and CPU quota and memory limit of its
+    cgroup (v1 or v2; limits of ancestors of the cgroup apply as well). If the cgroup
+    of this process isn't visible, e.g. in a container, limits of the root of the
+    mounted hierarchy are used.
+
+    Args:
+        cgroup_root: mount point of the cgroup filesystem
+        proc_cgroup: the file listing cgroups of this process
+
+    Returns:
+        ResourceLimits object
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        try:
+            cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpus = 1
+    # {controller: (hierarchy, path of the cgroup)}, the v2 hierarchy is keyed on ''
+    cgroups = {}
+    for line in _read_lines(proc_cgroup) or ['0::/']:
+        parts = line.split(':', 2)
+        if len(parts) == 3:
+            for controller in parts[1].split(','):
+                cgroups[controller] = (parts[1], parts[2])
+
+    quotas, memory_limits, memory_usage = [], [], None
+    if 'cpu' in cgroups:
+        for directory in _cgroup_dirs(cgroup_root, *cgroups['cpu']):
+            quota = _read_int(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = _read_int(os.path.join(directory, 'cpu.cfs_period_us'))
+            if quota is not None and quota > 0 and period:
+                quotas.append(float(quota) / period)
+    if 'memory' in cgroups:
+        for directory in _cgroup_dirs(cgroup_root, *cgroups['memory']):
+            limit = _read_int(os.path.join(directory, 'memory.limit_in_bytes'))
+            # "unlimited" is the maximum value rounded down to pages
+            if limit is not None and limit < 2 ** 62:
+                memory_limits.append(limit)
+            if memory_usage is None:
+                memory_usage = _read_int(os.path.join(directory, 'memory.usage_in_bytes'))
+    if '' in cgroups:
+        v2_root = cgroup_root
+        if not os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers')):
+            # hybrid layout
+            v2_root = os.path.join(cgroup_root, 'unified')
+        for directory in _cgroup_dirs(v2_root, '', cgroups[''][1]):
+            if memory_usage is None:
+                memory_usage = _read_int(os.path.join(directory, 'memory.current'))
+            cpu_max = (_read_lines(os.path.join(directory, 'cpu.max')) or [''])[0].split()
+            if len(cpu_max) == 2 and cpu_max[0] != 'max':
+                quotas.append(float(cpu_max[0]) / int(cpu_max[1]))
+            limit = _read_int(os.path.join(directory, 'memory.max'))
+            if limit is not None:
+                memory_limits.append(limit)
+    return ResourceLimits(cpus, min(quotas) if quotas else None,
+        min(memory_limits) if memory_limits else None, memory_usage)
+
+
+def _cgroup_dir(root, hierarchy, path):
+    """Returns directory of a cgroup, or of the root of its hierarchy, if the cgroup
+    isn't visible."""
+    mount = os.path.join(root, hierarchy) if hierarchy else root
+    directory = path_norm_join(mount, path)
+    return directory if os.path.isdir(directory) else path_norm_join(mount)
+
+
+def _cgroup_dirs(root, hierarchy, path):
+    """Yields directories of a cgroup (see _cgroup_dir) and of its ancestors up to
+    the root of its hierarchy."""
+    mount = path_norm_join(os.path.join(root, hierarchy) if hierarchy else root)
+    directory = _cgroup_dir(root, hierarchy, path)
+    while True:
+        yield directory
+        if directory == mount or not directory.startswith(mount):
+            return
+        directory = os.path.dirname(directory)
+
+
+def _read_lines(path):
+    """Returns stripped lines of given file, None if it can't be read."""
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f]
+    except (IOError, OSError):
+        return None
+
+
+def _read_int(path):
+    """Returns integer in the first line of given file, None if it can't be read
+    or isn't a number (e.g. "max")."""
+    try:
+        return int((_read_lines(path) or [''])[0])
+    except ValueError:
+        return None
+
+
+def _format_size(size):
+    for suffix in ['', 'K', 'M']:
+        if size < 1024 * 10:
+            return '{0}{1}'.format(size, suffix)
+        size //= 1024
+    return '{0}G'.format(size)
+
+
+def _process_tree_rss(pid):
+    """Returns resident memory of given process and all its descendants in bytes,
+    None if it can't be determined (e.g. on systems without /proc)."""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        for line in _read_lines('/proc/{0}/status'.format(pid)) or []:
+            # kernel threads and zombies have no VmRSS
+            if line.startswith('VmRSS:'):
+                total += int(line.split()[1]) * 1024
+                break
+        for children in glob.glob('/proc/{0}/task/*/children'.format(pid)):
+            pids.extend(int(c) for c in ' '.join(_read_lines(children) or []).split())
+    return total or None
+
+
+class MemoryAdmission(object):
+    """Admits items for execution only while the memory expected to be taken by all
+    running items fits in a budget, so that the processes don't get killed or thrash
+    when memory is limited. Memory of an item is estimated by the largest resident
+    memory measured for items of the same config so far, DEFAULT_ITEM_RSS until any
+    is measured. At least one item is always admitted, so that the execution
+    progresses even if the budget is too small.
+
+    Attributes:
+        budget: memory in bytes that running items may take
+        max_running: maximum number of items that ran at once
+        delayed: number of items that had to wait for memory
+    """
+    def __init__(self, budget, default_rss=DEFAULT_ITEM_RSS):
+        self.budget = budget
+        self.default_rss = default_rss
+        self.max_running = 0
+        self.delayed = 0
+        # {config_name: largest measured resident memory in bytes}
+        self.estimates = {}
+        self._reserved = 0
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def estimate(self, config_name):
+        return self.estimates.get(config_name, self.default_rss)
+
+    def acquire(self, config_name):
+        """Waits until an item of given config can be executed.
+
+        Returns:
+            memory reserved for the item, to be passed to release
+        """
+        with self._cond:
+            delayed = False
+            while self._running and self._reserved + self.estimate(config_name) > self.budget:
+                delayed = True
+                self._cond.wait()
+            reserved = self.estimate(config_name)
+            self._reserved += reserved
+            self._running += 1
+            self.max_running = max(self.max_running, self._running)
+            self.delayed += delayed
+            return reserved
+
+    def release(self, config_name, reserved, rss=None):
+        """Releases memory reserved for a finished item, updating the estimate of its
+        config by resident memory measured for it (None if unknown)."""
+        with self._cond:
+            if rss:
+                self.estimates[config_name] = max(rss, self.estimates.get(config_name, 0))
+            self._reserved -= reserved
+            self._running -= 1
+            self._cond.notify_all()
+
+    def log_summary(self):
+        largest = max(self.estimates.values()) if self.estimates else None
+        logging.info('Memory admission: budget {0}, at most {1} items ran at once, '.format(
+            _format_size(self.budget), self.max_running) +
+            '{0} waited for memory, largest measured item {1}'.format(self.delayed,
+            _format_size(largest) if largest is not None else 'unknown'))
+
+
+class RunResult(object):
+    """Result of execution of a plan of bytecompilation of a buildroot.
+
+    Attributes:
+        rpm_buildroot: rpm buildroot
+        status: 0 if everything went well, 12 if some items failed and errors
+            terminate the bytecompilation (see bytecompile) or if there are errors
+        results: list of WorkResult objects of executed items
+        cancelled: True if the execution was cancelled because of a failure
+        errors: tracebacks of exceptions raised by planning or executing items of
+            the executor, see Executor
+        incremental: {"skipped", "compiled"} numbers of bytecompiled files in
+            incremental mode, None if it wasn't used
+        index: BuildrootIndex of rpm_buildroot used by the execution, for reuse
+            after it (e.g. by dedup_bytecode); None if nothing was executed
+    """
+    def __init__(self, rpm_buildroot, status=0, results=None, cancelled=False,
+            incremental=None, errors=None, index=None):
+        self.rpm_buildroot = rpm_buildroot
+        self.index = index
+        self.status = status
+        self.results = results or []
+        self.cancelled = cancelled
+        self.incremental = incremental
+        self.errors = errors or []
+
+    @property
+    def failed(self):
+        """WorkResult objects of failed items."""
+        return [r for r in self.results if r.failed]
+
+    def iter_file_results(self):
+        """Yields per-file results ({"source", "optimize", "ok", "cfile" or "error"}
+        dicts) of all items compiled by persistent workers."""
+        for r in self.results:
+            for f in r.file_results or []:
+                yield f
+
+
+class Bytecompiler(object):
+    """Bytecompiles rpm buildroots as specified in configs, for use in process by build
+    tools: configs are loaded once, interpreters are probed once, caches and persistent
+    compile workers are shared by all buildroots bytecompiled by the same object.
+
+        with Bytecompiler.from_config_dir('/etc/pypackages-tools', workers=True) as bc:
+            for rpm_buildroot in buildroots:
+                result = bc.run(rpm_buildroot)
+
+    Many buildroots can also be bytecompiled at once by run_many, which executes all
+    of them by a single executor, so that the jobs don't wait for the slowest item
+    of every buildroot.
+
+    Attributes:
+        configs: mapping of config names to ByteCompileConfig objects
+        jobs: number of parallel jobs
+        workers: if True, files are compiled by persistent compile workers, see make_plan
+        batch_size: target total size of sources in a batch compiled by a persistent
+            worker in bytes, see partition_batches
+        errors_terminate: if True, the first failure cancels the rest of the execution
+        caches: mapping {config_name: BytecodeCache}, see get_caches
+        worker_pool: WorkerPool shared by all executions
+        limits: ResourceLimits of this process
+        admission: MemoryAdmission shared by all executions, None if memory isn't
+            limited
+        report: if True, invocations report their start up time and the files they
+            bytecompile, see Invocation.execute
+    """
+    def __init__(self, configs, jobs=None, workers=False, cache_dir=None, cache_size='1G',
+            batch_size=None, errors_terminate=True, limits=None, report=False):
+        self.configs = configs
+        self.report = report
+        self.limits = limits or get_resource_limits()
+        self.jobs = jobs or get_default_jobs(self.limits)
+        self.admission = None
+        if self.limits.memory_available is not None:
+            self.admission = MemoryAdmission(int(self.limits.memory_available *
+                MEMORY_BUDGET_RATIO))
+        self.workers = workers
+        self.batch_size = _parse_size(batch_size) if batch_size is not None else None
+        self.errors_terminate = errors_terminate
+        self.caches, self._caches_by_directory = get_caches(configs, cache_dir, cache_size)
+        # idle workers take memory too, so there are only as many as the budget allows
+        #  before anything is measured
+        max_workers = self.jobs
+        if self.admission is not None:
+            max_workers = max(1, min(max_workers, self.admission.budget // DEFAULT_ITEM_RSS))
+        self.worker_pool = WorkerPool(configs, max_workers)
+        # {config_name: information about its interpreter}, see probe_interpreter
+        self._infos = {}
+
+    @classmethod
+    def from_config_dir(cls, config_dir, **kwargs):
+        """Creates a Bytecompiler of all configs in given directory, see load_configs;
+        kwargs are passed to the constructor."""
+        return cls(load_configs(config_dir), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes idle persistent compile workers."""
+        self.worker_pool.close()
+
+    def validate(self, rpm_buildroot, index=None):
+        """Checks that the configs can bytecompile given buildroot, logging the problems.
+
+        Returns:
+            0 if everything is all right, 10 if some configs want to compile the same
+            root, 11 if there are Python libdirs unassociated with any config
+        """
+        if compile_roots_errors(self.configs):
+            return 10
+        if unassoc_libdirs_errors(self.configs, path_norm_join(rpm_buildroot), index):
+            return 11
+        return 0
+
+    def plan(self, rpm_buildroot, index=None, manifest=None, incremental=False, probe=True):
+        """Plans bytecompilation of given buildroot, see make_plan.
+
+        Args:
+            rpm_buildroot: rpm buildroot
+            index: BuildrootIndex of rpm_buildroot, a new one is created if not provided
+            manifest: path of a manifest of files to compile, see read_manifest
+            incremental: if True, invocations skip sources with up to date bytecompiled
+                files by themselves
+            probe: if True, interpreters are probed to find out if they can compile all
+                optimization levels in a single pass
+
+        Returns:
+            Plan object, its items are planned lazily as they're consumed
+
+        Raises:
+            IOError or OSError if the manifest can't be opened
+        """
+        rpm_buildroot = path_norm_join(rpm_buildroot)
+        if index is None:
+            index = BuildrootIndex(rpm_buildroot)
+        if probe:
+            self._capture_environments(rpm_buildroot, index)
+        return make_plan(rpm_buildroot, self.configs, index, self.jobs, workers=self.workers,
+            cached=self.caches, batch_size=self.batch_size, probe=probe, manifest=manifest,
+            force=not incremental, infos=self._infos)
+
+    def execute(self, plan, index=None, incremental=False):
+        """Executes a plan made by plan (or loaded by Plan.load, as long as it has
+        the same configs), logging statistics of bytecode caches.
+
+        Args:
+            plan: Plan object
+            index: BuildrootIndex of the plan's buildroot, a new one is created if not
+                provided
+            incremental: if True, bytecompiled files that are up to date aren't compiled
+                again, see filter_up_to_date
+
+        Returns:
+            RunResult object
+        """
+        return self._execute([(plan, index)], incremental, self.errors_terminate)[0]
+
+    def execute_many(self, plans, incremental=False, indexes=None):
+        """Executes plans of more buildroots by a single executor, feeding it with items
+        of the next plan as soon as the items of the previous ones are taken. A failure
+        never cancels bytecompilation of the other buildroots, status of a buildroot
+        with failures is 12 if errors_terminate is set.
+
+        Args:
+            plans: list of Plan objects
+            incremental: see execute
+            indexes: list of BuildrootIndex objects of the plans' buildroots, new ones
+                are created if not provided
+
+        Returns:
+            list of RunResult objects, one for every plan
+        """
+        return self._execute(list(zip(plans, indexes or [None] * len(plans))), incremental,
+            False)
+
+    def run(self, rpm_buildroot, manifest=None, incremental=False):
+        """Validates the configs for given buildroot, plans its bytecompilation and
+        executes it, see validate, plan and execute.
+
+        Returns:
+            RunResult object, its status is the status of validation if that fails
+            and 15 if the manifest can't be read
+        """
+        rpm_buildroot = path_norm_join(rpm_buildroot)
+        index = BuildrootIndex(rpm_buildroot)
+        status = self.validate(rpm_buildroot, index)
+        if status:
+            return RunResult(rpm_buildroot, status)
+        try:
+            plan = self.plan(rpm_buildroot, index, manifest=manifest, incremental=incremental)
+        except (IOError, OSError) as e:
+            _log_manifest_error(manifest, e)
+            return RunResult(rpm_buildroot, 15)
+        return self.execute(plan, index, incremental=incremental)
+
+    def run_many(self, rpm_buildroots, incremental=False):
+        """Validates the configs for given buildroots, plans their bytecompilation and
+        executes all the plans at once, see execute_many.
+
+        Returns:
+            list of RunResult objects in the order of rpm_buildroots, their status is
+            the status of validation if that fails
+        """
+        results = []
+        plans = []
+        indexes = []
+        for rpm_buildroot in rpm_buildroots:
+            rpm_buildroot = path_norm_join(rpm_buildroot)
+            index = BuildrootIndex(rpm_buildroot)
+            status = self.validate(rpm_buildroot, index)
+            if status:
+                results.append(RunResult(rpm_buildroot, status))
+                continue
+            plans.append(self.plan(rpm_buildroot, index, incremental=incremental))
+            indexes.append(index)
+            results.append(None)
+        executed = iter(self.execute_many(plans, incremental=incremental, indexes=indexes))
+        return [r if r is not None else next(executed) for r in results]
+
+    def _execute(self, plans, incremental, cancel_on_failure):
+        """Executes items of all given (plan, index or None) tuples by a single executor.
+
+        Returns:
+            list of RunResult objects, one for every plan
+        """
+        results = []
+        streams = []
+        # {id(item): RunResult of its plan}, so that results of items can be sorted out
+        owners = {}
+
+        def owned(items, result):
+            for item in items:
+                owners[id(item)] = result
+                yield item
+
+        for plan, index in plans:
+            if index is None:
+                index = BuildrootIndex(plan.rpm_buildroot)
+            self._capture_environments(plan.rpm_buildroot, index)
+            result = RunResult(plan.rpm_buildroot, index=index)
+            items = plan.items
+            if incremental:
+                infos = self._probe(plan.configs, [fname for fname, config in
+                    plan.configs.items() if any(index.has_py_files(path_norm_join(
+                        plan.rpm_buildroot, unit[1])) for unit in config.get_units())])
+                result.incremental = {'skipped': 0, 'compiled': 0}
+                items = filter_up_to_date(items, plan.configs, infos, index,
+                    result.incremental)
+            streams.append(owned(items, result))
+            results.append(result)
+        for cache in self._caches_by_directory.values():
+            cache.hits = cache.misses = cache.stores = cache.evictions = 0
+
+        logging.info('Resource limits: {0}; running at most {1} jobs{2}'.format(
+            self.limits.describe(), self.jobs, ', as memory allows'
+            if self.admission is not None else ''))
+        executor = Executor(self.jobs, cancel_on_failure, worker_pool=self.worker_pool,
+            caches=self.caches, configs=self.configs, admission=self.admission,
+            report=self.report)
+        for r in executor.run(itertools.chain.from_iterable(streams)):
+            owners.pop(id(r.item)).results.append(r)
+        # an exception leaves every plan executed by the cancelled executor incomplete
+        for error in executor.errors:
+            logging.error('Error: bytecompilation failed unexpectedly:')
+            [logging.error(line) for line in error.splitlines()]
+        for result in results:
+            result.cancelled = executor.cancelled
+            result.errors = executor.errors
+            if result.failed and self.errors_terminate or result.errors:
+                result.status = 12
+
+        for directory, cache in sorted(self._caches_by_directory.items()):
+            cache.evict()
+            logging.info('Bytecode cache "{0}": {1} hits, {2} misses, {3} stored, {4} evicted'.
+                format(directory, cache.hits, cache.misses, cache.stores, cache.evictions))
+        if self.admission is not None:
+            self.admission.log_summary()
+        if incremental:
+            for result in results:
+                logging.info('Incremental bytecompilation{0}: {skipped} up to date files '
+                    'skipped, {compiled} files compiled'.format(' of "{0}"'.format(
+                    result.rpm_buildroot) if len(results) > 1 else '', **result.incremental))
+        return results
+
+    def _capture_environments(self, rpm_buildroot, index):
+        """Captures environments of configs that have anything to compile in given
+        buildroot, see capture_environments."""
+        capture_environments(self.configs, [fname for fname, config in self.configs.items()
+            if config.formatted_dict['capture_environment'] and config.environment is None and
+            any(index.has_py_files(path_norm_join(rpm_buildroot, unit[1]))
+                for unit in config.get_units())])
+
+    def _probe(self, configs, names):
+        """Returns {config_name: information about its interpreter or None} of given
+        configs, probing every interpreter at most once, see probe_interpreters."""
+        if configs is not self.configs:
+            return probe_interpreters(configs, names)
+        self._infos.update(probe_interpreters(configs,
+            [n for n in names if n not in self._infos]))
+        return dict((n, self._infos[n]) for n in names)
+
+
+def bytecompile(rpm_buildroot, default_python, errors_terminate, config_dir, dry_run,
+        jobs=None, workers=False, cache_dir=None, cache_size='1G', batch_size=None,
+        report=None, plan_in=None, plan_out=None, plan_cache_dir=None, manifest=None,
+        dedup=False, verify=None, incremental=False):
+    """Does the bytecompilation as specified in all configs.
+
+    Args:
+        rpm_buildroot: rpm buildroot
+        default_python: ignored for now (and probably forever)
+        errors_terminate: should errors terminate bytecompilation imediatelly?
+            Any non-zero number means yes.
+        config_dir: a directory where to look for config files
+        dry_run: if True, subprocesses won't actually be invoked, but rather
+            only logged
+        jobs: maximum number of concurrently running bytecompilation processes,
+            defaults to get_default_jobs()
+        workers: if True, files are compiled by persistent compile workers, started
+            once per config and flags instead of once per directory; configs with
+            a custom inline_script are still compiled by invocations
+        cache_dir: directory of bytecode cache shared across builds, overriden by
+            cache_dir of configs; using the cache implies workers
+        cache_size: maximum size of every bytecode cache, see _parse_size
+        batch_size: target total size of sources in a batch compiled by a persistent
+            worker, see _parse_size and partition_batches
+        report: path of a file to write JSON report of timings and throughput of
+            phases and executed items to, see RunReport; the slowest items are
+            also logged
+        plan_in: path of a plan written by plan_out to execute instead of loading
+            configs and planning
+        plan_out: path of a file to write the plan to
+        plan_cache_dir: directory of cache of plans, see PlanCache; defaults to
+            "plans" subdirectory of cache_dir, if that is set; not used by dry runs
+            and with manifest
+        manifest: path of a manifest of files to compile instead of walking the whole
+            buildroot, "-" for stdin; files are compiled by persistent workers as they
+            are read, see make_plan and read_manifest
+        dedup: if True, identical bytecompiled files of the same source (with different
+            optimization levels) are replaced by hardlinks after the compilation,
+            see dedup_bytecode
+        verify: if set, nothing is compiled, bytecompiled files are only checked
+            to be up to date and the findings are written as JSON to this file
+            ("-" for stdout), see verify_bytecode
+        incremental: if True, only sources without up to date bytecompiled files
+            are compiled, see filter_up_to_date
+
+    Returns:
+        0 if everything goes well
+        10 if some configs want to compile the same root
+        11 if there are Python libdirs unassociated with any config
+        12 if some bytecompilation invocations failed and errors_terminate is set,
+            or if planning or executing them raised an exception
+        13 if plan_in can't be loaded or is for a different buildroot
+        14 if verify finds missing, stale or otherwise invalid bytecompiled files
+        15 if manifest can't be read
+    """
+    # normalize rpm_buildroot, removing duplicate slashes
+    rpm_buildroot = path_norm_join(rpm_buildroot)
+    run_report = RunReport(rpm_buildroot)
+
+    def finish(status):
+        if report is not None:
+            run_report.status = status
+            run_report.log_summary()
+            run_report.write(report)
+        return status
+
+    if rpm_buildroot == '/':
+        return finish(0)
+    jobs = jobs or get_default_jobs()
+    if batch_size is not None:
+        batch_size = _parse_size(batch_size)
+    options = dict(jobs=jobs, workers=workers, cache_dir=cache_dir, cache_size=cache_size,
+        batch_size=batch_size, errors_terminate=_is_nonzero(errors_terminate),
+        report=report is not None)
+    if plan_cache_dir is None and cache_dir:
+        plan_cache_dir = os.path.join(cache_dir, 'plans')
+    index = BuildrootIndex(rpm_buildroot)
+
+    plan = plan_cache = planned = compiler = None
+    if plan_in is not None:
+        with run_report.phase('load_plan'):
+            try:
+                plan = Plan.load(plan_in)
+            except (IOError, OSError, ValueError) as e:
+                logging.error('Error: can\'t load plan "{0}": {1}'.format(plan_in, e))
+                return finish(13)
+        if plan.rpm_buildroot != rpm_buildroot:
+            logging.error('Error: plan "{0}" is for buildroot "{1}"'.format(plan_in,
+                plan.rpm_buildroot))
+            return finish(13)
+    elif plan_cache_dir is not None and not dry_run and manifest is None and verify is None:
+        with run_report.phase('load_configs'):
+            compiler = Bytecompiler.from_config_dir(config_dir, **options)
+        with run_report.phase('plan_cache'):
+            plan_cache = PlanCache(path_norm_join(plan_cache_dir))
+            plan_key = plan_cache.get_key(config_dir, compiler.configs, rpm_buildroot,
+                jobs=jobs, workers=workers, cache_dir=cache_dir, batch_size=batch_size,
+                incremental=incremental)
+            plan = plan_cache.get(plan_key)
+        if plan is not None:
+            logging.info('Using cached plan "{0}"'.format(plan_key))
+
+    if plan is None:
+        if compiler is None:
+            with run_report.phase('load_configs'):
+                compiler = Bytecompiler.from_config_dir(config_dir, **options)
+
+        with run_report.phase('validation'):
+            status = compiler.validate(rpm_buildroot, index)
+            if status:
+                return finish(status)
+
+        if verify is not None:
+            with run_report.phase('verify'):
+                findings = verify_bytecode(rpm_buildroot, compiler.configs, index, jobs)
+            text = json.dumps(findings, indent=2, sort_keys=True) + '\n'
+            if verify == '-':
+                sys.stdout.write(text)
+            else:
+                with open(verify, 'w') as f:
+                    f.write(text)
+            return finish(14 if findings['problems'] or findings['unverified_configs'] else 0)
+
+        with run_report.phase('planning'):
+            try:
+                plan = compiler.plan(rpm_buildroot, index, manifest=manifest,
+                    incremental=incremental, probe=not dry_run)
+            except (IOError, OSError) as e:
+                _log_manifest_error(manifest, e)
+                return finish(15)
+        if plan_cache is not None:
+            # the items are planned as they're executed, the plan is cached afterwards
+            planned = []
+            plan.items = _recorded(plan.items, planned)
+    elif compiler is None:
+        compiler = Bytecompiler(plan.configs, **options)
+    if plan_out is not None or dry_run:
+        # the items may be a generator
+        plan.items = list(plan.items)
+    if plan_out is not None:
+        plan.write(plan_out)
+
+    if dry_run:
+        for fname in plan.configs:
+            logging.info('Running from config "{0}":'.format(fname))
+            [logging.info(d) for d in
+                sorted(_describe(i) for i in plan.items if i.config_name == fname)]
+        return finish(0)
+
+    with run_report.phase('execution'):
+        with compiler:
+            result = compiler.execute(plan, index, incremental=incremental)
+        if plan_cache is not None and planned is not None and not result.cancelled:
+            plan_cache.put(plan_key, Plan(rpm_buildroot, plan.configs, planned), index)
+    results = result.results
+    run_report.incremental = result.incremental
+    if dedup:
+        with run_report.phase('dedup'):
+            linked, saved = dedup_bytecode(collect_bytecode(results, index), jobs)
+        logging.info('Deduplicated bytecode: {0} files replaced by hardlinks, {1} bytes saved'.
+            format(linked, saved))
+        run_report.dedup = {'files_linked': linked, 'bytes_saved': saved}
+    if report is not None:
+        run_report.add_results(results)
+
+    for r in result.failed:
+        logging.error('Error: bytecompilation from config "{0}" failed with exit status {1}:'.
+            format(r.item.config_name, r.returncode))
+        logging.error(_describe(r.item))
+        [logging.error(line) for line in r.output.splitlines()]
+    return finish(result.status)
+
+
+def bytecompile_many(rpm_buildroots, errors_terminate, config_dir, dry_run, jobs=None,
+        workers=False, cache_dir=None, cache_size='1G', batch_size=None, dedup=False,
+        incremental=False):
+    """Does the bytecompilation of more buildroots at once, loading the configs and
+    probing the interpreters only once. Items of all buildroots are executed by
+    a single executor with shared persistent workers, see Bytecompiler.run_many;
+    a failure in one buildroot doesn't cancel bytecompilation of the others.
+
+    Args are the same as of bytecompile.
+
+    Returns:
+        the highest status of all buildroots, see bytecompile; status of every
+        buildroot is logged
+    """
+    # like bytecompile, nothing is done for "/"
+    rpm_buildroots = [b for b in map(path_norm_join, rpm_buildroots) if b != '/']
+    jobs = jobs or get_default_jobs()
+    compiler = Bytecompiler.from_config_dir(config_dir, jobs=jobs, workers=workers,
+        cache_dir=cache_dir, cache_size=cache_size, batch_size=batch_size,
+        errors_terminate=_is_nonzero(errors_terminate))
+
+    if dry_run:
+        status = 0
+        for rpm_buildroot in rpm_buildroots:
+            index = BuildrootIndex(rpm_buildroot)
+            buildroot_status = compiler.validate(rpm_buildroot, index)
+            status = max(status, buildroot_status)
+            if buildroot_status:
+                continue
+            plan = compiler.plan(rpm_buildroot, index, incremental=incremental, probe=False)
+            items = list(plan.items)
+            for fname in plan.configs:
+                logging.info('Running from config "{0}" in "{1}":'.format(fname,
+                    rpm_buildroot))
+                [logging.info(d) for d in
+                    sorted(_describe(i) for i in items if i.config_name == fname)]
+        return status
+
+    with compiler:
+        results = compiler.run_many(rpm_buildroots, incremental=incremental)
+    for result in results:
+        if dedup and result.index is not None:
+            linked, saved = dedup_bytecode(collect_bytecode(result.results, result.index),
+                jobs)
+            logging.info('Deduplicated bytecode of "{0}": {1} files replaced by hardlinks, '
+                '{2} bytes saved'.format(result.rpm_buildroot, linked, saved))
+        for r in result.failed:
+            logging.error('Error: bytecompilation of "{0}" from config "{1}" '.format(
+                result.rpm_buildroot, r.item.config_name) +
+                'failed with exit status {0}:'.format(r.returncode))
+            logging.error(_describe(r.item))
+            [logging.error(line) for line in r.output.splitlines()]
+    for result in results:
+        logging.info('Buildroot "{0}": status {1}, {2} items executed, {3} failed'.format(
+            result.rpm_buildroot, result.status, len(result.results), len(result.failed)))
+    return max([0] + [result.status for result in results])
+
+
+def make_plan(rpm_buildroot, configs, index, jobs, workers=False, cached=(), batch_size=None,
+        probe=True, manifest=None, force=True, infos=None):
+    """Plans bytecompilation of a buildroot as specified in given configs.
+
+    Items of the returned plan are a generator, that plans the items only as they're
+    consumed, walking the buildroot (and ordering batches, see partition_batches)
+    gradually, so that execution of the first items overlaps planning of the later
+    ones and memory doesn't grow with size of the buildroot.
+
+    If a manifest is given, only files listed in it are compiled by persistent workers
+    (except for configs with a custom inline_script, which compile all their directories
+    by invocations as usual). The buildroot isn't walked then and the manifest is read
+    as the items are consumed, see iter_manifest_batches.
+
+    Args:
+        rpm_buildroot: rpm buildroot
+        configs: mapping of config names to ByteCompileConfig objects
+        index: BuildrootIndex of rpm_buildroot
+        jobs: number of parallel jobs
+        workers: if True, files are planned to be compiled by persistent compile workers,
+            except for configs with a custom inline_script
+        cached: names of configs whose bytecompiled files are cached; these are always
+            compiled by persistent workers
+        batch_size: target total size of sources in a batch compiled by a persistent
+            worker in bytes, see partition_batches
+        probe: if True, interpreters are probed to find out if they can compile all
+            optimization levels in a single pass, see ByteCompileConfig.get_variations
+        manifest: path of a manifest of files to compile, "-" for stdin, see
+            read_manifest
+        force: if False, invocations skip sources with up to date bytecompiled files
+            by themselves, see ByteCompileConfig.iter_compile_invocations
+        infos: mapping of config names to already known information about their
+            interpreters (see probe_interpreter), only the others are probed; newly
+            probed interpreters are added to it
+
+    Returns:
+        Plan object
+    """
+    # find out which interpreters can compile all optimization levels in a single pass;
+    #  without a manifest, only those that have anything to compile
+    if infos is None:
+        infos = {}
+    if probe:
+        infos.update(probe_interpreters(configs, [fname for fname, config in configs.items()
+            if fname not in infos and
+            len(config.formatted_dict['optimization_levels']) > 1 and
+            config.supports_workers and (manifest is not None or any(index.has_py_files(
+                path_norm_join(rpm_buildroot, unit[1])) for unit in config.get_units()))]))
+    else:
+        infos = {}
+
+    resolver = OwnershipResolver(configs, rpm_buildroot)
+    if manifest is not None:
+        workers = True
+    items = []
+    for fname, config in configs.items():
+        # get list of dirs to exclude when compiling by this config
+        exclude_dirs = get_exclude_dirs(configs, rpm_buildroot, fname)
+        if manifest is not None and config.supports_workers:
+            continue
+        elif (workers or fname in cached) and config.supports_workers:
+            # one batch per directory asked for explicitly, it can't be planned in chunks
+            items.append(config.iter_compile_batches(rpm_buildroot=rpm_buildroot,
+                resolver=resolver, index=index, info=infos.get(fname),
+                max_files=None if batch_size == 0 else PLAN_CHUNK_FILES))
+        else:
+            if workers:
+                logging.info('Config "{0}" has custom inline_script, '.format(fname) +
+                    'not using persistent workers for it')
+            items.append(config.iter_compile_invocations(rpm_buildroot=rpm_buildroot,
+                exclude_dirs=exclude_dirs, index=index, info=infos.get(fname), force=force))
+
+    if manifest is not None:
+        items.append(iter_manifest_batches(read_manifest(manifest, rpm_buildroot, index),
+            configs, resolver, infos, batch_size))
+        return Plan(rpm_buildroot, configs, itertools.chain.from_iterable(items))
+    return Plan(rpm_buildroot, configs,
+        partition_batches(itertools.chain.from_iterable(items), jobs, batch_size))
+
+
+def read_manifest(manifest, rpm_buildroot, index):
+    """Returns an iterator of full paths of .py files listed in a manifest, read
+    as the iterator is consumed.
+
+    The manifest lists a path relative to rpm buildroot (or including it) per line,
+    e.g. output of "rpm -ql" or a %files list with macros expanded. Directives like
+    %doc or %attr(...) are ignored, except that %ghost and %exclude entries are
+    skipped. All .py files in listed directories are included, unless they're
+    listed by %dir.
+
+    Args:
+        manifest: path of the manifest, "-" for stdin
+        rpm_buildroot: rpm buildroot
+        index: BuildrootIndex of rpm_buildroot, used for listed directories
+
+    Raises:
+        IOError or OSError if the manifest can't be opened; it's opened right away,
+        not once the iterator is consumed by an executor
+    """
+    f = sys.stdin if manifest == '-' else open(manifest, 'rb')
+    if manifest == '-':
+        f = getattr(f, 'buffer', f)
+    return _iter_manifest(f, manifest, rpm_buildroot, index)
+
+
+def _iter_manifest(f, manifest, rpm_buildroot, index):
+    seen = set()
+    try:
+        for line in iter(f.readline, b''):
+            directives, path = _parse_manifest_line(_fsdecode(line))
+            if not path.startswith(os.path.sep) or directives & set(['%ghost', '%exclude']):
+                continue
+            full_path = path_norm_join(rpm_buildroot, path)
+            if path.startswith(rpm_buildroot + os.path.sep):
+                full_path = path_norm_join(path)
+            if full_path.endswith('.py'):
+                sources = [full_path]
+            elif '%dir' not in directives and _is_dir(full_path):
+                sources = index.iter_py_files(full_path)
+            else:
+                continue
+            for source in sources:
+                if source not in seen:
+                    seen.add(source)
+                    yield source
+    finally:
+        if manifest != '-':
+            f.close()
+
+
+def _log_manifest_error(manifest, e):
+    logging.error('Error: can\'t read manifest "{0}": {1}'.format(manifest, e))
+
+
+def iter_manifest_batches(sources, configs, resolver, infos={}, batch_size=None):
+    """Yields batches of given sources to be compiled by persistent workers of configs
+    owning them. Batches are yielded as soon as they're big enough, so that compilation
+    can start while sources are still being read.
+
+    Args:
+        sources: iterable of full paths of .py files
+        configs: mapping of config names to ByteCompileConfig objects
+        resolver: OwnershipResolver of all configs
+        infos: mapping of config names to information about their interpreters as
+            returned by probe_interpreter
+        batch_size: target total size of sources in a batch in bytes; MIN_BATCH_SIZE
+            by default, 0 means one batch per compile dir or rootdir
+    """
+    if batch_size is None:
+        batch_size = MIN_BATCH_SIZE
+    # {(config_name, real_dir, flags): CompileBatch}
+    pending = {}
+    for source in sources:
+        unit = resolver.resolve(source)
+        if unit is None or not configs[unit[0]].supports_workers:
+            continue
+        config = configs[unit[0]]
+        compile_dir = path_norm_join(resolver.rpm_buildroot, unit[1])
+        dfile = path_norm_join(unit[1], os.path.relpath(source, compile_dir))
+        weight = _file_size(source) + FILE_WEIGHT_OVERHEAD
+        for flags, optimize in config.get_variations(infos.get(unit[0]), workers=True):
+            batch = pending.get(unit + (flags,))
+            if batch is None:
+                batch = pending[unit + (flags,)] = CompileBatch(unit[0], compile_dir,
+                    unit[1], flags, [], 0)
+            batch.jobs.append((source, dfile, optimize))
+            batch.weight += weight * (len(optimize) if isinstance(optimize, list) else 1)
+            if batch_size and batch.weight >= batch_size:
+                del pending[unit + (flags,)]
+                yield batch
+    for key in sorted(pending):
+        yield pending[key]
+
+
+def _parse_manifest_line(line):
+    """Returns a tuple (set of directives, path) of a line of a manifest."""
+    directives = set()
+    rest = line.strip()
+    while rest.startswith('%'):
+        match = re.match(r'(%\w+)(\([^)]*\))?\s*', rest)
+        if match is None:
+            break
+        directives.add(match.group(1))
+        rest = rest[match.end():]
+    if len(rest) > 1 and rest.startswith('"') and rest.endswith('"'):
+        rest = rest[1:-1]
+    return directives, rest
+
+
+def _is_dir(path):
+    """Returns True if path is a directory (not a symlink to one)."""
+    try:
+        return stat.S_ISDIR(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+def get_caches(configs, cache_dir, cache_size):
+    """Returns bytecode caches of given configs.
+
+    Args:
+        configs: mapping of config names to ByteCompileConfig objects
+        cache_dir: directory of bytecode cache, overriden by cache_dir of configs
+        cache_size: maximum size of every bytecode cache, see _parse_size
+
+    Returns:
+        a tuple ({config_name: BytecodeCache}, {cache directory: BytecodeCache}),
+        configs sharing a cache directory share the BytecodeCache object
+    """
+    caches = {}
+    by_directory = {}
+    for fname, config in configs.items():
+        directory = config.formatted_dict['cache_dir'] or cache_dir
+        if directory and config.supports_workers:
+            directory = path_norm_join(directory)
+            if directory not in by_directory:
+                by_directory[directory] = BytecodeCache(directory, _parse_size(cache_size))
+            caches[fname] = by_directory[directory]
+    return caches, by_directory
+
+
+def verify_bytecode(rpm_buildroot, configs, index, jobs):
+    """Checks that all sources compiled by configs have up to date bytecompiled files
+    for every configured optimization level, without compiling anything. Only headers
+    of bytecompiled files are read (see check_bytecode), concurrently by jobs threads.
+
+    Args:
+        rpm_buildroot: rpm buildroot
+        configs: mapping of config names to ByteCompileConfig objects
+        index: BuildrootIndex of rpm_buildroot
+        jobs: number of parallel jobs
+
+    Returns:
+        a JSON serializable dict with keys:
+            checked: number of checked bytecompiled files
+            counts: mapping of statuses (see check_bytecode) to numbers of files
+            problems: list of {"config", "source", "cfile", "optimize", "status",
+                "detail"} dicts of files that are missing, stale, invalid or written
+                by a wrong interpreter, sorted by source
+            unverified_configs: names of configs whose interpreters couldn't be probed
+    """
+    infos = probe_interpreters(configs, [fname for fname, config in configs.items()
+        if any(index.has_py_files(path_norm_join(rpm_buildroot, unit[1]))
+            for unit in config.get_units())])
+    unverified = sorted(fname for fname, info in infos.items() if info is None)
+    for fname in unverified:
+        logging.error('Error: can\'t probe Python interpreter of config "{0}", '.format(fname) +
+            'its bytecompiled files are not verified')
+
+    def iter_sources():
+        resolver = OwnershipResolver(configs, rpm_buildroot)
+        for fname, config in sorted(configs.items()):
+            if infos.get(fname) is None:
+                continue
+            if config.supports_workers:
+                for unit in config.get_units():
+                    for source in resolver.iter_owned_files(index, unit):
+                        yield fname, source
+                continue
+            # a custom inline_script compiles whole directories, once for every flags
+            compile_dir = None
+            for invocation in config.iter_compile_invocations(rpm_buildroot,
+                    get_exclude_dirs(configs, rpm_buildroot, fname), index):
+                if invocation.compile_dir != compile_dir:
+                    compile_dir = invocation.compile_dir
+                    for source in invocation.iter_sources(index):
+                        yield fname, source
+
+    def verify_source(config_source):
+        fname, source = config_source
+        info = infos[fname]
+        checked = []
+        for level in configs[fname].formatted_dict['optimization_levels']:
+            cfile = _cache_from_source(source, info, level)
+            # Python < 3.5 writes both levels 1 and 2 to the same .pyo file
+            if cfile is not None and cfile in [c[0] for c in checked]:
+                continue
+            status, detail = check_bytecode(source, cfile, info,
+                configs[fname].formatted_dict['invalidation_mode'])
+            checked.append((cfile, status, {'config': fname, 'source': source,
+                'cfile': cfile, 'optimize': level, 'status': status, 'detail': detail}))
+        return checked
+
+    counts = {}
+    problems = []
+    for checked in map_in_threads(verify_source, iter_sources(), jobs):
+        for cfile, status, finding in checked:
+            counts[status] = counts.get(status, 0) + 1
+            if status not in ('ok', 'hash_unchecked'):
+                problems.append(finding)
+    problems.sort(key=lambda p: (p['source'], p['optimize']))
+    checked = sum(counts.values())
+    logging.info('Verified {0} bytecompiled files: {1}'.format(checked, ', '.join(
+        '{0} {1}'.format(counts[status], status) for status in sorted(counts)) or 'nothing'))
+    for p in problems:
+        logging.info('{0}: "{1}"{2}'.format(p['status'], p['cfile'] or p['source'],
+            ' ({0})'.format(p['detail']) if p['detail'] else ''))
+    return {'rpm_buildroot': rpm_buildroot, 'checked': checked, 'counts': counts,
+        'problems': problems, 'unverified_configs': unverified}
+
+
+def filter_up_to_date(items, configs, infos, index, counts):
+    """Yields given planned items without sources whose bytecompiled files are
+    already up to date (see check_bytecode). Batches are left with only the missing
+    and stale files, invocations with all files up to date are left out (the others
+    are kept whole, unless they're planned not to force the compilation).
+
+    Args:
+        items: iterable of planned items
+        configs: mapping of config names to ByteCompileConfig objects
+        infos: mapping of config names to information about their interpreters as
+            returned by probe_interpreter; items of other configs are kept as they are
+        index: BuildrootIndex of rpm buildroot
+        counts: dict, whose "skipped" and "compiled" values are increased by numbers
+            of up to date and missing or stale bytecompiled files
+
+    Yields:
+        planned items
+    """
+    for item in items:
+        info = infos.get(item.config_name)
+        if info is None:
+            yield item
+            continue
+        mode = configs[item.config_name].formatted_dict['invalidation_mode']
+
+        def stale_levels(source, levels):
+            return [level for level in levels if check_bytecode(source,
+                _cache_from_source(source, info, level), info, mode)[0] != 'ok']
+
+        if isinstance(item, CompileBatch):
+            jobs = []
+            for source, dfile, optimize in item.jobs:
+                levels = optimize if isinstance(optimize, list) else \
+                    [_get_flags_level(item.flags) if optimize < 0 else optimize]
+                stale = stale_levels(source, levels)
+                counts['skipped'] += len(levels) - len(stale)
+                counts['compiled'] += len(stale)
+                if stale:
+                    jobs.append((source, dfile, stale if isinstance(optimize, list) else optimize))
+            if jobs:
+                yield CompileBatch(item.config_name, item.compile_dir, item.real_dir,
+                    item.flags, jobs)
+        else:
+            levels = item.optimization_levels or [_get_flags_level(item.flags)]
+            total = stale = 0
+            for source in item.iter_sources(index):
+                total += len(levels)
+                stale += len(stale_levels(source, levels))
+            counts['skipped'] += total - stale
+            counts['compiled'] += stale
+            if stale:
+                yield item
+
+
+def _get_flags_level(flags):
+    """Returns optimization level set by given flags of Python interpreter."""
+    level = sum(flag.count('O') for flag in flags.split() if re.match(r'-O+$', flag))
+    return min(level, 2)
+
+
+def check_bytecode(source, cfile, info, invalidation_mode=None):
+    """Checks that a bytecompiled file is up to date with its source. Only the header
+    of the file is read: magic number, flags (Python 3.7+) and either source mtime and
+    size (size since Python 3.3) or source hash (hash based files, see PEP 552).
+
+    Args:
+        source: full path of the source
+        cfile: full path of the bytecompiled file, None if it's unknown
+        info: information about the Python interpreter, that should have written
+            the file, as returned by probe_interpreter
+        invalidation_mode: name of py_compile.PycInvalidationMode that the file should
+            be written with (Python 3.7+), None if any mode will do
+
+    Returns:
+        a tuple (status, detail), where status is one of "ok", "hash_unchecked" (the
+        file is hash based and the hash can't be computed by this interpreter),
+        "missing", "stale", "wrong_interpreter" and "invalid"; detail is a string
+        describing the problem or None
+    """
+    if cfile is None:
+        return 'invalid', 'unknown location of bytecompiled file'
+    version = tuple(info['version'])
+    header_size = 16 if version >= (3, 7) else 12 if version >= (3, 3) else 8
+    try:
+        fd = os.open(cfile, os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return 'missing', None
+        return 'invalid', str(e)
+    try:
+        header = os.read(fd, header_size)
+        st = os.stat(source)
+    except OSError as e:
+        return 'invalid', str(e)
+    finally:
+        os.close(fd)
+    if len(header) < header_size:
+        return 'invalid', 'truncated header'
+    magic = binascii.hexlify(header[:4]).decode('ascii')
+    if magic != info['magic']:
+        return 'wrong_interpreter', 'magic number {0}, expected {1}'.format(magic, info['magic'])
+    offset = 4
+    if version >= (3, 7):
+        flags = struct.unpack('<I', header[4:8])[0]
+        offset = 8
+        if flags in _PYC_FLAGS and invalidation_mode not in (None, _PYC_FLAGS[flags]):
+            return 'stale', '{0} file, expected {1}'.format(_PYC_FLAGS[flags].lower(),
+                invalidation_mode.lower())
+        if flags & 0x1:
+            expected = _source_hash(source, info)
+            if expected is None:
+                return 'hash_unchecked', None
+            if header[8:16] != expected:
+                return 'stale', 'source hash differs'
+            return 'ok', None
+        elif flags != 0:
+            return 'invalid', 'unknown flags {0}'.format(flags)
+    mtime = struct.unpack('<I', header[offset:offset + 4])[0]
+    if mtime != int(st.st_mtime) & 0xFFFFFFFF:
+        return 'stale', 'source mtime differs'
+    if version >= (3, 3) and struct.unpack('<I', header[offset + 4:offset + 8])[0] != \
+            st.st_size & 0xFFFFFFFF:
+        return 'stale', 'source size differs'
+    return 'ok', None
+
+
+# flags in headers of bytecompiled files mapped to py_compile.PycInvalidationMode names
+_PYC_FLAGS = {0: 'TIMESTAMP', 1: 'UNCHECKED_HASH', 3: 'CHECKED_HASH'}
+
+
+def _source_hash(source, info):
+    """Returns hash of given source as written to hash based bytecompiled files by
+    the interpreter described by info or None if it can't be computed. The hash
+    is keyed by the magic number and its algorithm differs between Python versions,
+    so it's computed only if this interpreter has the same magic number."""
+    try:
+        from importlib.util import MAGIC_NUMBER, source_hash
+    except ImportError:
+        return None
+    if binascii.hexlify(MAGIC_NUMBER).decode('ascii') != info['magic']:
+        return None
+    try:
+        with open(source, 'rb') as f:
+            return source_hash(f.read())
+    except (IOError, OSError):
+        return None
+
+
+def map_in_threads(func, items, jobs):
+    """Calls func for every item of given iterable concurrently in jobs threads.
+    The iterable is consumed lazily, one item at a time.
+
+    Returns:
+        list of results of the calls in no particular order
+    """
+    items = iter(items)
+    lock = threading.Lock()
+    results = []
+
+    def run():
+        while True:
+            with lock:
+                item = next(items, _END)
+            if item is _END:
+                return
+            result = func(item)
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=run) for i in range(max(1, jobs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+_END = object()
+
+
+def collect_bytecode(results, index):
+    """Returns a set of full paths of bytecompiled files written by executed items.
+
+    Persistent workers report the files they write; for invocations, bytecompiled
+    files are looked up in directories of their sources (and their __pycache__
+    subdirectories).
+
+    Args:
+        results: list of WorkResult objects
+        index: BuildrootIndex of the compiled buildroot
+    """
+    cfiles = set()
+    directories = set()
+    for r in results:
+        if r.file_results is not None:
+            cfiles.update(f['cfile'] for f in r.file_results if f['ok'])
+        elif isinstance(r.item, Invocation):
+            directories.update(os.path.dirname(s) for s in r.item.iter_sources(index))
+    for directory in directories:
+        for d in [directory, os.path.join(directory, '__pycache__')]:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            cfiles.update(os.path.join(d, n) for n in names if n.endswith(('.pyc', '.pyo')))
+    return cfiles
+
+
+def dedup_bytecode(cfiles, jobs):
+    """Replaces identical bytecompiled files of the same source, e.g. foo.cpython-36.pyc
+    and foo.cpython-36.opt-1.pyc, by hardlinks. Files are hashed concurrently by jobs
+    threads.
+
+    Args:
+        cfiles: iterable of full paths of bytecompiled files
+        jobs: number of parallel jobs
+
+    Returns:
+        a tuple (number of files replaced by hardlinks, bytes saved)
+    """
+    # {(directory, name without optimization level and suffix): [cfile, ...]}
+    groups = {}
+    for cfile in sorted(cfiles):
+        directory, name = os.path.split(cfile)
+        match = re.match(r'(.*?)(\.opt-\d+)?\.py[co]$', name)
+        if match is not None:
+            groups.setdefault((directory, match.group(1)), []).append(cfile)
+    results = map_in_threads(_dedup_group, [g for g in groups.values() if len(g) > 1], jobs)
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def _dedup_group(group):
+    """Replaces identical files of a group by hardlinks to the first of them.
+
+    Returns:
+        a tuple (number of files replaced by hardlinks, bytes saved)
+    """
+    stats = {}
+    for cfile in group:
+        try:
+            stats[cfile] = os.lstat(cfile)
+        except OSError:
+            pass
+    # only files of the same size can be identical, don't hash the others
+    by_size = {}
+    for cfile, st in stats.items():
+        if stat.S_ISREG(st.st_mode):
+            by_size.setdefault(st.st_size, []).append(cfile)
+    linked = saved = 0
+    for size, cfiles in by_size.items():
+        if len(cfiles) < 2:
+            continue
+        by_hash = {}
+        for cfile in sorted(cfiles):
+            try:
+                with open(cfile, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).digest()
+            except (IOError, OSError):
+                continue
+            by_hash.setdefault(digest, []).append(cfile)
+        for identical in by_hash.values():
+            target = stats[identical[0]]
+            for cfile in identical[1:]:
+                st = stats[cfile]
+                if (st.st_dev, st.st_ino) == (target.st_dev, target.st_ino):
+                    continue
+                tmp = cfile + '.dedup'
+                try:
+                    os.link(identical[0], tmp)
+                    os.rename(tmp, cfile)
+                except OSError as e:
+                    logging.warning('Warning: failed to hardlink "{0}" to "{1}": {2}'.format(
+                        cfile, identical[0], e))
+                    if os.path.lexists(tmp):
+                        os.unlink(tmp)
+                    continue
+                linked += 1
+                # the space is only saved when there's no other link to the replaced file
+                if st.st_nlink == 1:
+                    saved += size
+    return linked, saved
+
+
+def partition_batches(items, jobs, batch_size=None, window=None):
+    """Splits CompileBatch items into batches of files of roughly the same total
+    size of sources and yields them longest first, so that they balance well
+    across workers. Other items (invocations) can't be split and their cost is
+    unknown, so they're yielded right away in their original order.
+
+    Items are consumed lazily and at most window batches are held and ordered
+    at once, so the order is exactly longest first only if all batches fit
+    in the window.
+
+    Args:
+        items: iterable of planned items
+        jobs: number of parallel jobs
+        batch_size: target total size of sources in a batch in bytes; by default
+            it's chosen so that every job gets several batches of the first window;
+            0 disables splitting
+        window: maximum number of batches held at once, PLAN_WINDOW or four per
+            job by default, whichever is more
+
+    Yields:
+        planned items
+    """
+    if window is None:
+        window = max(PLAN_WINDOW, jobs * 4)
+    # sizes of sources of batches that weren't split yet
+    sizes = {}
+
+    def get_weight(job):
+        source, optimize = job[0], job[2]
+        if source not in sizes:
+            try:
+                sizes[source] = os.stat(source).st_size
+            except OSError:
+                sizes[source] = 0
+        # the source is compiled once for every optimization level
+        levels = len(optimize) if isinstance(optimize, list) else 1
+        return sizes[source] * levels + FILE_WEIGHT_OVERHEAD
+
+    # heap of (-weight, sequence number, batch), ties are kept in the planned order
+    heap = []
+    counter = itertools.count()
+    # batches held until the batch size is chosen
+    unsplit = []
+
+    def push(batch):
+        parts = batch.split(batch_size, get_weight) if batch_size > 0 else [batch]
+        for part in parts:
+            heapq.heappush(heap, (-part.weight, next(counter), part))
+
+    for item in items:
+        if not isinstance(item, CompileBatch):
+            yield item
+            continue
+        item.weight = sum(get_weight(j) for j in item.jobs)
+        if batch_size is None:
+            unsplit.append(item)
+            if len(unsplit) < window:
+                continue
+            batch_size = max(MIN_BATCH_SIZE, sum(b.weight for b in unsplit) // (jobs * 4))
+            [push(b) for b in unsplit]
+            unsplit = []
+        else:
+            push(item)
+        sizes.clear()
+        while len(heap) > window:
+            yield heapq.heappop(heap)[2]
+    if batch_size is None:
+        batch_size = max(MIN_BATCH_SIZE, sum(b.weight for b in unsplit) // (jobs * 4))
+        [push(b) for b in unsplit]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def _recorded(items, recorded):
+    """Yields given items, appending each of them to the list recorded first."""
+    for item in items:
+        recorded.append(item)
+        yield item
+
+
+def _exclude_dir_regex(directory, rpm_buildroot):
+    """Returns a regular expression matching full paths of files below given directory
+    the same way OwnershipResolver excludes them from rootdirs: directories of other
+    configs (full paths including rpm buildroot) literally, shell-style patterns from
+    ROOTDIR_EXCLUDE_PATTERNS anywhere below rpm buildroot, but never in the path
+    of rpm buildroot itself."""
+    if directory not in ROOTDIR_EXCLUDE_PATTERNS:
+        return '^' + re.escape(directory.rstrip(os.path.sep)) + '/'
+    # translate the pattern piecewise, fnmatch.translate anchors the whole expression
+    regex = ['^', re.escape(rpm_buildroot.rstrip(os.path.sep)), '(?:/[^/]+)*/']
+    for part in re.split(r'(\[[^\]]*\]|\*|\?)', directory.strip(os.path.sep)):
+        if part == '*':
+            regex.append('[^/]*')
+        elif part == '?':
+            regex.append('[^/]')
+        elif part.startswith('[') and part.endswith(']') and len(part) > 2:
+            regex.append(part)
+        else:
+            regex.append(re.escape(part))
+    # patterns not ending with a slash match directories starting with the last component
+    if not directory.endswith(os.path.sep):
+        regex.append('[^/]*')
+    return ''.join(regex) + '/'
+
+
+def _describe(item):
+    """Returns a string describing a planned item for logging."""
+    if isinstance(item, Invocation):
+        return item.run_string
+    return item.describe()
+
+
+def _is_nonzero(value):
+    """Interprets a commandline switch like errors_terminate, that is supposed
+    to be a number, as boolean."""
+    try:
+        return int(value) != 0
+    except (TypeError, ValueError):
+        return bool(value)
+
+
+def unassoc_libdirs_errors(configs, rpm_buildroot, index=None):
+    """Find out if there are Python libdirs unassociated with any config.
+    Logs the problematic libdirs, if any.
+
+    Args:
+        configs: mapping of config names to ByteCompileConfig objects
+        rpm_buildroot: rpm buildroot to search
+        index: BuildrootIndex of rpm_buildroot; a new one is created if not provided
+
+    Returns:
+        True if problems were found, False otherwise
+    """
+    if index is None:
+        index = BuildrootIndex(rpm_buildroot)
+    buildroot_libdirs = []
+    for pld in PYTHON_LIBDIRS:
+        buildroot_libdirs.extend(index.find_dirs(pld))
+
+    config_libdirs = []
+    for cf in configs.values():
+        libdirs = [path_norm_join(rpm_buildroot, l) for l in cf.formatted_dict['compile_dirs']]
+        config_libdirs.extend(libdirs)
+
+    not_matched = set(buildroot_libdirs) - set(config_libdirs)
+
+    if not_matched:
+        logging.error('Error: there are Python libdirs not associated with any Python runtime:')
+        [logging.error(nm) for nm in sorted(not_matched)]
+        return True
+
+    return False
+
+
+def compile_roots_errors(configs):
+    """Check that there isn't a rootdir with two or more default Pythons.
+    Logs the problematic rootdirs and respective configs, if any.
+
+    Args:
+        configs: mapping of config names to ByteCompileConfig objects
+
+    Returns:
+        True if problems were found, False otherwise
+    """
+    # mapping {config_filename: rootdir}
+    compile_roots = {}
+    for fname, config in configs.items():
+        if config.formatted_dict['default_for_rootdir']:
+            compile_roots[fname] = path_norm_join(config.formatted_dict['rootdir'])
+
+    # mapping {rootdir: [config_filename, ...]}
+    path_to_pythons = {}
+    for python, path in compile_roots.items():
+        path_to_pythons.setdefault(path, [])
+        path_to_pythons[path].append(python)
+
+    errs = {path: pythons for path, pythons in path_to_pythons.items() if len(pythons) > 1}
+    if errs:
+        logging.error('Error, following roots are to be compiled by multiple Pythons:')
+        for root, confs in sorted(errs.items()):
+            err_msg = '"{root}": {confs}'.format(root=root, confs=', '.join(sorted(confs)))
+            logging.error(err_msg)
+        return True
+
+    return False
+
+
+def get_exclude_dirs(configs, rpm_buildroot, current):
+    """Get list of directories to be excluded by rootdir compilation of specified config.
+
+    Args:
+        configs: mapping of config names to ByteCompileConfig objects
+        rpm_buildroot: rpm buildroot
+        current: name of config to get exclude strings for (it's own directories are
+            not included in the output)
+
+    Returns:
+        list of directories to exclude by given config
+    """
+    # we intentionally use bin, sbin and libdir patterns without prepending
+    #  rpm_buildroot to catch all bindirs and libdirs everywhere
+    #  I think it's ok, but maybe we'll need to reconsider down the road
+    excl = list(ROOTDIR_EXCLUDE_PATTERNS)
+
+    for fname, config in configs.items():
+        if fname != current:
+            # we intentionally put whole dirs including rpm_buildroot into result
+            if config.formatted_dict['default_for_rootdir']:
+                excl.append(path_norm_join(rpm_buildroot, config.formatted_dict['rootdir']))
+            excl.extend([path_norm_join(rpm_buildroot, d) \
+                for d in config.formatted_dict['compile_dirs']])
+
+    return sorted(excl)
+
+
+def load_configs(location):
+    """Loads and returns all configs from given location.
+
+    Args:
+        location: a directory to search for configs
+
+    Returns:
+        a mapping {config_name: ByteCompileConfig object, ...}
+    """
+    configs = {}
+    for name in _list_configs(location):
+        config = ByteCompileConfig.from_file(path_norm_join(location, name))
+        configs[config.fname] = config
+    return configs
+
+
+def _list_configs(location):
+    """Returns names of config files in given location."""
+    try:
+        # not using glob, location may contain glob metacharacters
+        return [n for n in fnmatch.filter(os.listdir(location), '*.conf')
+            if not n.startswith('.')]
+    except OSError:
+        return []
+
+
+def main(argv=None):
+    """Runs the bytecompilation of $RPM_BUILD_ROOT as brp-python-bytecompile.py does.
+
+    Returns:
+        exit status, see bytecompile
+    """
+    logging.basicConfig(format=os.path.basename(sys.argv[0]) + ': %(message)s',
+        level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='brp-python-bytecompile.py')
+    # TODO: document that default_python is only here for backwards compat
+    #  (or remove it altogether)
+    parser.add_argument('default_python', default=None)
+    parser.add_argument('errors_terminate', default=None)
+    parser.add_argument('--dry-run', action='store_true', default=False)
+    parser.add_argument('--config-dir', default='/etc/pypackages-tools/')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of concurrent bytecompilation processes ' +
+            '(default: $RPM_BUILD_NCPUS or number of CPUs)')
+    parser.add_argument('--workers', action='store_true', default=False,
+        help='compile by persistent workers started once per config and flags')
+    parser.add_argument('--batch-size', default=None,
+        help='target total size of sources compiled by a worker at once, K, M and G ' +
+            'suffixes are allowed, 0 means one batch per directory (default: automatic)')
+    parser.add_argument('--cache-dir', default=None,
+        help='directory of bytecode cache shared across builds (implies --workers)')
+    parser.add_argument('--cache-size', default='1G',
+        help='maximum size of bytecode cache, K, M and G suffixes are allowed (default: 1G)')
+    parser.add_argument('--plan-out', default=None, metavar='FILE',
+        help='write the plan of bytecompilation to FILE')
+    plan_source = parser.add_mutually_exclusive_group()
+    plan_source.add_argument('--plan-in', default=None, metavar='FILE',
+        help='execute the plan from FILE instead of loading configs and planning')
+    plan_source.add_argument('--manifest', default=None, metavar='FILE',
+        help='compile only .py files (and directories) listed in FILE ("-" for stdin) ' +
+            'by persistent workers as they are read, instead of walking the buildroot')
+    plan_source.add_argument('--verify', default=None, metavar='FILE',
+        help='compile nothing, only check that bytecompiled files are up to date and ' +
+            'write missing, stale and invalid ones as JSON to FILE ("-" for stdout)')
+    parser.add_argument('--plan-cache-dir', default=None,
+        help='directory of cache of plans (default: "plans" in --cache-dir, if set)')
+    parser.add_argument('--incremental', action='store_true', default=False,
+        help='compile only sources without up to date bytecompiled files, instead of ' +
+            'forcing compilation of all of them')
+    parser.add_argument('--dedup', action='store_true', default=False,
+        help='replace identical bytecompiled files of the same source by hardlinks')
+    parser.add_argument('--report', default=None, metavar='FILE',
+        help='write JSON report of timings and throughput of the run to FILE')
+    parser.add_argument('--buildroot', action='append', default=[], metavar='DIR',
+        dest='buildroots', help='bytecompile DIR instead of $RPM_BUILD_ROOT, can be ' +
+            'given more times to bytecompile more buildroots at once')
+    parser.add_argument('--buildroots', default=None, metavar='FILE', dest='buildroots_file',
+        help='bytecompile buildroots listed in FILE ("-" for stdin), one per line')
+
+    args = parser.parse_args(argv)
+    buildroots = args.buildroots
+    if args.buildroots_file is not None:
+        buildroots = buildroots + _read_buildroots(args.buildroots_file)
+    if buildroots:
+        for option in ['plan_in', 'plan_out', 'manifest', 'verify', 'report',
+                'plan_cache_dir']:
+            if getattr(args, option) is not None:
+                parser.error('--{0} can\'t be used with --buildroot or --buildroots'.format(
+                    option.replace('_', '-')))
+        return bytecompile_many(buildroots, args.errors_terminate, args.config_dir,
+            args.dry_run, jobs=args.jobs, workers=args.workers, cache_dir=args.cache_dir,
+            cache_size=args.cache_size, batch_size=args.batch_size, dedup=args.dedup,
+            incremental=args.incremental)
+    del args.buildroots, args.buildroots_file
+    rpm_buildroot = os.environ.get('RPM_BUILD_ROOT', '/')
+    return bytecompile(rpm_buildroot=rpm_buildroot, **vars(args))
+
+
+def _read_buildroots(path):
+    """Returns buildroots listed in a file, "-" for stdin, skipping empty lines and
+    comments."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        lines = [line.strip() for line in f]
+    finally:
+        if path != '-':
+            f.close()
+    return [line for line in lines if line and not line.startswith('#')]
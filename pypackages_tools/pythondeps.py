@@ -0,0 +1,317 @@
+"""Automatic Provides and Requires of Python distributions installed in rpm buildroots.
+
+Every *.dist-info and *.egg-info is assigned to the Python runtime (config in
+/etc/pypackages-tools/) owning its directory by the same rules that bytecompilation
+uses, see pypackages_tools.bytecompile.OwnershipResolver. The pythondistdeps.py
+script is a thin wrapper of main(), usable as an RPM dependency generator.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from pypackages_tools.bytecompile import OwnershipResolver, get_default_jobs, load_configs, \
+    makedirs, map_in_threads, path_norm_join
+
+# bump when the parsed data changes, so that old cache entries aren't used
+PARSER_VERSION = 1
+
+_REQUIREMENT_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*' +
+    r'\(?([^;()]*)\)?\s*(;.*)?$')
+_SPECIFIER_RE = re.compile(r'^\s*(~=|===|==|!=|<=|>=|<|>)\s*([^\s,]+)\s*$')
+# PEP 440 operators mapped to RPM ones; "!=" can't be expressed by a single RPM
+#  dependency and is left out, "~= V" is approximated by ">= V"
+_RPM_OPERATORS = {'~=': '>=', '===': '=', '==': '=', '<=': '<=', '>=': '>=', '<': '<',
+    '>': '>'}
+
+
+def find_metadata(path):
+    """Returns a tuple (metadata file, requires.txt file or None) describing the
+    distribution that given installed path belongs to, None if the path isn't
+    a part of *.dist-info or *.egg-info metadata.
+
+    Args:
+        path: full path of a file or directory
+    """
+    path = path.rstrip(os.path.sep)
+    directory, name = os.path.split(path)
+    if name.endswith('.dist-info') and os.path.isdir(path):
+        return os.path.join(path, 'METADATA'), None
+    if name.endswith('.egg-info'):
+        if os.path.isdir(path):
+            return os.path.join(path, 'PKG-INFO'), os.path.join(path, 'requires.txt')
+        return path, None
+    parent = os.path.basename(directory)
+    if parent.endswith('.dist-info') and name == 'METADATA':
+        return path, None
+    if parent.endswith('.egg-info') and name in ('PKG-INFO', 'requires.txt'):
+        return os.path.join(directory, 'PKG-INFO'), os.path.join(directory, 'requires.txt')
+    return None
+
+
+def hash_metadata(metadata, requires=None):
+    """Returns hex digest of hash of contents of given metadata files (a missing
+    requires.txt is the same as an empty one)."""
+    h = hashlib.sha256(str(PARSER_VERSION).encode('ascii'))
+    for path in [metadata, requires]:
+        h.update(b'\0')
+        if path is None or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def stat_metadata(metadata, requires=None):
+    """Returns hex digest of hash of paths, mtimes and sizes of given metadata files,
+    which is cheap to compute and changes whenever the files are changed."""
+    h = hashlib.sha256(str(PARSER_VERSION).encode('ascii'))
+    for path in [metadata, requires]:
+        try:
+            st = os.stat(path) if path is not None else None
+        except OSError:
+            st = None
+        stat = None if st is None else [getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size]
+        h.update(b'\0' + json.dumps([path, stat]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def read_metadata(metadata, requires=None):
+    """Parses metadata of a distribution. Only the headers of the metadata file are
+    read, line by line, the description following them isn't.
+
+    Args:
+        metadata: path of METADATA or PKG-INFO file
+        requires: path of requires.txt of an egg-info, None if there's none
+
+    Returns:
+        a JSON serializable dict {"name", "version", "requires"}, where requires is
+        a list of requirement strings as in Requires-Dist
+    """
+    headers = {}
+    last = None
+    with io.open(metadata, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                break
+            if line[0] in ' \t' and last is not None:
+                headers[last][-1] += ' ' + line.strip()
+                continue
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            last = key.strip().lower()
+            headers.setdefault(last, []).append(value.strip())
+    result = {'name': (headers.get('name') or [None])[0],
+        'version': (headers.get('version') or [None])[0],
+        'requires': headers.get('requires-dist', [])}
+    if requires is not None and os.path.isfile(requires):
+        with io.open(requires, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                # sections are extras or environment markers
+                if line.startswith('['):
+                    break
+                if line and not line.startswith('#'):
+                    result['requires'].append(line)
+    return result
+
+
+def parse_requirement(requirement):
+    """Returns a tuple (name, [(operator, version), ...]) of given requirement string,
+    None if it can't be parsed or has an environment marker (including extras),
+    which can't be evaluated for the target runtime."""
+    match = _REQUIREMENT_RE.match(requirement)
+    if match is None or match.group(4):
+        return None
+    specifiers = []
+    for part in match.group(3).split(','):
+        if not part.strip():
+            continue
+        specifier = _SPECIFIER_RE.match(part)
+        if specifier is None:
+            return None
+        specifiers.append(specifier.groups())
+    return match.group(1), specifiers
+
+
+def normalize_name(name):
+    """Returns name of a distribution normalized as in PEP 503."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+class MetadataCache(object):
+    """On-disk cache of parsed metadata (see read_metadata), so that metadata seen
+    by any earlier run isn't parsed again. Entries are keyed both on stats of the
+    metadata files (see stat_metadata), so that files seen by an earlier run aren't
+    even read, and on hash of their contents (see hash_metadata), so that the same
+    metadata changed only by its stats (e.g. in another buildroot) isn't parsed.
+
+    Attributes:
+        directory: the cache directory
+        hits, misses: statistics of this run
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_metadata(self, metadata, requires=None):
+        """Returns parsed metadata of given files (see read_metadata), cached if
+        possible. Contents of the files are hashed only if their stats changed
+        and parsed only if their contents changed since they were cached."""
+        stat_key = stat_metadata(metadata, requires)
+        data = self.get(stat_key)
+        hit = data is not None
+        if data is None:
+            key = hash_metadata(metadata, requires)
+            data = self.get(key)
+            hit = data is not None
+            if data is None:
+                data = read_metadata(metadata, requires)
+                self.put(key, data)
+            self.put(stat_key, data)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return data
+
+    def get(self, key):
+        """Returns cached metadata with given key, None if there's none."""
+        try:
+            with open(self._entry_path(key)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, data):
+        """Stores metadata with given key."""
+        entry = self._entry_path(key)
+        try:
+            makedirs(os.path.dirname(entry))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, entry)
+        except (IOError, OSError) as e:
+            logging.warning('Warning: failed to store metadata in cache: {0}'.format(e))
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + '.json')
+
+
+def scan_distributions(paths, rpm_buildroot, configs, jobs=None, cache=None):
+    """Finds distributions that given installed paths belong to and parses their
+    metadata concurrently by jobs threads.
+
+    Args:
+        paths: iterable of paths of installed files, including rpm buildroot or
+            relative to it; paths not belonging to any metadata are skipped
+        rpm_buildroot: rpm buildroot
+        configs: mapping of config names to ByteCompileConfig objects
+        jobs: number of parallel jobs, defaults to get_default_jobs()
+        cache: MetadataCache to use, None to parse all metadata
+
+    Returns:
+        list of (config_name, metadata dict) tuples sorted by metadata path, see
+        read_metadata; distributions not owned by any config are left out
+    """
+    resolver = OwnershipResolver(configs, rpm_buildroot)
+
+    def iter_metadata():
+        seen = set()
+        for path in paths:
+            if not path.startswith(rpm_buildroot + os.path.sep):
+                path = path_norm_join(rpm_buildroot, path)
+            found = find_metadata(path)
+            if found is not None and found[0] not in seen:
+                seen.add(found[0])
+                yield found
+
+    def scan(found):
+        metadata, requires = found
+        unit = resolver.resolve(metadata)
+        if unit is None or not os.path.isfile(metadata):
+            return metadata, None
+        if cache is not None:
+            data = cache.get_metadata(metadata, requires)
+        else:
+            data = read_metadata(metadata, requires)
+        return metadata, (unit[0], data)
+
+    results = map_in_threads(scan, iter_metadata(), jobs or get_default_jobs())
+    return [r for m, r in sorted(results, key=lambda r: r[0]) if r is not None]
+
+
+def get_provides(config_name, metadata):
+    """Returns a list of RPM Provides of a distribution of given runtime."""
+    if not metadata['name'] or not metadata['version']:
+        return []
+    return ['{0}dist({1}) = {2}'.format(config_name, normalize_name(metadata['name']),
+        metadata['version'])]
+
+
+def get_requires(config_name, metadata):
+    """Returns a list of RPM Requires of a distribution of given runtime, one for every
+    version specifier of its unconditional requirements."""
+    requires = []
+    for requirement in metadata['requires']:
+        parsed = parse_requirement(requirement)
+        if parsed is None:
+            continue
+        name, specifiers = parsed
+        dependency = '{0}dist({1})'.format(config_name, normalize_name(name))
+        clauses = ['{0} {1} {2}'.format(dependency, _RPM_OPERATORS[op], version)
+            for op, version in specifiers if op in _RPM_OPERATORS and '*' not in version]
+        requires.extend(clauses or [dependency])
+    return requires
+
+
+def generate(paths, rpm_buildroot, configs, requires=False, jobs=None, cache=None):
+    """Returns sorted RPM Provides (or Requires, if requires is set) of distributions
+    that given installed paths belong to, see scan_distributions."""
+    get = get_requires if requires else get_provides
+    dependencies = set()
+    for config_name, metadata in scan_distributions(paths, rpm_buildroot, configs, jobs,
+            cache):
+        dependencies.update(get(config_name, metadata))
+    return sorted(dependencies)
+
+
+def main(argv=None):
+    """Prints Provides or Requires of distributions that paths read from stdin belong
+    to, as RPM dependency generators do.
+
+    Returns:
+        exit status
+    """
+    logging.basicConfig(format=os.path.basename(sys.argv[0]) + ': %(message)s',
+        level=logging.WARNING)
+    parser = argparse.ArgumentParser(prog='pythondistdeps.py')
+    kind = parser.add_mutually_exclusive_group(required=True)
+    kind.add_argument('-P', '--provides', action='store_true', default=False)
+    kind.add_argument('-R', '--requires', action='store_true', default=False)
+    parser.add_argument('--config-dir', default='/etc/pypackages-tools/')
+    parser.add_argument('--cache-dir', default=None,
+        help='directory of cache of parsed metadata shared across runs')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='number of concurrently parsed metadata files ' +
+            '(default: $RPM_BUILD_NCPUS or number of CPUs)')
+    args = parser.parse_args(argv)
+
+    rpm_buildroot = path_norm_join(os.environ.get('RPM_BUILD_ROOT', '/'))
+    cache = MetadataCache(path_norm_join(args.cache_dir)) if args.cache_dir else None
+    paths = (line.rstrip('\n') for line in sys.stdin if line.strip())
+    for dependency in generate(paths, rpm_buildroot, load_configs(args.config_dir),
+            requires=args.requires, jobs=args.jobs, cache=cache):
+        sys.stdout.write(dependency + '\n')
+    return 0
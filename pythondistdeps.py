@@ -0,0 +1,9 @@
+#!/usr/bin/python3
+"""Generates RPM Provides and Requires of Python distributions, see
+pypackages_tools.pythondeps."""
+import sys
+
+from pypackages_tools.pythondeps import main
+
+if __name__ == '__main__':
+    sys.exit(main())
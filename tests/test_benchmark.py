@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+
+BENCHMARK = os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'bench_bytecompile.py')
+
+
+def test_benchmark_smoke(pyruntime, tmpdir):
+    output = tmpdir.join('results.json')
+    subprocess.check_call([pyruntime, BENCHMARK, '--files', '30', '--depth', '3',
+        '--scl-roots', '1', '--repeat', '2', '--execute', '--python', pyruntime,
+        '--output', str(output)])
+    results = json.loads(output.read())
+    assert results['parameters']['files'] == 30
+    for phase in ['load_configs', 'get_exclude_dirs', 'unassoc_libdirs_errors',
+            'get_compile_invocations', 'get_compile_batches', 'execute_invocations',
+            'execute_workers']:
+        assert len(results['results'][phase]['runs']) == 2
+
+    # comparing with itself
+    proc = subprocess.Popen([pyruntime, BENCHMARK, '--files', '30', '--repeat', '1',
+        '--output', str(tmpdir.join('new.json')), '--compare', str(output)],
+        stderr=subprocess.PIPE)
+    err = proc.communicate()[1].decode('utf-8')
+    assert proc.returncode == 0
+    assert 'get_compile_invocations' in err
@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+
+import pytest
+
+from pypackages_tools import bytecompile
+from pypackages_tools.bytecompile import BuildrootIndex, Bytecompiler, Executor, MemoryAdmission, \
+    OwnershipResolver, Plan, PlanCache, ResourceLimits, RunResult, get_resource_limits, \
+    load_configs
+from .test_bytecompile_runs import RPM_BUILDROOT, SAMPLE_FILES, compiled_files, make_testroot
+
+
+def make_compiler(pyruntime, tmpdir, **kwargs):
+    config_dir = tmpdir.join('etc', 'pypackages-tools').ensure(dir=True)
+    config_dir.join('python9.9.conf').write(
+        '[bytecompile]\ndefault_for_rootdir=1\npython={0}\n'.format(pyruntime))
+    return Bytecompiler.from_config_dir(str(config_dir), **kwargs)
+
+
+def test_compiler_is_reused_for_more_buildroots(pyruntime, tmpdir):
+    testroots = [make_testroot(tmpdir.join(str(i)), {}, SAMPLE_FILES) for i in range(2)]
+    with make_compiler(pyruntime, tmpdir, jobs=2, workers=True) as compiler:
+        results = [compiler.run(str(t.join(RPM_BUILDROOT))) for t in testroots]
+
+    for testroot, result in zip(testroots, results):
+        assert isinstance(result, RunResult)
+        assert result.status == 0
+        assert not result.failed
+        assert len(compiled_files(testroot)) == 6
+        assert sorted(os.path.basename(f['source']) for f in result.iter_file_results()) == \
+            sorted(['foo.py', 'foo.py', '__init__.py', '__init__.py', 'baz.py', 'baz.py'])
+    # the second buildroot is compiled by workers started for the first one
+    assert sum(r.startup_time for r in results[0].results) > 0
+    assert sum(r.startup_time for r in results[1].results) == 0
+
+
+def test_plan_and_execute(pyruntime, tmpdir):
+    testroot = make_testroot(tmpdir, {}, SAMPLE_FILES)
+    rpm_buildroot = str(testroot.join(RPM_BUILDROOT))
+    with make_compiler(pyruntime, tmpdir) as compiler:
+        assert compiler.validate(rpm_buildroot) == 0
+        # without probing, every optimization level is compiled separately
+        plan = compiler.plan(rpm_buildroot, probe=False)
+        assert isinstance(plan, Plan)
+        plan.items = list(plan.items)
+        assert sorted(i.real_dir for i in plan.items) == ['/', '/', '/usr/lib/python9.9',
+            '/usr/lib/python9.9', '/usr/lib64/python9.9', '/usr/lib64/python9.9']
+        result = compiler.execute(plan)
+    assert result.status == 0
+    assert len(result.results) == 6
+    assert len(compiled_files(testroot)) == 6
+
+
+@pytest.mark.parametrize('errors_terminate, expected_status', [(True, 12), (False, 0)])
+def test_failures(pyruntime, tmpdir, errors_terminate, expected_status):
+    testroot = make_testroot(tmpdir, {}, {'usr/share/foo/bad.py': 'def\n'})
+    with make_compiler(pyruntime, tmpdir, workers=True,
+            errors_terminate=errors_terminate) as compiler:
+        result = compiler.run(str(testroot.join(RPM_BUILDROOT)))
+    assert result.status == expected_status
+    assert result.failed
+    assert [f['ok'] for f in result.iter_file_results()] == [False, False]
+
+
+def test_plan_cache_key_of_interpreter(tmpdir):
+    python = tmpdir.join('python9.9')
+    python.write('')
+    config_dir = tmpdir.join('etc', 'pypackages-tools').ensure(dir=True)
+    config_dir.join('python9.9.conf').write('[bytecompile]\npython={0}\n'.format(python))
+    cache = PlanCache(str(tmpdir.join('plans')))
+
+    def get_key():
+        configs = load_configs(str(config_dir))
+        return cache.get_key(str(config_dir), configs, str(tmpdir.join(RPM_BUILDROOT)))
+    key = get_key()
+    assert get_key() == key
+    # an updated interpreter behind the same config
+    os.utime(str(python), (1000000000, 1000000000))
+    assert get_key() != key
+
+
+def test_plan_cache_hit_skips_walk_and_probes(pyruntime, tmpdir, monkeypatch):
+    testroot = make_testroot(tmpdir, {}, SAMPLE_FILES)
+    make_compiler(pyruntime, tmpdir).close()
+    args = [str(testroot.join(RPM_BUILDROOT)), 'python', '1',
+        str(tmpdir.join('etc', 'pypackages-tools')), False]
+    kwargs = dict(workers=True, plan_cache_dir=str(tmpdir.join('plans')))
+    listed, probed = [], []
+    listdir, probe_interpreter = BuildrootIndex.listdir, bytecompile.probe_interpreter
+
+    def counting_listdir(self, directory):
+        listed.append(directory)
+        return listdir(self, directory)
+
+    def counting_probe_interpreter(config, flags):
+        probed.append(config.fname)
+        return probe_interpreter(config, flags)
+    monkeypatch.setattr(BuildrootIndex, 'listdir', counting_listdir)
+    monkeypatch.setattr(bytecompile, 'probe_interpreter', counting_probe_interpreter)
+
+    assert bytecompile.bytecompile(*args, **kwargs) == 0
+    assert listed and probed == ['python9.9']
+    for f in compiled_files(testroot):
+        testroot.join(RPM_BUILDROOT, f).remove()
+    del listed[:], probed[:]
+    assert bytecompile.bytecompile(*args, **kwargs) == 0
+    assert len(compiled_files(testroot)) == 6
+    assert listed == [] and probed == []
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('usr/share/foo/a.py', '/'),
+    ('usr/share/binaries/a.py', '/'),
+    ('usr/lib/python9.9/site-packages/a.py', '/usr/lib/python9.9'),
+    ('usr/bin/a.py', None),
+    ('opt/x/sbin/deeper/a.py', None),
+    ('usr/lib/python3.6/a.py', None),
+    ('usr/lib/python3.10/site-packages/a.py', None),
+])
+def test_ownership(pyruntime, tmpdir, path, expected):
+    with make_compiler(pyruntime, tmpdir) as compiler:
+        resolver = OwnershipResolver(compiler.configs, str(tmpdir.join(RPM_BUILDROOT)))
+    unit = resolver.resolve(str(tmpdir.join(RPM_BUILDROOT, path)))
+    assert unit == (None if expected is None else ('python9.9', expected))
+
+
+def test_validation_failure(pyruntime, tmpdir):
+    testroot = make_testroot(tmpdir, {}, {'usr/lib/python8.8/foo.py': ''})
+    with make_compiler(pyruntime, tmpdir) as compiler:
+        result = compiler.run(str(testroot.join(RPM_BUILDROOT)))
+    assert result.status == 11
+    assert result.results == []
+
+
+def test_run_many(pyruntime, tmpdir, monkeypatch):
+    testroots = [make_testroot(tmpdir.join(name), {}, files) for name, files in
+        [('good', SAMPLE_FILES), ('bad', {'usr/share/foo/bad.py': 'def\n'}),
+         ('unassociated', {'usr/lib/python8.8/foo.py': ''})]]
+    indexed = []
+    init = BuildrootIndex.__init__
+
+    def counting_init(self, rpm_buildroot, *args, **kwargs):
+        indexed.append(rpm_buildroot)
+        init(self, rpm_buildroot, *args, **kwargs)
+    monkeypatch.setattr(BuildrootIndex, '__init__', counting_init)
+    with make_compiler(pyruntime, tmpdir, jobs=2, workers=True) as compiler:
+        results = compiler.run_many([str(t.join(RPM_BUILDROOT)) for t in testroots])
+    # every buildroot is walked once for validation, planning and execution
+    assert sorted(indexed) == sorted(r.rpm_buildroot for r in results)
+    assert [r.index is not None for r in results] == [True, True, False]
+    assert [r.rpm_buildroot for r in results] == \
+        [str(t.join(RPM_BUILDROOT)) for t in testroots]
+    assert [r.status for r in results] == [0, 12, 11]
+    assert not results[0].failed and not results[0].cancelled
+    assert len(compiled_files(testroots[0])) == 6
+    assert all(r.item.compile_dir.startswith(results[1].rpm_buildroot)
+        for r in results[1].results)
+    # the failure didn't cancel the other buildroots
+    assert [f['ok'] for f in results[1].iter_file_results()] == [False, False]
+
+
+def write_files(root, files):
+    for path, contents in files.items():
+        root.join(path).write(contents, ensure=True)
+
+
+@pytest.mark.parametrize('proc_cgroup, files, expected', [
+    # cgroup v2, the parent's memory limit is lower
+    ('0::/build/job\n', {'cgroup.controllers': '', 'build/cpu.max': 'max 100000\n',
+        'build/memory.max': '1073741824\n', 'build/job/cpu.max': '150000 100000\n',
+        'build/job/memory.max': 'max\n', 'build/job/memory.current': '104857600\n'},
+        (1.5, 1073741824, 104857600)),
+    # cgroup v1, the parent's CPU quota and memory limit are lower
+    ('4:memory:/build/job\n2:cpu,cpuacct:/build/job\n', {
+        'cpu,cpuacct/build/cpu.cfs_quota_us': '100000\n',
+        'cpu,cpuacct/build/cpu.cfs_period_us': '100000\n',
+        'cpu,cpuacct/build/job/cpu.cfs_quota_us': '-1\n',
+        'cpu,cpuacct/build/job/cpu.cfs_period_us': '100000\n',
+        'memory/memory.limit_in_bytes': '9223372036854771712\n',
+        'memory/build/memory.limit_in_bytes': '268435456\n',
+        'memory/build/job/memory.limit_in_bytes': '536870912\n',
+        'memory/build/job/memory.usage_in_bytes': '2097152\n'},
+        (1.0, 268435456, 2097152)),
+    # cgroup v1, the cgroup isn't visible in the container, its root is used
+    ('4:memory:/docker/abc\n2:cpu,cpuacct:/docker/abc\n0::/\n', {
+        'cpu,cpuacct/cpu.cfs_quota_us': '200000\n', 'cpu,cpuacct/cpu.cfs_period_us': '100000\n',
+        'memory/memory.limit_in_bytes': '536870912\n',
+        'memory/memory.usage_in_bytes': '1048576\n', 'unified/cgroup.procs': ''},
+        (2.0, 536870912, 1048576)),
+    # unlimited
+    ('4:memory:/\n2:cpu:/\n', {'cpu/cpu.cfs_quota_us': '-1\n', 'cpu/cpu.cfs_period_us': '100000\n',
+        'memory/memory.limit_in_bytes': '9223372036854771712\n'}, (None, None, None)),
+])
+def test_resource_limits(tmpdir, proc_cgroup, files, expected):
+    write_files(tmpdir.join('cgroup'), files)
+    tmpdir.join('proc_cgroup').write(proc_cgroup)
+    limits = get_resource_limits(str(tmpdir.join('cgroup')), str(tmpdir.join('proc_cgroup')))
+    assert (limits.cpu_quota, limits.memory_limit, limits.memory_usage) == expected
+    if limits.cpu_quota:
+        assert limits.cpu_jobs == min(limits.cpus, int(limits.cpu_quota + 0.5))
+    if limits.memory_limit:
+        assert limits.memory_available == limits.memory_limit - limits.memory_usage
+
+
+def test_memory_admission():
+    admission = MemoryAdmission(100, default_rss=40)
+    running = []
+
+    def run(rss):
+        reserved = admission.acquire('python9.9')
+        running.append(reserved)
+        time.sleep(0.05)
+        admission.release('python9.9', reserved, rss)
+
+    # two items fit the budget until the first ones are measured bigger
+    threads = [threading.Thread(target=run, args=(60,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert admission.max_running == 2
+    assert admission.estimate('python9.9') == 60
+    assert admission.delayed >= 4
+    assert set(running[2:]) == set([60])
+
+    # an item bigger than the budget still runs alone
+    admission.release('python9.9', admission.acquire('python9.9'), 500)
+    assert admission.acquire('python9.9') == 500
+
+
+def test_executor_errors():
+    class Broken(object):
+        config_name = 'python9.9'
+
+        def execute(self, executor):
+            raise RuntimeError('broken item')
+
+    def items(broken_plan):
+        if broken_plan:
+            raise RuntimeError('broken plan')
+        yield Broken()
+        yield Broken()
+
+    for broken_plan, error in [(False, 'broken item'), (True, 'broken plan')]:
+        admission = MemoryAdmission(100, default_rss=40)
+        executor = Executor(1, False, admission=admission)
+        assert executor.run(items(broken_plan)) == []
+        # the first error cancels the execution, even though errors don't terminate it
+        assert executor.cancelled
+        assert [e.splitlines()[-1] for e in executor.errors] == ['RuntimeError: ' + error]
+        # the reservation of the broken item was released
+        assert admission.acquire('python9.9') == 40
+        assert admission.max_running == 1
+
+
+@pytest.mark.parametrize('workers', [False, True])
+def test_memory_limited_run(pyruntime, tmpdir, workers):
+    testroot = make_testroot(tmpdir, {}, SAMPLE_FILES)
+    limits = ResourceLimits(4, memory_limit=2 ** 30, memory_usage=0)
+    with make_compiler(pyruntime, tmpdir, jobs=4, workers=workers,
+            limits=limits) as compiler:
+        assert compiler.jobs == 4
+        result = compiler.run(str(testroot.join(RPM_BUILDROOT)))
+    assert result.status == 0
+    assert len(compiled_files(testroot)) == 6
+    # the interpreters were measured
+    assert all(r.max_rss > 0 for r in result.results)
+    assert compiler.admission.estimate('python9.9') == max(r.max_rss for r in result.results)
@@ -20,6 +20,26 @@ def run_bytecompile(pyruntime, directory, rpm_buildroot):
     return proc.returncode, out
 
 
+EXCLUDE_PATTERNS = ['/bin/', '/sbin/', '/usr/lib/python[0-9].[0-9]',
+    '/usr/lib64/python[0-9].[0-9]']
+
+
+def exclude_rx(excl_dirs, rpm_buildroot):
+    """Constructs the rx expression excluding given directories the same way
+    the script does - directories of other configs are matched literally, patterns
+    anywhere below rpm buildroot, where [...] are character classes."""
+    regexes = []
+    for d in sorted(excl_dirs):
+        if d not in EXCLUDE_PATTERNS:
+            regexes.append('^' + re.escape(d) + '/')
+            continue
+        parts = re.split(r'(\[[^\]]*\])', d.strip('/'))
+        regexes.append('^' + re.escape(rpm_buildroot) + '(?:/[^/]+)*/' +
+            ''.join(p if p.startswith('[') else re.escape(p) for p in parts) +
+            ('' if d.endswith('/') else '[^/]*') + '/')
+    return 're.compile(r"{0}")'.format('|'.join(regexes))
+
+
 def assert_libdirs_not_associated(retcode, output, libdirs, testdir, rpm_buildroot):
     """Warning: libdirs must not start with slash!"""
     assert retcode == 11
@@ -95,7 +115,7 @@ def test_one_libdir(pyruntime, has_default_python, testdir):
     # first, test bytecompilation of the rootdir by default python
     python = '/usr/bin/python2.7'
     to_compile = to_compile_base
-    rx="re.compile(r'/bin/|/sbin/|/usr/lib/python[0-9].[0-9]|/usr/lib64/python[0-9].[0-9]')"
+    rx = exclude_rx(EXCLUDE_PATTERNS, os.path.join(TEST_ROOTS, testdir, rpm_buildroot))
     if has_default_python:
         assert_compile_string(retcode, out, python=python, depth=8, real_dir='/', rx=rx,
             to_compile=to_compile_base)
@@ -129,7 +149,7 @@ def test_complex(pyruntime):
         sections[sect] = '\n'.join(sections[sect])
 
     to_compile_base = os.path.join(testdir, rpm_buildroot)
-    excl_dirs_base = ['/bin/', '/sbin/', '/usr/lib/python[0-9].[0-9]', '/usr/lib64/python[0-9].[0-9]']
+    excl_dirs_base = EXCLUDE_PATTERNS
 
 
     # check python2.7
@@ -138,7 +158,7 @@ def test_complex(pyruntime):
     excl_dirs = excl_dirs_base + [os.path.join(TEST_ROOTS, testdir, rpm_buildroot, d) for d in
         ['opt/rh/python33/root', 'opt/rh/python33/root/usr/lib/python3.3',
          'opt/rh/python33/root/usr/lib64/python3.3', 'usr/lib/python3.4', 'usr/lib64/python3.4']]
-    rx = "re.compile(r'{excl}')".format(excl='|'.join(sorted(excl_dirs)))
+    rx = exclude_rx(excl_dirs, os.path.join(TEST_ROOTS, testdir, rpm_buildroot))
     assert_compile_string(retcode, sections['python2.7'], python=python, depth=9, real_dir='/',
         rx=rx, to_compile=to_compile_base)
 
@@ -160,7 +180,7 @@ def test_complex(pyruntime):
     excl_dirs = excl_dirs_base + [os.path.join(TEST_ROOTS, testdir, rpm_buildroot, d) for d in
         ['usr/lib/python3.4', 'usr/lib64/python3.4',
          'usr/lib/python2.7', 'usr/lib64/python2.7']]
-    rx = "re.compile(r'{excl}')".format(excl='|'.join(sorted(excl_dirs)))
+    rx = exclude_rx(excl_dirs, os.path.join(TEST_ROOTS, testdir, rpm_buildroot))
     inline_script = ['import compileall, sys, re; ',
         'sys.exit(not compileall.compile_dir("{to_compile}", {depth}, "{real_dir}", ',
         'force=1, quiet=1, rx={rx}))']
@@ -0,0 +1,661 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+BYTECOMPILE_SCRIPT = 'brp-python-bytecompile.py'
+BRP_PYTHON_BYTECOMPILE = os.path.join(os.path.dirname(__file__), '..', BYTECOMPILE_SCRIPT)
+RPM_BUILDROOT = 'BUILDROOT'
+
+
+def make_testroot(tmpdir, configs, files):
+    """Creates a test root with configs in etc/pypackages-tools and given files
+    in its rpm buildroot.
+
+    Args:
+        tmpdir: py.path.local to create the test root in
+        configs: mapping {config_name: contents of [bytecompile] section}
+        files: mapping {path relative to rpm buildroot: file contents}
+    """
+    config_dir = tmpdir.join('etc', 'pypackages-tools').ensure(dir=True)
+    for name, section in configs.items():
+        config_dir.join(name + '.conf').write('[bytecompile]\n' + section)
+    buildroot = tmpdir.join(RPM_BUILDROOT).ensure(dir=True)
+    for path, contents in files.items():
+        buildroot.join(path).write(contents, ensure=True)
+    return tmpdir
+
+
+def run_bytecompile(pyruntime, testroot, errors_terminate='1', args=[], stdin=None):
+    proc = subprocess.Popen([pyruntime, BRP_PYTHON_BYTECOMPILE, '--config-dir',
+        str(testroot.join('etc', 'pypackages-tools')), 'python', errors_terminate] + args,
+        stdin=subprocess.PIPE if stdin is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env={'RPM_BUILD_ROOT': str(testroot.join(RPM_BUILDROOT))})
+
+    out = proc.communicate(stdin.encode('utf-8') if stdin is not None else None)[0]
+    out = out.decode('utf-8')
+    return proc.returncode, out
+
+
+def runtime_version(pyruntime):
+    out = subprocess.check_output([pyruntime, '-c', 'import sys; print(sys.version_info[:2])'])
+    return tuple(int(v) for v in out.decode('ascii').strip('()\n').split(','))
+
+
+def compiled_files(testroot):
+    """Returns sorted list of bytecompiled files relative to rpm buildroot."""
+    buildroot = str(testroot.join(RPM_BUILDROOT))
+    result = []
+    for root, dirs, files in os.walk(buildroot):
+        result.extend(os.path.relpath(os.path.join(root, f), buildroot) for f in files
+            if f.endswith(('.pyc', '.pyo')))
+    return sorted(result)
+
+
+SAMPLE_FILES = {'usr/lib/python9.9/site-packages/foo.py': 'x = 1\n',
+    'usr/lib64/python9.9/site-packages/spam/__init__.py': '',
+    'usr/share/bar/baz.py': 'y = 2\n',
+    'usr/sbin/not_compiled.py': 'z = 3\n'}
+
+
+@pytest.fixture
+def default_config(pyruntime):
+    """Options of config python9.9, that compiles also the rootdir by the tested runtime."""
+    return 'default_for_rootdir=1\npython={0}\n'.format(pyruntime)
+
+
+@pytest.fixture
+def sample_root(tmpdir, default_config):
+    """Returns a function creating a test root in tmpdir (or its given subdirectory)
+    with default_config extended by given options and given files, SAMPLE_FILES
+    by default."""
+    def make(options='', files=SAMPLE_FILES, subdir=None):
+        return make_testroot(tmpdir.join(subdir) if subdir is not None else tmpdir,
+            {'python9.9': default_config + options}, files)
+    return make
+
+
+@pytest.fixture
+def compile_ok(pyruntime):
+    """Returns a function running the script on a test root with given arguments,
+    that asserts the run succeeded and returns its output."""
+    def run(testroot, args=[], stdin=None):
+        retcode, out = run_bytecompile(pyruntime, testroot, args=args, stdin=stdin)
+        assert retcode == 0, out
+        return out
+    return run
+
+
+@pytest.fixture(params=['invocations', 'workers'])
+def mode_args(request, tmpdir):
+    """Arguments of the script compiling by invocations or persistent workers; tests
+    parametrized indirectly with "cache" compile by workers with bytecode cache."""
+    return {'invocations': [], 'workers': ['--workers'],
+        'cache': ['--cache-dir', str(tmpdir.join('cache'))]}[request.param]
+
+
+def test_compiles_libdirs_and_rootdir(sample_root, compile_ok):
+    testroot = sample_root(files={'usr/lib/python9.9/site-packages/foo.py': 'x = 1\n',
+         'usr/lib64/python9.9/site-packages/spam/__init__.py': '',
+         'usr/share/bar/baz.py': 'y = 2\n',
+         'usr/bin/not_compiled.py': 'z = 3\n'})
+    compile_ok(testroot, ['-j', '3'])
+
+    compiled = compiled_files(testroot)
+    for source in ['usr/lib/python9.9/site-packages/foo', 'usr/lib64/python9.9/site-packages/spam/__init__',
+            'usr/share/bar/baz']:
+        directory, name = os.path.split(source)
+        # both unoptimized and optimized bytecode for every source
+        assert len([c for c in compiled if c.startswith(directory) and
+            os.path.basename(c).startswith(name + '.')]) == 2
+    assert not [c for c in compiled if c.startswith('usr/bin')]
+
+
+@pytest.mark.parametrize('errors_terminate, expected_retcode', [('1', 12), ('0', 0)])
+def test_failing_invocation(pyruntime, tmpdir, errors_terminate, expected_retcode):
+    testroot = make_testroot(tmpdir,
+        {'python9.9': 'run=echo something went wrong; exit 3\n'},
+        {'usr/lib/python9.9/foo.py': ''})
+    retcode, out = run_bytecompile(pyruntime, testroot, errors_terminate=errors_terminate)
+    assert retcode == expected_retcode
+    assert BYTECOMPILE_SCRIPT + \
+        ': Error: bytecompilation from config "python9.9" failed with exit status 3:' in out
+    assert BYTECOMPILE_SCRIPT + ': something went wrong' in out
+
+
+def test_failure_kills_running_invocations(pyruntime, tmpdir):
+    testroot = make_testroot(tmpdir,
+        {'python9.9': 'run=exit 1\n', 'python8.8': 'run=sleep 60\n'},
+        {'usr/lib/python9.9/foo.py': '', 'usr/lib/python8.8/foo.py': ''})
+    start = time.time()
+    retcode, out = run_bytecompile(pyruntime, testroot, args=['--jobs', '4'])
+    assert retcode == 12
+    assert time.time() - start < 30
+    # killed invocations are not reported as failures
+    assert 'from config "python8.8" failed' not in out
+
+
+def test_dirs_without_sources_are_skipped(tmpdir, compile_ok):
+    testroot = make_testroot(tmpdir,
+        {'python9.9': 'default_for_rootdir=1\n', 'python8.8': ''},
+        {'usr/lib/python9.9/foo.py': '', 'usr/lib/python8.8/data.txt': '',
+         'usr/lib64/python8.8/deeper/still/no/sources.txt': ''})
+    out = compile_ok(testroot, ['--dry-run'])
+    # the rootdir of python9.9 and its libdir, without and with -O
+    assert out.count('compileall.compile_dir(') == 4
+    assert 'python8.8", ' not in out
+
+
+def test_workers_compile_same_files_as_invocations(sample_root, compile_ok):
+    compiled = []
+    for mode, args in [('invocations', []), ('workers', ['--workers'])]:
+        testroot = sample_root(subdir=mode)
+        compile_ok(testroot, args)
+        compiled.append(compiled_files(testroot))
+    assert compiled[0] == compiled[1]
+    assert len(compiled[1]) == 6
+
+
+def test_workers_through_run_wrapper(sample_root, compile_ok):
+    # the worker must be reachable even when started through a heredoc fed shell
+    testroot = sample_root("run=sh <<EOF\n {python} {flags} -c '{inline_script}'\n EOF\n")
+    compile_ok(testroot, ['--workers'])
+
+    compiled = [c for c in compiled_files(testroot) if c.startswith('usr/share/bar/')]
+    assert len(compiled) == 2
+    for c in compiled:
+        # the real path, not the buildroot path, is hardcoded to bytecode
+        with open(str(testroot.join(RPM_BUILDROOT, c)), 'rb') as f:
+            contents = f.read()
+        assert b'/usr/share/bar/baz.py' in contents
+        assert RPM_BUILDROOT.encode('ascii') not in contents
+
+
+def test_workers_report_errors(pyruntime, tmpdir):
+    testroot = make_testroot(tmpdir,
+        {'python9.9': 'python={0}\n'.format(pyruntime),
+         'python8.8': 'python=/nonexistent/python\n'},
+        {'usr/lib/python9.9/bad.py': 'def (\n', 'usr/lib/python8.8/foo.py': ''})
+    retcode, out = run_bytecompile(pyruntime, testroot, errors_terminate='0',
+        args=['--workers'])
+    assert retcode == 0
+    assert 'from config "python9.9" failed with exit status 1' in out
+    assert '*** Error compiling "{0}"'.format(
+        testroot.join(RPM_BUILDROOT, 'usr/lib/python9.9/bad.py')) in out
+    assert 'from config "python8.8" failed with exit status 127' in out
+
+
+@pytest.mark.parametrize('args', [[], ['--dedup']])
+def test_bytecode_cache(pyruntime, tmpdir, sample_root, compile_ok, args):
+    cache_dir = str(tmpdir.join('cache'))
+    compiled = []
+    for i, expected in enumerate(['0 hits, 6 misses, 6 stored', '6 hits, 0 misses, 0 stored']):
+        testroot = sample_root(subdir=str(i))
+        # sources of the second build are older than the cached bytecode
+        for path in SAMPLE_FILES:
+            os.utime(str(testroot.join(RPM_BUILDROOT, path)), (1000000000 + i, 1000000000 + i))
+        out = compile_ok(testroot, args + ['--cache-dir', cache_dir])
+        assert 'Bytecode cache "{0}": {1}, 0 evicted'.format(cache_dir, expected) in out
+        compiled.append(compiled_files(testroot))
+    assert compiled[0] == compiled[1]
+
+    # restored bytecode must be valid for the restored sources
+    bar = str(testroot.join(RPM_BUILDROOT, 'usr', 'share', 'bar'))
+    proc = subprocess.Popen([pyruntime, '-v', '-c',
+        'import sys; sys.path.insert(0, {0!r}); import baz'.format(bar)],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0].decode('utf-8')
+    assert ' matches {0}'.format(os.path.join(bar, 'baz.py')) in out
+
+
+def test_bytecode_cache_restores_deduplicated_bytecode(pyruntime, tmpdir, sample_root,
+        compile_ok):
+    if runtime_version(pyruntime) < (3, 5):
+        pytest.skip('needs .opt-N.pyc files')
+    args = ['--workers', '--dedup', '--cache-dir', str(tmpdir.join('cache'))]
+    options = 'optimization_levels=0 1\n'
+    # identical bytecode of both levels is hardlinked
+    testroot = sample_root(options, {'usr/share/foo/mod.py': 'x = 1\n'}, 'deduplicated')
+    compile_ok(testroot, args)
+    pycache = testroot.join(RPM_BUILDROOT, 'usr/share/foo/__pycache__')
+    assert [f.stat().nlink for f in pycache.listdir()] == [2, 2]
+
+    # bytecode of the changed source is cached by another build and restored
+    changed = 'x = 1\nassert False\n'
+    compile_ok(sample_root(options, {'usr/share/foo/mod.py': changed}, 'other'), args)
+    testroot.join(RPM_BUILDROOT, 'usr/share/foo/mod.py').write(changed)
+    assert '2 hits, 0 misses' in compile_ok(testroot, args)
+    assert sorted(f.stat().nlink for f in pycache.listdir()) == [1, 1]
+    assert len(set(f.stat().ino for f in pycache.listdir())) == 2
+
+    # level 0 keeps its assert
+    proc = subprocess.Popen([pyruntime, '-c',
+        'import sys; sys.path.insert(0, {0!r}); import mod'.format(str(pycache.dirpath()))],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0].decode('utf-8')
+    assert proc.returncode == 1
+    assert 'AssertionError' in out
+
+
+def test_bytecode_cache_eviction(pyruntime, tmpdir, compile_ok):
+    cache_dir = tmpdir.join('cache')
+    testroot = make_testroot(tmpdir,
+        {'python9.9': 'python={0}\ncache_dir={1}\n'.format(pyruntime, cache_dir)},
+        SAMPLE_FILES)
+    assert '4 stored, 4 evicted' in compile_ok(testroot, ['--cache-size', '1'])
+    assert not [f for f in cache_dir.visit() if f.check(file=True)]
+
+
+@pytest.mark.parametrize('batch_size, expected_batches', [('0', 1), ('8K', 5), (None, 1)])
+def test_big_directories_are_split(tmpdir, compile_ok, batch_size, expected_batches):
+    # 20 files of 1 KiB source (+ 1 KiB per-file overhead), 4 of them fit in 8 KiB batch
+    files = dict(('usr/lib/python9.9/mod{0}.py'.format(i), '#' * 1023 + '\n')
+        for i in range(20))
+    testroot = make_testroot(tmpdir, {'python9.9': ''}, files)
+    args = ['--dry-run', '--workers', '-j', '2']
+    if batch_size is not None:
+        args.extend(['--batch-size', batch_size])
+    out = compile_ok(testroot, args)
+
+    for flags in ['', '-O']:
+        batches = [l for l in out.splitlines() if l.endswith('with flags "{0}"'.format(flags))]
+        assert len(batches) == expected_batches
+        assert sum(int(b.split()[1]) for b in batches) == 20
+
+
+@pytest.mark.parametrize('batch_size, expected_batches', [('0', 1), ('1G', 2)])
+def test_huge_directories_are_planned_in_chunks(tmpdir, compile_ok, batch_size,
+        expected_batches):
+    # more files than PLAN_CHUNK_FILES, they're planned in two chunks unless one batch
+    #  per directory is asked for
+    files = dict(('usr/lib/python9.9/mod{0}.py'.format(i), '') for i in range(2100))
+    testroot = make_testroot(tmpdir, {'python9.9': 'optimization_levels=0\n'}, files)
+    out = compile_ok(testroot, ['--dry-run', '--workers', '--batch-size', batch_size])
+
+    batches = [l for l in out.splitlines() if l.endswith('with flags ""')]
+    assert len(batches) == expected_batches
+    assert sum(int(b.split()[1]) for b in batches) == 2100
+
+
+def test_workers_ownership_of_complex_root(pyruntime):
+    testroot = os.path.join(os.path.dirname(__file__), 'test_roots', 'complex')
+    buildroot = os.path.join(testroot, 'some/build/dir/BUILDROOT/foo-1.2.3.fcXY.x86_64')
+    proc = subprocess.Popen([pyruntime, BRP_PYTHON_BYTECOMPILE, '--dry-run', '--workers',
+        '--batch-size', '0', '--config-dir', os.path.join(testroot, 'etc', 'pypackages-tools'),
+        'python', '1'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env={'RPM_BUILD_ROOT': buildroot})
+    out = proc.communicate()[0].decode('utf-8')
+    assert proc.returncode == 0, out
+
+    expected = [('1', ''), ('2', '/usr/lib/python2.7'), ('1', '/usr/lib64/python2.7'),
+        ('1', '/usr/lib64/python3.4'), ('1', '/opt/rh/python33/root'),
+        ('1', '/opt/rh/python33/root/usr/lib/python3.3'),
+        ('1', '/opt/rh/python33/root/usr/lib64/python3.3')]
+    for files, directory in expected:
+        for flags in ['', '-O']:
+            assert '{0}: {1} files in "{2}" with flags "{3}"'.format(BYTECOMPILE_SCRIPT, files,
+                buildroot + directory, flags) in out
+    assert out.count(' files in ') == 2 * len(expected)
+
+
+def test_literal_path_matching(pyruntime, tmpdir, compile_ok, mode_args):
+    # neither bindirs nor regular expression metacharacters in path of the buildroot
+    #  itself affect what gets compiled, by invocations and workers alike
+    testroot = make_testroot(tmpdir.join('bin', 'a+b[c]'),
+        {'python9.9': 'default_for_rootdir=1\npython={0}\n'.format(pyruntime),
+         'python8.8': 'rootdir=/opt/(x|y)/\ndefault_for_rootdir=1\n' +
+            'python={0}\n'.format(pyruntime)},
+        {'usr/share/foo.py': '', 'opt/(x|y)/bar.py': '', 'opt/x/baz.py': '',
+         'usr/bin/not_compiled.py': ''})
+    compile_ok(testroot, mode_args)
+    assert [os.path.dirname(c) for c in compiled_files(testroot)] == \
+        ['opt/(x|y)/__pycache__'] * 2 + ['opt/x/__pycache__'] * 2 + ['usr/share/__pycache__'] * 2
+
+
+def test_report(tmpdir, sample_root, compile_ok, mode_args):
+    testroot = sample_root('optimization_levels=0\n')
+    report = tmpdir.join('report.json')
+    out = compile_ok(testroot, mode_args + ['--batch-size', '0', '--report', str(report)])
+    assert 'Slowest bytecompilation items:' in out
+
+    data = json.loads(report.read())
+    assert data['status'] == 0
+    assert [p['name'] for p in data['phases']] == ['load_configs', 'validation', 'planning',
+        'execution']
+    assert len(data['items']) == 3
+    for item in data['items']:
+        assert item['config'] == 'python9.9'
+        assert item['files_compiled'] == 1
+        assert item['wall_time'] > 0
+        assert item['cpu_time'] is not None
+        assert item['startup_time'] is not None
+    assert data['totals']['startup_time'] > 0
+    assert data['totals']['files_compiled'] == 3
+    assert data['totals']['bytes_read'] == sum(len(c) for p, c in SAMPLE_FILES.items()
+        if 'sbin' not in p)
+    assert data['totals']['bytes_written'] == sum(os.path.getsize(str(f))
+        for f in testroot.join(RPM_BUILDROOT).visit('*.py[co]'))
+
+
+def test_report_counts_files_written_by_the_run(tmpdir, sample_root, compile_ok, mode_args):
+    testroot = sample_root('optimization_levels=0\n')
+    compile_ok(testroot, mode_args)
+    testroot.join(RPM_BUILDROOT, 'usr', 'share', 'bar', 'new.py').write('x = 1\n')
+
+    report = tmpdir.join('report.json')
+    out = compile_ok(testroot, mode_args + ['--incremental', '--report', str(report)])
+    assert 'pypackages-tools-report' not in out
+    data = json.loads(report.read())
+    # bytecompiled files that were up to date before the run aren't counted
+    assert data['totals']['files_compiled'] == 1
+    assert data['totals']['bytes_read'] == len('x = 1\n')
+    assert data['totals']['bytes_written'] == sum(os.path.getsize(str(f))
+        for f in testroot.join(RPM_BUILDROOT).visit('new*.py[co]'))
+    assert all(item['startup_time'] > 0 for item in data['items'])
+
+
+@pytest.mark.parametrize('args, min_version', [([], (3, 9)), (['--workers'], (3, 2))])
+def test_single_pass_optimization_levels(pyruntime, tmpdir, sample_root, compile_ok, args,
+        min_version):
+    testroot = sample_root('optimization_levels=0 1 2\n')
+    report = tmpdir.join('report.json')
+    compile_ok(testroot, args + ['--batch-size', '0', '--report', str(report)])
+
+    compiled = compiled_files(testroot)
+    assert len(compiled) == 9
+    if runtime_version(pyruntime) >= (3, 5):
+        assert len([c for c in compiled if c.endswith('.opt-2.pyc')]) == 3
+    items = json.loads(report.read())['items']
+    # every directory is compiled in a single pass, unless the runtime is too old
+    if runtime_version(pyruntime) >= min_version:
+        assert len(items) == 3
+        assert [i['files_compiled'] for i in items] == [3, 3, 3]
+    else:
+        assert len(items) == 9
+
+
+# compiles every bytecompiled source of the buildroot given as argv[1] by py_compile,
+#  one level at a time, and prints the bytecompiled files that differ from those
+PY_COMPILE_SCRIPT = """
+import importlib.util, os, py_compile, sys, tempfile
+buildroot, mode = sys.argv[1:]
+expected = os.path.join(tempfile.mkdtemp(), "expected.pyc")
+for root, dirs, files in os.walk(buildroot):
+    for source in [os.path.join(root, f) for f in files if f.endswith(".py")]:
+        for level in [0, 1, 2]:
+            cfile = importlib.util.cache_from_source(source, optimization=level or "")
+            if not os.path.exists(cfile):
+                continue
+            py_compile.compile(source, cfile=expected, dfile=source[len(buildroot):],
+                optimize=level, invalidation_mode=getattr(py_compile.PycInvalidationMode, mode))
+            if open(expected, "rb").read() != open(cfile, "rb").read():
+                print(cfile)
+"""
+
+
+@pytest.mark.parametrize('mode', ['timestamp', 'checked-hash', 'unchecked-hash'])
+def test_single_pass_matches_py_compile(pyruntime, sample_root, compile_ok, mode):
+    if runtime_version(pyruntime) < (3, 7):
+        pytest.skip('single pass by workers needs Python 3.7')
+    files = dict(SAMPLE_FILES, **{'usr/share/foo/doc.py': '"""Docstring."""\nassert x\n'})
+    testroot = sample_root('optimization_levels=0 1 2\ninvalidation_mode={0}\n'.format(mode),
+        files)
+    compile_ok(testroot, ['--workers'])
+    assert len(compiled_files(testroot)) == 12
+    differing = subprocess.check_output([pyruntime, '-c', PY_COMPILE_SCRIPT,
+        str(testroot.join(RPM_BUILDROOT)), mode.upper().replace('-', '_')])
+    assert differing.decode('utf-8') == ''
+
+
+def test_optimization_levels_dry_run(tmpdir, compile_ok):
+    testroot = make_testroot(tmpdir,
+        {'python9.9': 'optimization_levels=0,2\nflags=-s\n'},
+        {'usr/lib/python9.9/foo.py': ''})
+    out = compile_ok(testroot, ['--dry-run'])
+    assert len([l for l in out.splitlines() if 'compileall' in l]) == 2
+    assert '/usr/bin/python9.9 -s -c' in out
+    assert '/usr/bin/python9.9 -s -OO -c' in out
+
+
+def test_plan_out_and_in(tmpdir, sample_root, compile_ok, mode_args):
+    testroot = sample_root()
+    plan = tmpdir.join('plan.json')
+    compile_ok(testroot, mode_args + ['--dry-run', '--plan-out', str(plan)])
+    assert not compiled_files(testroot)
+
+    # the configs aren't needed anymore
+    testroot.join('etc').remove()
+    compile_ok(testroot, ['--plan-in', str(plan)])
+    assert len(compiled_files(testroot)) == 6
+
+
+def test_plan_in_errors(pyruntime, tmpdir, compile_ok):
+    testroot = make_testroot(tmpdir, {'python9.9': ''}, {'usr/lib/python9.9/foo.py': ''})
+    plan = tmpdir.join('plan.json')
+    retcode, out = run_bytecompile(pyruntime, testroot, args=['--plan-in', str(plan)])
+    assert retcode == 13
+    assert 'can\'t load plan' in out
+
+    compile_ok(testroot, ['--dry-run', '--plan-out', str(plan)])
+    other = make_testroot(tmpdir.join('other'), {}, {})
+    retcode, out = run_bytecompile(pyruntime, other, args=['--plan-in', str(plan)])
+    assert retcode == 13
+    assert 'is for buildroot "{0}"'.format(testroot.join(RPM_BUILDROOT)) in out
+
+
+def test_plan_cache(tmpdir, sample_root, compile_ok):
+    testroot = sample_root()
+    args = ['--cache-dir', str(tmpdir.join('cache'))]
+    outputs = []
+    for change in [None, None, 'add_source', None, 'change_config', None]:
+        if change == 'add_source':
+            testroot.join(RPM_BUILDROOT, 'usr', 'share', 'new', 'new.py').write('', ensure=True)
+        elif change == 'change_config':
+            testroot.join('etc', 'pypackages-tools', 'python9.9.conf').write('\nflags=-s\n',
+                mode='a')
+        outputs.append(compile_ok(testroot, args))
+    assert ['Using cached plan' in out for out in outputs] == \
+        [False, True, False, True, False, True]
+    assert len(compiled_files(testroot)) == 8
+    # the plan of the changed layout replaced the stale one with the same key
+    assert len(tmpdir.join('cache', 'plans').listdir()) == 2
+
+
+@pytest.mark.parametrize('from_stdin', [False, True])
+def test_manifest(tmpdir, sample_root, compile_ok, from_stdin):
+    files = dict(SAMPLE_FILES)
+    files.update({'usr/share/bar/unlisted.py': '', 'usr/share/pkg/sub/listed.py': '',
+        'usr/share/data.txt': ''})
+    testroot = sample_root(files=files)
+    manifest = '\n'.join(['%doc README', '/usr/lib/python9.9/site-packages/foo.py',
+        '%attr(0644,root,root) "/usr/share/bar/baz.py"', '/usr/share/pkg',
+        '%ghost /usr/share/bar/ghost.py', '/usr/sbin/not_compiled.py', '/usr/share/data.txt',
+        '%dir /usr/share/bar', str(testroot.join(RPM_BUILDROOT, 'usr/share/bar/baz.py')), ''])
+    if from_stdin:
+        compile_ok(testroot, ['--manifest', '-'], stdin=manifest)
+    else:
+        tmpdir.join('manifest').write(manifest)
+        compile_ok(testroot, ['--manifest', str(tmpdir.join('manifest'))])
+    compiled = compiled_files(testroot)
+    assert len(compiled) == 6
+    assert set(os.path.dirname(c) for c in compiled) == set(['usr/share/bar/__pycache__',
+        'usr/share/pkg/sub/__pycache__', 'usr/lib/python9.9/site-packages/__pycache__'])
+    assert not [c for c in compiled if 'unlisted' in c]
+
+
+@pytest.mark.parametrize('errors_terminate', ['0', '1'])
+def test_planning_error(pyruntime, sample_root, errors_terminate):
+    testroot = sample_root('run={python} {flags} {typo} -c "{inline_script}"\n')
+    retcode, out = run_bytecompile(pyruntime, testroot, errors_terminate=errors_terminate)
+    assert retcode == 12, out
+    assert 'Error: bytecompilation failed unexpectedly:' in out
+    assert "KeyError: 'typo'" in out
+    assert compiled_files(testroot) == []
+
+
+def test_missing_manifest(pyruntime, tmpdir, sample_root):
+    testroot = sample_root()
+    manifest = tmpdir.join('missing')
+    retcode, out = run_bytecompile(pyruntime, testroot, args=['--manifest', str(manifest)])
+    assert retcode == 15, out
+    assert 'Error: can\'t read manifest "{0}"'.format(manifest) in out
+    assert 'Traceback' not in out
+    assert compiled_files(testroot) == []
+
+
+@pytest.mark.parametrize('mode_args', ['invocations', 'workers', 'cache'], indirect=True)
+def test_dedup(pyruntime, tmpdir, sample_root, compile_ok, mode_args):
+    if runtime_version(pyruntime) < (3, 5):
+        pytest.skip('needs .opt-N.pyc files')
+    # without docstrings and asserts, all optimization levels give identical bytecode
+    files = {'usr/share/foo/same.py': 'x = 1\n',
+        'usr/share/foo/different.py': '"""Docstring."""\nassert x\n'}
+    testroot = sample_root('optimization_levels=0 1 2\n', files)
+    report = tmpdir.join('report.json')
+    out = compile_ok(testroot, mode_args + ['--dedup', '--report', str(report)])
+
+    pycache = testroot.join(RPM_BUILDROOT, 'usr/share/foo/__pycache__')
+    links = dict((f.basename, f.stat().nlink) for f in pycache.listdir())
+    assert [n for b, n in links.items() if b.startswith('same.')] == [3, 3, 3]
+    assert sorted(n for b, n in links.items() if b.startswith('different.')) == [1, 1, 1]
+    saved = 2 * pycache.listdir('same.*')[0].size()
+    assert 'Deduplicated bytecode: 2 files replaced by hardlinks, {0} bytes saved'.format(
+        saved) in out
+    assert json.loads(report.read())['dedup'] == {'files_linked': 2, 'bytes_saved': saved}
+
+
+def test_verify(pyruntime, tmpdir, sample_root, compile_ok):
+    testroot = sample_root('optimization_levels=0 1\n')
+    findings = tmpdir.join('findings.json')
+    retcode, out = run_bytecompile(pyruntime, testroot, args=['--verify', str(findings)])
+    assert retcode == 14, out
+    data = json.loads(findings.read())
+    assert data['checked'] == 6
+    assert data['counts'] == {'missing': 6}
+
+    compile_ok(testroot)
+    compiled = compiled_files(testroot)
+    assert not [f for f in compiled if 'sbin' in f]
+    compile_ok(testroot, ['--verify', str(findings)])
+    assert json.loads(findings.read())['counts'] == {'ok': 6}
+
+    buildroot = testroot.join(RPM_BUILDROOT)
+    buildroot.join(compiled[0]).remove()
+    with open(str(buildroot.join(compiled[1])), 'r+b') as f:
+        f.write(b'\0\0\0\0')
+    stale = [p for p in SAMPLE_FILES if 'sbin' not in p and
+        os.path.basename(p)[:-3] not in compiled[0] + compiled[1]][0]
+    buildroot.join(stale).write('# changed\n', mode='a')
+    retcode, out = run_bytecompile(pyruntime, testroot, args=['--verify', '-'])
+    assert retcode == 14, out
+    data = json.loads(out[out.index('{'):out.rindex('}') + 1])
+    assert data['counts'] == {'ok': 2, 'missing': 1, 'wrong_interpreter': 1, 'stale': 2}
+    assert sorted((p['status'], os.path.relpath(p['cfile'], str(buildroot)))
+        for p in data['problems'] if p['status'] != 'stale') == \
+        [('missing', compiled[0]), ('wrong_interpreter', compiled[1])]
+    assert set(p['source'] for p in data['problems'] if p['status'] == 'stale') == \
+        set([str(buildroot.join(stale))])
+
+
+@pytest.mark.parametrize('mode_args', ['invocations', 'workers', 'cache'], indirect=True)
+@pytest.mark.parametrize('mode, flags', [('unchecked-hash', 1), ('checked-hash', 3),
+    ('timestamp', 0)])
+def test_invalidation_mode(pyruntime, sample_root, compile_ok, default_config, mode_args, mode,
+        flags):
+    if runtime_version(pyruntime) < (3, 7):
+        pytest.skip('hash based bytecompiled files need Python 3.7')
+    options = 'optimization_levels=0 1 2\n'
+    testroot = sample_root(options + 'invalidation_mode=' + mode)
+    # the second run restores files from the cache
+    for i in range(2 if '--cache-dir' in mode_args else 1):
+        compile_ok(testroot, mode_args)
+
+        compiled = compiled_files(testroot)
+        assert len(compiled) == 9
+        for f in compiled:
+            with open(str(testroot.join(RPM_BUILDROOT, f)), 'rb') as pyc:
+                assert pyc.read(8)[4] == flags
+
+    compile_ok(testroot, ['--verify', '-'])
+    # files written with another mode than configured are stale
+    other = 'timestamp' if mode != 'timestamp' else 'checked-hash'
+    testroot.join('etc', 'pypackages-tools', 'python9.9.conf').write(
+        '[bytecompile]\n' + default_config + options + 'invalidation_mode=' + other)
+    retcode, out = run_bytecompile(pyruntime, testroot, args=['--verify', '-'])
+    assert retcode == 14, out
+    assert '"stale": 9' in out
+
+
+def test_incremental(tmpdir, sample_root, compile_ok, mode_args):
+    testroot = sample_root()
+    report = tmpdir.join('report.json')
+    out = compile_ok(testroot, mode_args + ['--incremental'])
+    assert '0 up to date files skipped, 6 files compiled' in out
+
+    buildroot = testroot.join(RPM_BUILDROOT)
+    compiled = compiled_files(testroot)
+    mtimes = dict((f, os.stat(str(buildroot.join(f))).st_mtime) for f in compiled)
+    time.sleep(1.1)
+    buildroot.join('usr/share/bar/baz.py').write('# changed\n', mode='a')
+    out = compile_ok(testroot, mode_args + ['--incremental', '--report', str(report)])
+    assert '4 up to date files skipped, 2 files compiled' in out
+    assert json.loads(report.read())['incremental'] == {'skipped': 4, 'compiled': 2}
+    changed = [f for f in compiled if os.stat(str(buildroot.join(f))).st_mtime != mtimes[f]]
+    assert len(changed) == 2
+    assert all('baz.' in f for f in changed)
+
+    compile_ok(testroot, mode_args + ['--verify', '-'])
+
+
+def test_more_buildroots(pyruntime, tmpdir, sample_root, mode_args):
+    testroot = sample_root()
+    others = [make_testroot(tmpdir.join(name), {}, files) for name, files in
+        [('good', SAMPLE_FILES), ('bad', {'usr/share/foo/bad.py': 'def\n'}),
+         ('unassociated', {'usr/lib/python8.8/foo.py': ''})]]
+    buildroots = tmpdir.join('buildroots.txt')
+    buildroots.write('# buildroots\n\n' + '\n'.join(str(t.join(RPM_BUILDROOT))
+        for t in others[1:]) + '\n')
+    retcode, out = run_bytecompile(pyruntime, testroot, errors_terminate='0',
+        args=mode_args + ['--buildroot', str(testroot.join(RPM_BUILDROOT)),
+            '--buildroot', str(others[0].join(RPM_BUILDROOT)), '--buildroots', '-'],
+        stdin=buildroots.read())
+    # the failure doesn't stop compilation of the other buildroots
+    assert retcode == 11, out
+    assert len(compiled_files(testroot)) == 6
+    assert len(compiled_files(others[0])) == 6
+    assert 'Buildroot "{0}": status 0'.format(others[1].join(RPM_BUILDROOT)) in out
+    assert 'Error: bytecompilation of "{0}" from config "python9.9" failed'.format(
+        others[1].join(RPM_BUILDROOT)) in out
+    assert 'Buildroot "{0}": status 11'.format(others[2].join(RPM_BUILDROOT)) in out
+
+    retcode, out = run_bytecompile(pyruntime, testroot,
+        args=['--buildroot', str(testroot.join(RPM_BUILDROOT)), '--report', 'x.json'])
+    assert retcode == 2
+    assert '--report can\'t be used with --buildroot' in out
+
+
+@pytest.mark.parametrize('args, inline_script', [
+    ([], ''),
+    (['--workers'], ''),
+    # the interpreter must see the environment set up by the wrapper
+    ([], 'inline_script=import os, sys; sys.exit(os.environ.get("WRAPPED") != "yes")\n'),
+])
+def test_capture_environment(tmpdir, sample_root, compile_ok, args, inline_script):
+    log = tmpdir.join('wrapper.log')
+    run = "run=echo run >> {0}; WRAPPED=yes sh <<EOF\n {{python}} {{flags}} -c '{{inline_script}}'\n EOF\n".format(log)
+    testroot = sample_root(run + inline_script + 'capture_environment=1\n')
+    out = compile_ok(testroot, args + ['-j', '3'])
+    assert 'Captured environment of config "python9.9"' in out
+    # the wrapper is run only once, to capture the environment
+    assert log.read() == 'run\n'
+    if not inline_script:
+        assert len(compiled_files(testroot)) == 6
+
+    # without capturing, the wrapper is run by every invocation, worker and probe
+    log.remove()
+    compile_ok(sample_root(run + inline_script, subdir='plain'), args + ['-j', '3'])
+    assert len(log.read().splitlines()) > 1
@@ -0,0 +1,106 @@
+import os
+import subprocess
+
+import pytest
+
+from pypackages_tools import pythondeps
+from pypackages_tools.bytecompile import load_configs
+from pypackages_tools.pythondeps import MetadataCache, generate, parse_requirement
+from .test_bytecompile_runs import RPM_BUILDROOT, make_testroot
+
+PYTHONDISTDEPS_SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'pythondistdeps.py')
+
+METADATA = '''Metadata-Version: 2.1
+Name: Foo_Bar
+Version: 1.2
+Requires-Dist: six
+Requires-Dist: requests (>=2.0,<3)
+Requires-Dist: spam.eggs==1.0
+Requires-Dist: pytest; extra == "test"
+Requires-Dist: enum34; python_version < "3.4"
+
+Requires-Dist: not a header, just a description
+'''
+PKG_INFO = 'Metadata-Version: 1.1\nName: baz\nVersion: 0.1\n\nDescription\n'
+REQUIRES_TXT = 'ham>=2\n\n[test]\nmock\n'
+DIST_FILES = {
+    'usr/lib/python3.6/site-packages/Foo_Bar-1.2.dist-info/METADATA': METADATA,
+    'usr/lib/python3.6/site-packages/Foo_Bar-1.2.dist-info/RECORD': '',
+    'usr/lib/python3.6/site-packages/foo_bar.py': '',
+    'usr/lib64/python2.7/site-packages/baz-0.1-py2.7.egg-info/PKG-INFO': PKG_INFO,
+    'usr/lib64/python2.7/site-packages/baz-0.1-py2.7.egg-info/requires.txt': REQUIRES_TXT,
+    'usr/lib64/python2.7/site-packages/single-3-py2.7.egg-info': 'Name: single\nVersion: 3\n',
+}
+
+
+@pytest.fixture
+def distroot(tmpdir):
+    testroot = make_testroot(tmpdir, {'python3.6': '', 'python2.7': ''}, DIST_FILES)
+    rpm_buildroot = str(testroot.join(RPM_BUILDROOT))
+    configs = load_configs(str(testroot.join('etc', 'pypackages-tools')))
+    paths = [os.path.join(rpm_buildroot, p) for p in sorted(DIST_FILES)]
+    return rpm_buildroot, configs, paths
+
+
+@pytest.mark.parametrize('requirement, expected', [
+    ('six', ('six', [])),
+    ('requests (>=2.0,<3)', ('requests', [('>=', '2.0'), ('<', '3')])),
+    ('foo[bar] ~= 1.4', ('foo', [('~=', '1.4')])),
+    ('pytest; extra == "test"', None),
+    ('not a requirement!', None),
+])
+def test_parse_requirement(requirement, expected):
+    assert parse_requirement(requirement) == expected
+
+
+def test_provides_and_requires(distroot):
+    rpm_buildroot, configs, paths = distroot
+    assert generate(paths, rpm_buildroot, configs, jobs=3) == [
+        'python2.7dist(baz) = 0.1', 'python2.7dist(single) = 3',
+        'python3.6dist(foo-bar) = 1.2']
+    assert generate(paths, rpm_buildroot, configs, requires=True, jobs=3) == [
+        'python2.7dist(ham) >= 2', 'python3.6dist(requests) < 3',
+        'python3.6dist(requests) >= 2.0', 'python3.6dist(six)',
+        'python3.6dist(spam-eggs) = 1.0']
+
+
+def test_metadata_cache(distroot, tmpdir, monkeypatch):
+    rpm_buildroot, configs, paths = distroot
+    cache = MetadataCache(str(tmpdir.join('cache')))
+    provides = generate(paths, rpm_buildroot, configs, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    # called once per file, as RPM does
+    cache = MetadataCache(str(tmpdir.join('cache')))
+    assert sorted(set(sum([generate([p], rpm_buildroot, configs, cache=cache) for p in paths],
+        []))) == provides
+    assert (cache.hits, cache.misses) == (4, 0)
+
+    # changed metadata is parsed again
+    with open(paths[0], 'a') as f:
+        f.write('More description\n')
+    assert generate(paths[:1], rpm_buildroot, configs, cache=cache) == provides[2:]
+    assert (cache.hits, cache.misses) == (4, 1)
+
+    # metadata with changed stats only is hashed, but not parsed again
+    os.utime(paths[0], (1000000000, 1000000000))
+    monkeypatch.setattr(pythondeps, 'read_metadata', None)
+    assert generate(paths[:1], rpm_buildroot, configs, cache=cache) == provides[2:]
+    assert (cache.hits, cache.misses) == (5, 1)
+    # unchanged metadata isn't even read
+    monkeypatch.setattr(pythondeps, 'hash_metadata', None)
+    assert generate(paths, rpm_buildroot, configs, cache=cache) == provides
+    assert (cache.hits, cache.misses) == (8, 1)
+
+
+def test_script(pyruntime, distroot):
+    rpm_buildroot, configs, paths = distroot
+    testroot = os.path.dirname(rpm_buildroot)
+    proc = subprocess.Popen([pyruntime, PYTHONDISTDEPS_SCRIPT, '--requires', '--config-dir',
+        os.path.join(testroot, 'etc', 'pypackages-tools')], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, env={'RPM_BUILD_ROOT': rpm_buildroot,
+            'PYTHONPATH': os.path.join(os.path.dirname(__file__), '..')})
+    out = proc.communicate('\n'.join(paths[:2]).encode('utf-8'))[0].decode('utf-8')
+    assert proc.returncode == 0
+    assert out.splitlines() == ['python3.6dist(requests) < 3',
+        'python3.6dist(requests) >= 2.0', 'python3.6dist(six)',
+        'python3.6dist(spam-eggs) = 1.0']